@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+#
+# Load test for ffs: starts "ffs.py --headless" on localhost with a
+# throwaway home directory, drives concurrent download and upload
+# clients against it and prints the results as JSON, e.g.
+#
+#   ./benchmark.py --sizes 1K,1M,100M,4G --clients 8 > before.json
+#
+# Every scenario runs against a fresh server process so that the peak
+# RSS (VmHWM in /proc) belongs to that scenario only.
+
+import argparse, hashlib, json, math, os, platform, shutil, socket, subprocess, sys
+import tempfile, threading, time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+BLOCK_SIZE = 1024 * 1024
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size (value):
+    value = value.strip ().upper ().rstrip ("B")
+    if (value and value[-1] in UNITS):
+        return int (float (value[:-1]) * UNITS[value[-1]])
+    return int (value)
+
+
+def format_size (size):
+    for unit in ["G", "M", "K"]:
+        if (size >= UNITS[unit] and size % UNITS[unit] == 0):
+            return "%d%s" % (size // UNITS[unit], unit)
+    return "%d" % size
+
+
+def percentile (values, p):
+    # nearest-rank percentile
+    if (not values):
+        return None
+    values = sorted (values)
+    rank = max (1, int (math.ceil (p / 100.0 * len (values))))
+    return values[rank - 1]
+
+
+def create_file (path, size):
+    # incompressible content, so the sizes on the wire match
+    block = os.urandom (min (size, BLOCK_SIZE))
+    with open (path, "wb") as f:
+        remaining = size
+        while (remaining > 0):
+            f.write (block[:remaining])
+            remaining -= len (block)
+
+
+def create_tree (path, files, size):
+    for i in range (files):
+        directory = os.path.join (path, "dir%d" % (i % 10))
+        if (not os.path.isdir (directory)):
+            os.makedirs (directory)
+        if (i % 2):
+            # half of the files compress well
+            with open (os.path.join (directory, "text%d.txt" % i), "w") as f:
+                line = "%08d some fairly repetitive log line\n" % i
+                f.write (line * (size // len (line)))
+        else:
+            create_file (os.path.join (directory, "data%d.bin" % i), size)
+
+
+def get_free_port ():
+    s = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+    s.bind (("127.0.0.1", 0))
+    port = s.getsockname ()[1]
+    s.close ()
+    return port
+
+
+def get_peak_rss (pid):
+    # kB, None where /proc is not available
+    try:
+        with open ("/proc/%d/status" % pid) as f:
+            for line in f:
+                if (line.startswith ("VmHWM:")):
+                    return int (line.split ()[1])
+    except IOError:
+        pass
+    return None
+
+
+class BenchmarkServer:
+
+    # An ffs process in headless mode. HOME and the XDG directories
+    # point into 'workdir', so uploads and caches never touch the real
+    # home directory and every run starts from the same state.
+
+    def __init__ (self, args, workdir, files, extra_args = []):
+        self.port = get_free_port ()
+        env = dict (os.environ)
+        env["HOME"] = workdir
+        env["XDG_CACHE_HOME"] = os.path.join (workdir, "cache")
+        env["XDG_CONFIG_HOME"] = os.path.join (workdir, "config")
+        self.upload_dir = os.path.join (workdir, "downloads")
+        for d in [env["XDG_CONFIG_HOME"], self.upload_dir]:
+            if (not os.path.isdir (d)):
+                os.makedirs (d)
+        with open (os.path.join (env["XDG_CONFIG_HOME"], "user-dirs.dirs"), "w") as f:
+            f.write ("XDG_DOWNLOAD_DIR=\"%s\"\n" % self.upload_dir)
+
+        command = [args.python, args.ffs, "--headless", "--no-upnp",
+                   "--no-zeroconf", "-u", "-p", str (self.port)]
+        self.log = open (os.path.join (workdir, "server.log"), "ab")
+        self.process = subprocess.Popen (command + extra_args + files, env = env,
+                                         stdout = self.log, stderr = self.log)
+        self.wait_until_ready ()
+
+
+    def request (self, method, path, timeout = 10):
+        conn = httplib.HTTPConnection ("127.0.0.1", self.port, timeout = timeout)
+        try:
+            conn.request (method, path)
+            response = conn.getresponse ()
+            response.read ()
+            return response.status
+        finally:
+            conn.close ()
+
+
+    def wait_until_ready (self, timeout = 30):
+        deadline = time.time () + timeout
+        while (time.time () < deadline):
+            if (self.process.poll () != None):
+                raise Exception ("ffs exited with status %d, see %s"
+                                 % (self.process.returncode, self.log.name))
+            try:
+                self.request ("HEAD", "/")
+                return
+            except (socket.error, httplib.HTTPException):
+                time.sleep (0.05)
+        raise Exception ("ffs did not start in %d seconds" % timeout)
+
+
+    def stop (self):
+        # returns the peak RSS of the server in kB
+        peak_rss = get_peak_rss (self.process.pid)
+        self.process.terminate ()
+        self.process.wait ()
+        self.log.close ()
+        return peak_rss
+
+
+class ClientResult:
+
+    def __init__ (self):
+        self.latencies = []
+        self.first_byte = []
+        self.bytes = 0
+        self.errors = 0
+
+
+def download (port, path, result):
+    started = time.time ()
+    conn = httplib.HTTPConnection ("127.0.0.1", port, timeout = 600)
+    try:
+        conn.request ("GET", path)
+        response = conn.getresponse ()
+        # time to the response headers
+        first = time.time ()
+        received = 0
+        while (True):
+            data = response.read (BLOCK_SIZE)
+            if (not data):
+                break
+            received += len (data)
+        if (response.status != 200):
+            result.errors += 1
+            return
+        result.first_byte.append (first - started)
+        result.latencies.append (time.time () - started)
+        result.bytes += received
+    except (socket.error, httplib.HTTPException):
+        result.errors += 1
+    finally:
+        conn.close ()
+
+
+def upload (port, source, name, result):
+    boundary = "ffsbenchmarkboundary%d" % id (result)
+    head = ("--%s\r\n"
+            "Content-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+            % (boundary, name)).encode ("ascii")
+    tail = ("\r\n--%s--\r\n" % boundary).encode ("ascii")
+    size = os.path.getsize (source)
+
+    started = time.time ()
+    conn = httplib.HTTPConnection ("127.0.0.1", port, timeout = 600)
+    try:
+        conn.putrequest ("POST", "/")
+        conn.putheader ("Content-Type", "multipart/form-data; boundary=%s" % boundary)
+        conn.putheader ("Content-Length", str (len (head) + size + len (tail)))
+        conn.endheaders ()
+        conn.send (head)
+        with open (source, "rb") as f:
+            while (True):
+                data = f.read (BLOCK_SIZE)
+                if (not data):
+                    break
+                conn.send (data)
+        conn.send (tail)
+        response = conn.getresponse ()
+        response.read ()
+        if (response.status != 200):
+            result.errors += 1
+            return
+        result.latencies.append (time.time () - started)
+        result.bytes += size
+    except (socket.error, httplib.HTTPException):
+        result.errors += 1
+    finally:
+        conn.close ()
+
+
+def run_clients (clients, requests, work):
+    # runs work (client, request, result) in 'clients' threads
+    results = [ClientResult () for i in range (clients)]
+    def client_loop (client):
+        for request in range (requests):
+            work (client, request, results[client])
+
+    threads = [threading.Thread (target = client_loop, args = (i,))
+               for i in range (clients)]
+    started = time.time ()
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    elapsed = time.time () - started
+
+    merged = ClientResult ()
+    for result in results:
+        merged.latencies += result.latencies
+        merged.first_byte += result.first_byte
+        merged.bytes += result.bytes
+        merged.errors += result.errors
+    return merged, elapsed
+
+
+def summarize (scenario, size, clients, merged, elapsed, peak_rss):
+    to_ms = lambda s: None if s == None else round (s * 1000, 2)
+    return {"scenario": scenario,
+            "size": size,
+            "clients": clients,
+            "requests": len (merged.latencies),
+            "errors": merged.errors,
+            "bytes": merged.bytes,
+            "seconds": round (elapsed, 3),
+            "throughput_mb_s": round (merged.bytes / elapsed / UNITS["M"], 2),
+            "requests_per_s": round (len (merged.latencies) / elapsed, 2),
+            "latency_p50_ms": to_ms (percentile (merged.latencies, 50)),
+            "latency_p99_ms": to_ms (percentile (merged.latencies, 99)),
+            "first_byte_p50_ms": to_ms (percentile (merged.first_byte, 50)),
+            "first_byte_p99_ms": to_ms (percentile (merged.first_byte, 99)),
+            "peak_rss_kb": peak_rss}
+
+
+def benchmark_download (args, workdir, size):
+    path = os.path.join (workdir, "files", "download-%s.bin" % format_size (size))
+    if (not os.path.exists (path)):
+        create_file (path, size)
+
+    server = BenchmarkServer (args, workdir, [path])
+    try:
+        requests = args.requests if size < UNITS["G"] else 1
+        merged, elapsed = run_clients (args.clients, requests,
+                                       lambda c, r, result: download (server.port, "/1", result))
+    finally:
+        peak_rss = server.stop ()
+    return summarize ("download", size, args.clients, merged, elapsed, peak_rss)
+
+
+def benchmark_upload (args, workdir, size):
+    path = os.path.join (workdir, "files", "upload-%s.bin" % format_size (size))
+    if (not os.path.exists (path)):
+        create_file (path, size)
+
+    server = BenchmarkServer (args, workdir, [])
+    try:
+        requests = args.requests if size < UNITS["G"] else 1
+        def work (client, request, result):
+            upload (server.port, path, "upload-%d-%d.bin" % (client, request), result)
+        merged, elapsed = run_clients (args.clients, requests, work)
+    finally:
+        peak_rss = server.stop ()
+        shutil.rmtree (server.upload_dir, True)
+    return summarize ("upload", size, args.clients, merged, elapsed, peak_rss)
+
+
+def benchmark_fetch (args, workdir, size):
+    # "ffs.py --fetch" against a real server: parallel segmented
+    # download, checked against the shared file
+    path = os.path.join (workdir, "files", "download-%s.bin" % format_size (size))
+    if (not os.path.exists (path)):
+        create_file (path, size)
+    output = os.path.join (workdir, "fetched.bin")
+
+    server = BenchmarkServer (args, workdir, [path])
+    merged = ClientResult ()
+    try:
+        started = time.time ()
+        status = subprocess.call ([args.python, args.ffs, "--fetch",
+                                   "http://127.0.0.1:%d/1" % server.port,
+                                   "-o", output, "-j", str (args.connections)],
+                                  stdout = server.log, stderr = server.log)
+        elapsed = time.time () - started
+        if (status == 0 and file_digest (output) == file_digest (path)):
+            merged.latencies.append (elapsed)
+            merged.bytes += size
+        else:
+            merged.errors += 1
+    finally:
+        peak_rss = server.stop ()
+        if (os.path.exists (output)):
+            os.remove (output)
+    return summarize ("fetch", size, args.connections, merged, elapsed, peak_rss)
+
+
+def file_digest (path):
+    digest = hashlib.sha256 ()
+    with open (path, "rb") as f:
+        data = f.read (BLOCK_SIZE)
+        while (data):
+            digest.update (data)
+            data = f.read (BLOCK_SIZE)
+    return digest.hexdigest ()
+
+
+def benchmark_archive (args, workdir, prepare):
+    tree = os.path.join (workdir, "files", "tree")
+    if (not os.path.exists (tree)):
+        create_tree (tree, args.archive_files, parse_size (args.archive_file_size))
+    shutil.rmtree (os.path.join (workdir, "cache"), True)
+
+    if (not prepare):
+        server = BenchmarkServer (args, workdir, [tree])
+        try:
+            merged, elapsed = run_clients (args.clients, 1,
+                                           lambda c, r, result: download (server.port, "/1", result))
+        finally:
+            peak_rss = server.stop ()
+        return summarize ("archive-stream", None, args.clients, merged, elapsed, peak_rss)
+
+    # time until the prepared archive is served (202 while preparing)
+    server = BenchmarkServer (args, workdir, [tree], ["--prepare-archives"])
+    try:
+        started = time.time ()
+        while (server.request ("HEAD", "/1") == 202):
+            time.sleep (0.01)
+        preparation = time.time () - started
+        merged, elapsed = run_clients (args.clients, 1,
+                                       lambda c, r, result: download (server.port, "/1", result))
+    finally:
+        peak_rss = server.stop ()
+    summary = summarize ("archive-prepared", None, args.clients, merged, elapsed, peak_rss)
+    summary["preparation_ms"] = round (preparation * 1000, 2)
+    return summary
+
+
+def get_revision (ffs):
+    try:
+        return subprocess.check_output (["git", "describe", "--always", "--dirty"],
+                                        cwd = os.path.dirname (ffs)).decode ().strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main ():
+    parser = argparse.ArgumentParser (description = "Load test ffs on localhost "
+                                      "and print the results as JSON.")
+    parser.add_argument ("--ffs", default = os.path.join (os.path.dirname (os.path.abspath (__file__)), "ffs.py"),
+                         help = "ffs.py to test (default: the one next to this script)")
+    parser.add_argument ("--python", default = sys.executable,
+                         help = "interpreter used to run ffs.py")
+    parser.add_argument ("--sizes", default = "1K,1M,100M",
+                         help = "comma separated file sizes, e.g. 1K,1M,4G "
+                                "(default: %(default)s)")
+    parser.add_argument ("--clients", type = int, default = 8,
+                         help = "concurrent clients (default: %(default)s)")
+    parser.add_argument ("--requests", type = int, default = 10,
+                         help = "requests per client, 1 for sizes of 1G "
+                                "and more (default: %(default)s)")
+    parser.add_argument ("--connections", type = int, default = 4,
+                         help = "parallel connections of the fetch client "
+                                "(default: %(default)s)")
+    parser.add_argument ("--archive-files", type = int, default = 200,
+                         help = "files in the directory share (default: %(default)s)")
+    parser.add_argument ("--archive-file-size", default = "1M",
+                         help = "size of each file in the directory share "
+                                "(default: %(default)s)")
+    parser.add_argument ("--skip", default = "",
+                         help = "comma separated scenarios to skip: download, "
+                                "upload, fetch, archive")
+    parser.add_argument ("--workdir",
+                         help = "keep generated files here between runs "
+                                "(default: a temporary directory)")
+    parser.add_argument ("-o", "--output", help = "write JSON here instead of stdout")
+    args = parser.parse_args ()
+
+    workdir = args.workdir or tempfile.mkdtemp (prefix = "ffs-benchmark-")
+    if (not os.path.isdir (os.path.join (workdir, "files"))):
+        os.makedirs (os.path.join (workdir, "files"))
+    skip = set (args.skip.split (","))
+
+    results = []
+    try:
+        for size in [parse_size (s) for s in args.sizes.split (",")]:
+            if ("download" not in skip):
+                results.append (benchmark_download (args, workdir, size))
+            if ("upload" not in skip):
+                results.append (benchmark_upload (args, workdir, size))
+            if ("fetch" not in skip):
+                results.append (benchmark_fetch (args, workdir, size))
+        if ("archive" not in skip):
+            results.append (benchmark_archive (args, workdir, False))
+            results.append (benchmark_archive (args, workdir, True))
+    finally:
+        if (not args.workdir):
+            shutil.rmtree (workdir, True)
+
+    report = {"revision": get_revision (args.ffs),
+              "python": args.python,
+              "platform": platform.platform (),
+              "cpus": os.sysconf ("SC_NPROCESSORS_ONLN"),
+              "time": time.strftime ("%Y-%m-%dT%H:%M:%SZ", time.gmtime ()),
+              "results": results}
+    output = json.dumps (report, indent = 2, sort_keys = True)
+    if (args.output):
+        with open (args.output, "w") as f:
+            f.write (output + "\n")
+    else:
+        print (output)
+
+
+if __name__ == "__main__":
+    main ()
@@ -17,8 +17,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import argparse, avahi, logging, os, signal, socket, sys, tempfile, traceback, types
-from gi.repository import Gio, GLib, GObject, Gtk, GUPnPIgd, Pango, Soup
+import argparse, base64, binascii, bisect, collections, errno, hashlib, json, logging, math, multiprocessing, os, shutil, signal, socket, struct, sys, tempfile, threading, time, traceback, types, zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import http.client as httplib
+    import urllib.parse as urlparse
+except ImportError:
+    import httplib, urlparse
+from gi.repository import Gio, GLib, GObject, Soup
+
+# The user interface, UPnP and zeroconf modules are slow to import and
+# not available everywhere: they are imported only when they are used.
+Gtk = None
+Pango = None
 
 FFS_APP_NAME = "Friendly File Server"
 
@@ -31,7 +42,151 @@ class FormInfo:
     DOWNLOAD_NOT_FOUND = 3
     PREPARING_DOWNLOAD = 4
     DOWNLOAD_FAILURE = 5
-
+    SERVER_BUSY = 6
+
+
+# Size of the reads done when streaming a file to a client. A transfer
+# never holds more than one chunk of file data in memory.
+CHUNK_SIZE = 64 * 1024
+
+# Content-defined chunks for delta downloads, see split_delta_chunks().
+# Files smaller than DELTA_MIN_FILE_SIZE are always fetched whole.
+DELTA_CHUNK_MIN_SIZE = 256 * 1024
+DELTA_CHUNK_MAX_SIZE = 8 * 1024 * 1024
+DELTA_CHUNK_WINDOW = 32
+DELTA_CHUNK_MASK = 0xFFF
+DELTA_MIN_FILE_SIZE = 16 * 1024 * 1024
+
+# Uploads the file selected in the upload form with the resumable upload
+# protocol (see FriendlyResumableUpload), retrying with backoff when the
+# connection drops. Browsers without the File API use the plain form.
+UPLOAD_SCRIPT = """<script type="text/javascript">
+(function () {
+  var form = document.getElementById ("upload-form");
+  var status = document.getElementById ("upload-status");
+  if (!form || !window.XMLHttpRequest || !window.Blob || !Blob.prototype.slice)
+    return;
+  var CHUNK_SIZE = 8 * 1024 * 1024;
+  var MAX_RETRIES = 8;
+
+  function show (text) {
+    status.innerHTML = "";
+    var p = document.createElement ("p");
+    p.appendChild (document.createTextNode (text));
+    status.appendChild (p);
+  }
+
+  function request (method, url, headers, body, done, progress) {
+    var xhr = new XMLHttpRequest ();
+    xhr.open (method, url);
+    xhr.setRequestHeader ("Tus-Resumable", "1.0.0");
+    for (var name in headers)
+      xhr.setRequestHeader (name, headers[name]);
+    xhr.onload = function () { done (xhr); };
+    xhr.onerror = function () { done (null); };
+    if (progress && xhr.upload)
+      xhr.upload.onprogress = function (e) { progress (e.loaded); };
+    xhr.send (body);
+  }
+
+  function upload (file) {
+    var key = "ffs-upload:" + file.name + ":" + file.size + ":" + file.lastModified;
+    var url = null;
+    var retries = 0;
+    var sent_any = false;
+    try { url = window.localStorage.getItem (key); } catch (e) {}
+
+    function remember (value) {
+      try {
+        if (value) window.localStorage.setItem (key, value);
+        else window.localStorage.removeItem (key);
+      } catch (e) {}
+    }
+
+    function fail () {
+      retries++;
+      if (retries > MAX_RETRIES) {
+        show ("Your upload failed.");
+        return;
+      }
+      show ("Connection lost, retrying...");
+      setTimeout (resume, Math.min (30000, 1000 * Math.pow (2, retries)));
+    }
+
+    function create () {
+      var name = window.btoa (unescape (encodeURIComponent (file.name)));
+      request ("POST", "/uploads/",
+               {"Upload-Length": String (file.size),
+                "Upload-Metadata": "filename " + name}, null,
+               function (xhr) {
+        if (!xhr) {
+          fail ();
+        } else if (xhr.status != 201) {
+          // no resumable uploads here: use the plain form
+          form.submit ();
+        } else {
+          url = xhr.getResponseHeader ("Location");
+          remember (url);
+          send (0);
+        }
+      });
+    }
+
+    function resume () {
+      if (!url) {
+        create ();
+        return;
+      }
+      request ("HEAD", url, {}, null, function (xhr) {
+        if (xhr && xhr.status == 404 && !sent_any) {
+          url = null;
+          create ();
+        } else if (!xhr || xhr.status != 200) {
+          fail ();
+        } else {
+          send (parseInt (xhr.getResponseHeader ("Upload-Offset"), 10));
+        }
+      });
+    }
+
+    function send (offset) {
+      if (offset >= file.size) {
+        remember (null);
+        show ("Your file was uploaded succesfully.");
+        return;
+      }
+      var percent = function (sent) {
+        show ("Uploading " + file.name + ": " +
+              Math.floor (100 * (offset + sent) / file.size) + "%");
+      };
+      percent (0);
+      request ("PATCH", url,
+               {"Upload-Offset": String (offset),
+                "Content-Type": "application/offset+octet-stream"},
+               file.slice (offset, offset + CHUNK_SIZE),
+               function (xhr) {
+        if (!xhr || xhr.status != 204) {
+          fail ();
+          return;
+        }
+        retries = 0;
+        sent_any = true;
+        send (parseInt (xhr.getResponseHeader ("Upload-Offset"), 10));
+      }, percent);
+    }
+
+    resume ();
+  }
+
+  form.onsubmit = function () {
+    var files = form.elements["file"].files;
+    if (!files || !files.length)
+      return true;
+    upload (files[0]);
+    return false;
+  };
+}) ();
+</script>"""
 
 class IPState:
     UNKNOWN = 0
@@ -43,6 +198,7 @@ class ArchiveState:
     PREPARING = 1
     READY = 2
     NA = 3
+    STREAMING = 4
 
 # Utility function to guess the IP (as a string) where the server can be
 # reached from the outside. Quite nasty problem actually.
@@ -66,7 +222,8 @@ def find_ip ():
     return candidates[0]
 
 
-def get_form (allow_upload, form_info, archive_state, shared_file, username):
+def get_form (allow_upload, form_info, archive_state, shared_file, username,
+              listing = None, href = "/1"):
     if (username):
         app_name = username + "'s " + FFS_APP_NAME
     else:
@@ -89,6 +246,8 @@ def get_form (allow_upload, form_info, archive_state, shared_file, username):
         download_info_part = "<p>The file you requested does not seem to exist.</p>"
     elif (form_info == FormInfo.DOWNLOAD_FAILURE):
         download_info_part = "<p>The file you requested seems to have disappeared.</p>"
+    elif (form_info == FormInfo.SERVER_BUSY):
+        download_info_part = "<p>Too many downloads are in progress, please try again in a moment.</p>"
 
     prepare_info = ""
     if (archive_state == ArchiveState.PREPARING):
@@ -97,19 +256,296 @@ def get_form (allow_upload, form_info, archive_state, shared_file, username):
     upload_part = ""
     if (allow_upload):
         upload_part = """<h2>You can upload a file</h2>
-<form action="/" enctype="multipart/form-data" method="post"><p>
+<form id="upload-form" action="/" enctype="multipart/form-data" method="post"><p>
 <input type="file" name="file" size="20">
-<input type="submit" value="Upload"></p></form>%s""" % upload_info_part
+<input type="submit" value="Upload"></p></form>
+<div id="upload-status">%s</div>""" % upload_info_part + UPLOAD_SCRIPT
 
     download_part = "<h2>No downloads are available</h2>" + download_info_part
-    if (shared_file and archive_state != ArchiveState.FAILED):
+    if (listing != None):
+        title = "<h2>Files available for download</h2>"
+        items = []
+        for (href, name, size) in listing:
+            item = "<li><a href=\"%s\">%s</a>" % (href, GLib.markup_escape_text (name, -1))
+            if (size != None):
+                item += " (%s)" % get_human_readable_bytes (size)
+            items.append (item + "</li>")
+        if (not items):
+            items.append ("<li>This folder is empty</li>")
+        download_part = title + "<ul>" + "".join (items) + "</ul>" + download_info_part
+    elif (shared_file and archive_state != ArchiveState.FAILED):
         title = "<h2>A file is available for download</h2>"
-        file_line = "<p><a href=\"/1\">%s</a> %s</p>" % (shared_file, prepare_info)
+        file_line = "<p><a href=\"%s\">%s</a> %s</p>" % (href, shared_file, prepare_info)
         download_part = title + file_line + download_info_part
 
     return prefix + upload_part + download_part + postfix
 
 
+def is_process_running (pid):
+    try:
+        os.kill (pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+# Returns the (ETag, Last-Modified) validators for a file with the
+# given os.stat() result
+def get_file_validators (st):
+    etag = "\"%x-%x\"" % (st.st_size, int (st.st_mtime * 1000000))
+    date = Soup.Date.new_from_time_t (int (st.st_mtime))
+    return (etag, date.to_string (Soup.DateFormat.HTTP))
+
+
+# The mtime of an os.stat() result in nanoseconds, so that a change
+# within the same second still gives a different value
+def get_mtime_ns (st):
+    if (hasattr (st, "st_mtime_ns")):
+        return st.st_mtime_ns
+    return int (st.st_mtime * 1000000000)
+
+
+# Converts a hex SHA-256 digest to the base64 form used in the Digest
+# and Repr-Digest headers
+def get_digest_header_value (digest):
+    return base64.b64encode (binascii.unhexlify (digest)).decode ("ascii")
+
+
+# Returns the hex SHA-256 digest from the Repr-Digest (or older Digest)
+# header of an httplib response, None if there is none
+def get_repr_digest (response):
+    for header, prefix, suffix in [("Repr-Digest", "sha-256=:", ":"),
+                                   ("Digest", "sha-256=", "")]:
+        for value in (response.getheader (header) or "").split (","):
+            value = value.strip ()
+            if (value.lower ().startswith (prefix) and value.endswith (suffix)):
+                encoded = value[len (prefix):len (value) - len (suffix)]
+                try:
+                    return binascii.hexlify (base64.b64decode (encoded)).decode ("ascii")
+                except (TypeError, ValueError):
+                    pass
+    return None
+
+
+def get_file_digest (path):
+    digest = hashlib.sha256 ()
+    with open (path, "rb") as f:
+        data = f.read (1024 * 1024)
+        while (data):
+            digest.update (data)
+            data = f.read (1024 * 1024)
+    return digest.hexdigest ()
+
+
+# Parses a Range header value for a representation of 'size' bytes.
+# Returns a sorted list of non-overlapping (start, end) tuples (end is
+# inclusive), an empty list if none of the ranges can be satisfied, or
+# None if the header is not valid and should be ignored.
+def parse_range_header (value, size):
+    unit, sep, specs = value.partition ("=")
+    if (unit.strip ().lower () != "bytes" or not sep):
+        return None
+
+    ranges = []
+    found_spec = False
+    for spec in specs.split (","):
+        spec = spec.strip ()
+        if (not spec):
+            continue
+        found_spec = True
+        first, sep, last = spec.partition ("-")
+        if (not sep):
+            return None
+        try:
+            if (first == ""):
+                # suffix range, e.g. "-500" for the last 500 bytes
+                start = max (0, size - int (last))
+                end = size - 1
+                if (int (last) <= 0):
+                    continue
+            else:
+                start = int (first)
+                end = size - 1
+                if (last != ""):
+                    if (int (last) < start):
+                        return None
+                    end = min (int (last), size - 1)
+        except ValueError:
+            return None
+        if (start < size):
+            ranges.append ((start, end))
+
+    if (not found_spec):
+        return None
+
+    ranges.sort ()
+    merged = []
+    for (start, end) in ranges:
+        if (merged and start <= merged[-1][1] + 1):
+            merged[-1] = (merged[-1][0], max (merged[-1][1], end))
+        else:
+            merged.append ((start, end))
+    return merged
+
+
+# Returns (path, top level name) for every path in the selection. Top
+# level names that are taken already get a "name(N).ext" suffix like
+# uploads do, so they do not collide in archives and listings; a path
+# that is selected twice is only returned once.
+def get_selection_roots (files):
+    roots = []
+    paths = set ()
+    names = set ()
+    for path in files:
+        path = os.path.normpath (path)
+        if (path in paths):
+            continue
+        paths.add (path)
+        top = os.path.basename (path)
+        if (os.path.isdir (path)):
+            fn, ext = top, ""
+        else:
+            fn, ext = os.path.splitext (top)
+        counter = 2
+        while (top in names):
+            top = "%s(%d)%s" % (fn, counter, ext)
+            counter += 1
+        names.add (top)
+        roots.append ((path, top))
+    return roots
+
+
+# Yields (path, archive name, is_dir) for every file and directory in
+# the selection, directory contents in a stable order
+def walk_selection (files):
+    for path, top in get_selection_roots (files):
+        if (not os.path.isdir (path)):
+            yield (path, top, False)
+            continue
+
+        yield (path, top + "/", True)
+        for dirpath, dirnames, filenames in os.walk (path):
+            dirnames.sort ()
+            rel = os.path.relpath (dirpath, path)
+            prefix = top + "/" if rel == "." else top + "/" + rel + "/"
+            for name in dirnames:
+                yield (os.path.join (dirpath, name), prefix + name + "/", True)
+            for name in sorted (filenames):
+                yield (os.path.join (dirpath, name), prefix + name, False)
+
+
+# Splits the contents of f into content-defined chunks, yielding
+# (offset, data) for each. A chunk ends after a newline byte when the
+# DELTA_CHUNK_WINDOW bytes before it hash to a value with the
+# DELTA_CHUNK_MASK bits clear, so the boundaries move along with the
+# content when data is inserted or removed and unchanged data gives the
+# same chunks. Newlines are found with find(): only every 256th byte of
+# binary data (or every line of text) is looked at in Python.
+def split_delta_chunks (f):
+    offset = 0
+    buf = b""
+    eof = False
+    while (True):
+        if (not eof and len (buf) < DELTA_CHUNK_MAX_SIZE):
+            data = f.read (DELTA_CHUNK_MAX_SIZE)
+            eof = not data
+            buf += data
+            continue
+        if (not buf):
+            return
+
+        end = min (len (buf), DELTA_CHUNK_MAX_SIZE)
+        i = buf.find (b"\n", DELTA_CHUNK_MIN_SIZE - 1, end)
+        while (i >= 0):
+            window = buf[i - DELTA_CHUNK_WINDOW:i]
+            if (zlib.crc32 (window) & DELTA_CHUNK_MASK == 0):
+                end = i + 1
+                break
+            i = buf.find (b"\n", i + 1, end)
+
+        yield (offset, buf[:end])
+        offset += end
+        buf = buf[end:]
+
+
+def get_archive_name (files):
+    if (len (files) == 1):
+        return GLib.path_get_basename (os.path.normpath (files[0])) + ".zip"
+    return "archive.zip"
+
+
+def get_dos_datetime (timestamp):
+    t = time.localtime (timestamp)
+    if (t.tm_year < 1980):
+        return (0, (1 << 5) | 1)
+    if (t.tm_year > 2107):
+        return ((23 << 11) | (59 << 5) | 29, (127 << 9) | (12 << 5) | 31)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+# Weak comparison of an If-None-Match header value with an ETag
+def etag_matches (if_none_match, etag):
+    for candidate in (if_none_match or "").split (","):
+        candidate = candidate.strip ()
+        if (candidate.startswith ("W/")):
+            candidate = candidate[2:]
+        if (candidate == "*" or candidate == etag):
+            return True
+    return False
+
+
+# Parses an Accept-Encoding header into a dict of encoding: qvalue
+def parse_accept_encoding (value):
+    encodings = {}
+    for item in (value or "").split (","):
+        params = item.split (";")
+        encoding = params[0].strip ().lower ()
+        if (not encoding):
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, sep, qvalue = param.strip ().partition ("=")
+            if (name.strip () == "q"):
+                try:
+                    q = float (qvalue)
+                except ValueError:
+                    q = 0.0
+        encodings[encoding] = q
+    return encodings
+
+
+# True for addresses in the local network (or this machine)
+def is_local_address (address):
+    if (address.startswith ("::ffff:")):
+        address = address[7:]
+    inet_address = Gio.InetAddress.new_from_string (address)
+    if (not inet_address):
+        return False
+    return (inet_address.get_is_loopback () or
+            inet_address.get_is_site_local () or
+            inet_address.get_is_link_local ())
+
+
+def is_loopback_address (address):
+    if (address.startswith ("::ffff:")):
+        address = address[7:]
+    inet_address = Gio.InetAddress.new_from_string (address)
+    return (inet_address != None and inet_address.get_is_loopback ())
+
+
+# True if a Host header names this machine by a loopback name. Web pages
+# can only reach a local server by such a name unless DNS rebinding is
+# used, which gives a Host of the attacker's domain.
+def is_loopback_host (host):
+    host = (host or "").strip ().lower ()
+    if (host.startswith ("[")):
+        host = host[:host.find ("]") + 1]
+    else:
+        host = host.partition (":")[0]
+    return host in ("localhost", "127.0.0.1", "[::1]")
+
+
 def get_human_readable_bytes (size):
     suffixes = ['B','KB','MB','GB','TB']
     i = 0
@@ -119,86 +555,2710 @@ def get_human_readable_bytes (size):
     return "%d %s" % (size, suffixes[i])
 
 
-class FriendlyZipper ():
+class FriendlyCompressionPolicy:
+
+    # Decides whether an archive entry is worth deflating. Media files
+    # and archives are recognized by their extension, anything else by
+    # the entropy of a sample from the start of the file: data that is
+    # already compressed looks random and is stored as is.
+
+    INCOMPRESSIBLE_EXTENSIONS = set ([
+        "7z", "aac", "apk", "avi", "bz2", "cab", "deb", "docx", "epub",
+        "flac", "flv", "gif", "gz", "heic", "jar", "jpeg", "jpg", "lz",
+        "lz4", "lzma", "m4a", "m4v", "mkv", "mov", "mp3", "mp4", "mpeg",
+        "mpg", "odp", "ods", "odt", "ogg", "opus", "png", "pptx", "rar",
+        "rpm", "tbz2", "tgz", "txz", "webm", "webp", "whl", "wma", "wmv",
+        "xlsx", "xz", "zip", "zst"])
+
+    SAMPLE_SIZE = 16 * 1024
+    # bits per byte: well compressed data is very close to 8
+    MAX_ENTROPY = 7.5
+
+    def __init__ (self, compress_level = 6):
+        self.compress_level = compress_level
+
+
+    def is_compressible (self, path):
+        ext = os.path.splitext (path)[1][1:].lower ()
+        if (ext in FriendlyCompressionPolicy.INCOMPRESSIBLE_EXTENSIONS):
+            return False
+
+        try:
+            with open (path, "rb") as f:
+                sample = bytearray (f.read (FriendlyCompressionPolicy.SAMPLE_SIZE))
+        except IOError:
+            return True
+        if (len (sample) < 512):
+            # small enough that it does not matter
+            return True
+
+        entropy = 0.0
+        for count in collections.Counter (sample).values ():
+            p = float (count) / len (sample)
+            entropy -= p * math.log (p, 2)
+        return entropy < FriendlyCompressionPolicy.MAX_ENTROPY
+
+
+# Compresses one block of a raw deflate stream. Blocks end with a sync
+# flush so that independently compressed blocks can be concatenated; the
+# previous block is used as the dictionary where zlib supports that.
+def deflate_block (data, dictionary, level):
+    if (dictionary and sys.version_info >= (3, 3)):
+        compressor = zlib.compressobj (level, zlib.DEFLATED, -15,
+                                       zlib.DEF_MEM_LEVEL,
+                                       zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj (level, zlib.DEFLATED, -15)
+    return compressor.compress (data) + compressor.flush (zlib.Z_SYNC_FLUSH)
+
+
+class FriendlyDeflateBlock:
+
+    # A block that is being deflated in the pool. The pool thread hands
+    # the compressed data (or the exception) over to the main loop, where
+    # it is stored here; 'done' is set only after that, so a stream that
+    # is woken up always finds the block finished.
 
     def __init__ (self):
-        if (not GLib.find_program_in_path ("7z")):
-            raise Exception
-
-    def on_child_process_exit (self, pid, status, callback):
-        print_func = None
-        wexitstatus = os.WEXITSTATUS (status)
-        if (wexitstatus == 0):
-            state = ArchiveState.READY
-        elif (wexitstatus == 1):
-            state = ArchiveState.READY
-            print_func = logging.warning
-        else:
+        self.done = threading.Event ()
+        self.data = None
+        self.error = None
+
+
+    def get (self):
+        if (self.error):
+            raise self.error
+        return self.data
+
+
+class FriendlyZipper ():
+
+    # Creates zip archives with FriendlyZipStream: entries that are
+    # compressible according to the policy are split into blocks that
+    # are deflated in parallel in a pool of worker threads (zlib does
+    # not hold the GIL while compressing). Archives are either streamed
+    # directly to clients or prepared into a file in a background thread.
+
+    def __init__ (self, policy = None, workers = None, member_cache = None):
+        self.policy = policy or FriendlyCompressionPolicy ()
+        self.workers = workers or multiprocessing.cpu_count ()
+        self.member_cache = member_cache
+        self.pool = None
+
+
+    def get_pool (self):
+        if (not self.pool):
+            self.pool = ThreadPool (self.workers)
+        return self.pool
+
+
+    def create_stream (self, files):
+        return FriendlyZipStream (files, self.policy, self.get_pool (),
+                                  2 * self.workers, self.member_cache)
+
+
+    def write_archive (self, files, archive_name, callback):
+        state = ArchiveState.READY
+        try:
+            stream = self.create_stream (files)
+            with open (archive_name, "wb") as f:
+                while (True):
+                    piece = stream.read ()
+                    if (piece == None):
+                        stream.wait ()
+                        continue
+                    if (not piece):
+                        break
+                    f.write (piece)
+        except:
+            logging.error ("Failed to create archive %s" % archive_name)
+            traceback.print_exc ()
             state = ArchiveState.FAILED
-            print_func = logging.error
 
-        if (print_func):
-            print_func ("7z returned %s, printing full output:"
-                        % wexitstatus)
-            line = self.out_7z.readline ()
-            while (line):
-                sys.stdout.write(" | " + line)
-                line = self.out_7z.readline ()
+        GLib.idle_add (callback, state)
+
+
+    def create_archive (self, files, target_dir, callback):
+        archive_name = os.path.join (target_dir, get_archive_name (files))
 
-        GLib.spawn_close_pid (pid)
-        self.out_7z = None
+        thread = threading.Thread (target = self.write_archive,
+                                   args = (files, archive_name, callback))
+        thread.daemon = True
+        thread.start ()
+
+        return archive_name
 
-        callback (state)
 
+class FriendlyArchiveCache:
+
+    # Keeps prepared archives around after sharing stops, so sharing the
+    # same files again does not mean compressing them again. Archives
+    # are keyed by the paths, sizes and mtimes of everything in the
+    # selection. The least recently used archives are removed when the
+    # cache grows over 'max_size' bytes.
+    #
+    # Several processes can use the cache at the same time: archives
+    # are written in a "<pid>-<key>" directory and moved to "<key>"
+    # when they are ready, and the index on disk is merged with the one
+    # in memory before it is saved.
+
+    def __init__ (self, max_size, cache_dir = None):
+        if (not cache_dir):
+            cache_dir = os.path.join (GLib.get_user_cache_dir (), "ffs", "archives")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join (cache_dir, "index.json")
+        self.in_use = set ()
+        self.entries = {}
+        # keys removed since the last save
+        self.removed = set ()
+
+        if (not os.path.isdir (cache_dir)):
+            os.makedirs (cache_dir)
+        self.merge ()
+
+        # remove archives that are not in the index and unfinished
+        # archives of processes that are gone
+        for name in os.listdir (cache_dir):
+            path = os.path.join (cache_dir, name)
+            if (not os.path.isdir (path)):
+                continue
+            pid, sep, key = name.partition ("-")
+            if (sep):
+                if (not pid.isdigit () or not is_process_running (int (pid))):
+                    shutil.rmtree (path, True)
+            elif (name not in self.entries):
+                shutil.rmtree (path, True)
+        self.save ()
+
+
+    def merge (self):
+        # adds the entries that other processes have saved
+        try:
+            with open (self.index_file) as f:
+                saved = json.load (f)
+        except (IOError, ValueError):
+            return
+        for key, entry in saved.items ():
+            if (key in self.removed):
+                continue
+            current = self.entries.get (key)
+            if (current):
+                current["used"] = max (current["used"], entry["used"])
+            elif (os.path.isfile (entry["file"])):
+                self.entries[key] = entry
+
+
+    def get_key (self, files):
+        # entries that cannot be stat()ed (e.g. dangling symlinks) are
+        # skipped by the zipper; they are only part of the key by name
+        digest = hashlib.sha1 ()
+        for path in sorted (os.path.abspath (f) for f in files):
+            for entry_path, arcname, is_dir in walk_selection ([path]):
+                try:
+                    st = os.stat (entry_path)
+                    line = "%s\0%d\0%d\0%d\n" % (entry_path, is_dir,
+                                                  st.st_size, get_mtime_ns (st))
+                except OSError:
+                    line = "%s\0%d\0-\n" % (entry_path, is_dir)
+                digest.update (line.encode ("utf-8", "surrogateescape")
+                               if sys.version_info[0] > 2 else line)
+        return digest.hexdigest ()
+
+
+    def lookup (self, key):
+        # returns the archive path for key, None if there is no archive yet
+        if (key not in self.entries):
+            self.merge ()
+        entry = self.entries.get (key)
+        if (not entry or not os.path.isfile (entry["file"])):
+            return None
+        entry["used"] = time.time ()
+        self.in_use.add (key)
+        self.save ()
+        return entry["file"]
+
+
+    def get_work_directory (self, key):
+        return os.path.join (self.cache_dir, "%d-%s" % (os.getpid (), key))
+
+
+    def get_directory (self, key):
+        # directory that a new archive for key should be created in
+        directory = self.get_work_directory (key)
+        shutil.rmtree (directory, True)
+        os.makedirs (directory)
+        self.in_use.add (key)
+        return directory
+
+
+    def add (self, key, archive):
+        # moves a new archive into the cache, returns its new path or
+        # None if that failed
+        directory = os.path.join (self.cache_dir, key)
+        try:
+            # another process may have created the same archive
+            shutil.rmtree (directory, True)
+            os.rename (os.path.dirname (archive), directory)
+            archive = os.path.join (directory, os.path.basename (archive))
+            size = os.path.getsize (archive)
+        except OSError as e:
+            logging.warning ("Failed to add archive to the cache: %s" % e)
+            self.discard (key)
+            return None
+        self.removed.discard (key)
+        self.entries[key] = {"file": archive, "size": size,
+                             "used": time.time ()}
+        self.evict ()
+        return archive
+
+
+    def discard (self, key):
+        # removes an archive that could not be prepared
+        self.in_use.discard (key)
+        shutil.rmtree (self.get_work_directory (key), True)
+
+
+    def release (self, key):
+        self.in_use.discard (key)
+        self.evict ()
+
+
+    def evict (self):
+        total = sum (entry["size"] for entry in self.entries.values ())
+        by_age = sorted (self.entries, key = lambda k: self.entries[k]["used"])
+        for key in by_age:
+            if (total <= self.max_size):
+                break
+            if (key in self.in_use):
+                continue
+            total -= self.entries[key]["size"]
+            del self.entries[key]
+            self.removed.add (key)
+            shutil.rmtree (os.path.join (self.cache_dir, key), True)
+        self.save ()
+
+
+    def save (self):
+        self.merge ()
+        self.removed = set ()
+        temp_name = "%s.%d.tmp" % (self.index_file, os.getpid ())
+        try:
+            with open (temp_name, "w") as f:
+                json.dump (self.entries, f)
+            os.rename (temp_name, self.index_file)
+        except (IOError, OSError):
+            logging.warning ("Failed to save the archive cache index")
+
+
+class FriendlyMemberCache:
+
+    # Deflated ZIP members of files that have been archived before,
+    # keyed by path, size and mtime. When an archive of a live share is
+    # created again, the members of files that did not change are
+    # copied from here and only the changed files are compressed. Files
+    # smaller than MIN_SIZE are cheaper to compress again than to cache.
+    # Only the newest member of each path is kept, and the least
+    # recently used members are removed when the cache grows over
+    # 'max_size' bytes. Archives are also written in background threads,
+    # so the index is protected by a lock. Every process has its own
+    # directory, removed by close (); directories of processes that are
+    # gone are removed at startup.
+
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 1024 * 1024 * 1024
+
+    Member = collections.namedtuple ("Member", "file crc size compressed_size")
+
+    def __init__ (self, cache_dir = None, max_size = MAX_SIZE):
+        if (not cache_dir):
+            cache_dir = os.path.join (GLib.get_user_cache_dir (), "ffs", "members")
+        self.max_size = max_size
+        self.members = collections.OrderedDict ()
+        self.keys = {}
+        self.total_size = 0
+        self.lock = threading.Lock ()
+
+        if (not os.path.isdir (cache_dir)):
+            os.makedirs (cache_dir)
+        for name in os.listdir (cache_dir):
+            pid = name.partition ("-")[0]
+            if (pid.isdigit () and not is_process_running (int (pid))):
+                shutil.rmtree (os.path.join (cache_dir, name), True)
+        # the index is not saved: start with an empty directory
+        self.cache_dir = tempfile.mkdtemp (prefix = "%d-" % os.getpid (),
+                                           dir = cache_dir)
+
+
+    def close (self):
+        with self.lock:
+            self.members.clear ()
+            self.keys = {}
+            self.total_size = 0
+        shutil.rmtree (self.cache_dir, True)
+
+
+    def open (self, path, st):
+        # returns (member, file) for this version of path or None
+        key = (path, st.st_size, st.st_mtime)
+        with self.lock:
+            member = self.members.pop (key, None)
+            if (not member):
+                return None
+            self.members[key] = member
+        try:
+            return (member, open (member.file, "rb"))
+        except IOError:
+            return None
+
+
+    def create (self):
+        # returns (name, file) for writing a new member, see add()
+        name = os.path.join (self.cache_dir,
+                             binascii.hexlify (os.urandom (8)).decode ("ascii"))
+        return (name, open (name, "wb"))
+
+
+    def add (self, path, st, name, crc, size, compressed_size):
+        key = (path, st.st_size, st.st_mtime)
+        with self.lock:
+            old_key = self.keys.pop (path, None)
+            if (old_key in self.members):
+                self.remove (self.members.pop (old_key))
+            self.keys[path] = key
+            self.members[key] = FriendlyMemberCache.Member (name, crc, size,
+                                                            compressed_size)
+            self.total_size += compressed_size
+
+            while (self.total_size > self.max_size):
+                key, member = self.members.popitem (last = False)
+                del self.keys[key[0]]
+                self.remove (member)
+
+
+    def remove (self, member):
+        self.total_size -= member.compressed_size
+        self.discard (member.file)
+
+
+    def discard (self, name):
+        try:
+            os.remove (name)
+        except OSError:
+            pass
+
+
+class FriendlyShareIndex:
+
+    # Maps the URL paths of every file and directory in a selection to
+    # their metadata, so that the files can be listed and served one by
+    # one without archiving anything. The selection is walked once when
+    # sharing starts; after that update() can be used to bring single
+    # paths up to date. Directory paths end in a slash; the top level
+    # directory is 'prefix'.
+
+    Entry = collections.namedtuple ("Entry", "path name size mtime content_type")
+
+    def __init__ (self, files, prefix = "/1/"):
+        self.prefix = prefix
+        self.entries = {}
+        self.children = {prefix: []}
+        self.urls = {}
+        # selected path -> top level name
+        self.roots = dict (get_selection_roots (files))
+        self.file_count = 0
+
+        for path, arcname, is_dir in walk_selection (files):
+            self.add (path, arcname, is_dir)
 
-    def create_archive (self, files, callback):
-        temp_dir = tempfile.mkdtemp ("", "ffs-")
         if (len (files) == 1):
-            archive_name = os.path.join (temp_dir, GLib.path_get_basename (files[0]))
+            self.name = GLib.path_get_basename (os.path.normpath (files[0]))
+        else:
+            self.name = "%d files" % self.file_count
+
+
+    def add (self, path, arcname, is_dir):
+        # adds or refreshes the entry for path, returns False if the
+        # parent directory is not in the index
+        try:
+            st = os.stat (path)
+        except OSError:
+            return False
+        url = self.prefix + arcname
+        name = arcname.rstrip ("/").rpartition ("/")[2]
+        parent = self.get_parent (url, name, is_dir)
+        if (parent not in self.children):
+            return False
+        if (is_dir):
+            entry = FriendlyShareIndex.Entry (path, name, None, st.st_mtime, None)
+            self.children.setdefault (url, [])
+        else:
+            content_type = Gio.content_type_get_mime_type (
+                Gio.content_type_guess (path, None)[0])
+            entry = FriendlyShareIndex.Entry (path, name, st.st_size,
+                                              st.st_mtime, content_type)
+
+        is_new = url not in self.entries
+        self.entries[url] = entry
+        self.urls[path] = url
+        if (is_new):
+            if (not is_dir):
+                self.file_count += 1
+            self.children[parent].append (url)
+        return is_new
+
+
+    def remove (self, url):
+        # removes url and, for a directory, everything under it
+        entry = self.entries.pop (url, None)
+        if (not entry):
+            return
+        if (self.urls.get (entry.path) == url):
+            del self.urls[entry.path]
+        is_dir = url in self.children
+        if (is_dir):
+            for child in self.children.pop (url):
+                self.remove (child)
+        else:
+            self.file_count -= 1
+        parent = self.get_parent (url, entry.name, is_dir)
+        if (parent in self.children):
+            self.children[parent].remove (url)
+
+
+    def update (self, path):
+        # Brings the entries for path up to date after it was created,
+        # changed or deleted on disk. A directory that is new to the
+        # index is walked so that its contents are added too.
+        path = os.path.normpath (path)
+        arcname = self.get_arcname (path)
+        if (arcname == None):
+            return
+        url = self.urls.get (path)
+        exists = os.path.exists (path)
+        is_dir = exists and os.path.isdir (path)
+        if (url and (not exists or (url in self.children) != is_dir)):
+            self.remove (url)
+            url = None
+
+        if (exists):
+            if (is_dir):
+                arcname += "/"
+            added = self.add (path, arcname, is_dir)
+            name = arcname.rstrip ("/").rpartition ("/")[2]
+            if (added and is_dir):
+                # child archive names start with the basename of path,
+                # which is not the name of a renamed top level directory
+                skip = len (os.path.basename (path))
+                for child, child_arcname, child_is_dir in walk_selection ([path]):
+                    if (child != path):
+                        self.add (child, arcname[:-1] + child_arcname[skip:],
+                                  child_is_dir)
+            if (added):
+                parent = self.get_parent (self.prefix + arcname, name, is_dir)
+                self.sort (parent)
+
+        if (len (self.roots) > 1):
+            self.name = "%d files" % self.file_count
+
+
+    def get_arcname (self, path):
+        for root, top in self.roots.items ():
+            if (path == root):
+                return top
+            if (path.startswith (root + os.sep)):
+                return top + "/" + os.path.relpath (path, root).replace (os.sep, "/")
+        return None
+
+
+    def get_parent (self, url, name, is_dir):
+        return url[:len (url) - len (name) - (2 if is_dir else 1)] + "/"
+
+
+    def sort (self, directory):
+        # same order as walk_selection(): directories first, then files
+        if (directory != self.prefix and directory in self.children):
+            self.children[directory].sort (key = lambda url: (url not in self.children, url))
+
+
+    def lookup (self, path):
+        return self.entries.get (path)
+
+
+    def is_directory (self, path):
+        return path in self.children
+
+
+    def get_listing (self, directory):
+        # (href, name, size) for each item in directory, size is None
+        # for directories
+        listing = []
+        for url in self.children.get (directory, []):
+            entry = self.entries[url]
+            name = entry.name + "/" if entry.size == None else entry.name
+            listing.append ((GLib.uri_escape_string (url, "/", False),
+                             name, entry.size))
+        return listing
+
+
+class FriendlyTreeMonitor:
+
+    # Watches the files and directory trees of a live share. Directory
+    # monitors are not recursive, so every directory in the tree gets
+    # its own Gio.FileMonitor; monitors are added and cancelled as
+    # directories come and go. Changed paths are collected and passed to
+    # callback (paths) once nothing has changed for QUIET_DELAY ms, so a
+    # file that is being written is handled once and not for every
+    # write. Changes that keep coming are still reported every MAX_DELAY
+    # ms.
+
+    QUIET_DELAY = 1000
+    MAX_DELAY = 10000
+
+    IGNORED_EVENTS = (Gio.FileMonitorEvent.PRE_UNMOUNT,
+                      Gio.FileMonitorEvent.UNMOUNTED)
+
+    def __init__ (self, files, callback):
+        self.callback = callback
+        self.monitors = {}
+        self.changed = set ()
+        self.first_change = None
+        self.timeout_id = None
+
+        for path, arcname, is_dir in walk_selection (files):
+            if (is_dir):
+                self.watch (path, True)
+        for path in files:
+            if (not os.path.isdir (path)):
+                self.watch (os.path.normpath (path), False)
+
+
+    def watch (self, path, is_dir):
+        if (path in self.monitors):
+            return
+        try:
+            f = Gio.File.new_for_path (path)
+            if (is_dir):
+                monitor = f.monitor_directory (Gio.FileMonitorFlags.NONE, None)
+            else:
+                monitor = f.monitor_file (Gio.FileMonitorFlags.NONE, None)
+        except GLib.Error as e:
+            logging.warning ("Cannot watch %s for changes: %s" % (path, e.message))
+            return
+        monitor.connect ("changed", self.on_changed)
+        self.monitors[path] = monitor
+
+
+    def unwatch (self, path):
+        for watched in list (self.monitors):
+            if (watched == path or watched.startswith (path + os.sep)):
+                self.monitors.pop (watched).cancel ()
+
+
+    def on_changed (self, monitor, f, other_file, event_type):
+        if (event_type in FriendlyTreeMonitor.IGNORED_EVENTS):
+            return
+        path = f.get_path ()
+        if (event_type == Gio.FileMonitorEvent.CREATED and os.path.isdir (path)):
+            # whatever was moved in with the directory is not reported
+            for child, arcname, is_dir in walk_selection ([path]):
+                if (is_dir):
+                    self.watch (child, True)
+        elif (event_type == Gio.FileMonitorEvent.DELETED):
+            self.unwatch (path)
+
+        self.changed.add (path)
+        now = GLib.get_monotonic_time ()
+        if (self.first_change == None):
+            self.first_change = now
+        elif ((now - self.first_change) // 1000 >= FriendlyTreeMonitor.MAX_DELAY):
+            return
+        if (self.timeout_id):
+            GLib.source_remove (self.timeout_id)
+        self.timeout_id = GLib.timeout_add (FriendlyTreeMonitor.QUIET_DELAY,
+                                            self.on_quiet)
+
+
+    def on_quiet (self):
+        self.timeout_id = None
+        self.first_change = None
+        changed, self.changed = self.changed, set ()
+        # parents before their contents
+        self.callback (sorted (changed))
+        return False
+
+
+    def stop (self):
+        for monitor in self.monitors.values ():
+            monitor.cancel ()
+        self.monitors = {}
+        if (self.timeout_id):
+            GLib.source_remove (self.timeout_id)
+            self.timeout_id = None
+
+
+class FriendlyShare:
+
+    # One set of shared files. Every share has its own unguessable URL
+    # "/<token>", archive state, download counters and an optional
+    # lifetime in seconds. The share started from the user interface is
+    # the primary share of the server and can also be found at "/1".
+    # Live shares have a monitor that keeps them up to date with the
+    # files on disk.
+
+    def __init__ (self, files, lifetime = None):
+        self.token = base64.urlsafe_b64encode (os.urandom (12)).decode ("ascii")
+        self.prefix = "/" + self.token
+        self.files = files
+        self.shared_file = None
+        self.shared_selection = None
+        self.share_index = None
+        self.archive_state = ArchiveState.NA
+        self.archive_key = None
+        self.next_archive_key = None
+        self.archive_update = 0
+        self.download_count = 0
+        self.download_finished_count = 0
+        self.expires = time.time () + lifetime if lifetime else None
+        self.timeout_id = None
+        self.monitor = None
+
+
+    def get_status (self):
+        return {"token": self.token,
+                "path": self.prefix,
+                "shared_file": self.shared_file,
+                "archive_state": self.archive_state,
+                "downloads_in_progress": self.download_count,
+                "downloads_finished": self.download_finished_count,
+                "expires": self.expires,
+                "live": self.monitor != None}
+
+
+class FriendlyVariantCache:
+
+    # Precompressed copies ("variants") of shared files for clients
+    # that send Accept-Encoding. Variants are built one at a time in a
+    # worker thread and named after the path, size and mtime of the
+    # original file, so a variant of an older version is never served.
+    # The least recently used variants are removed when the cache grows
+    # over 'max_size' bytes. zstd variants are only built if the
+    # zstandard module is available.
+
+    EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+    MAX_SIZE = 1024 * 1024 * 1024
+    ZSTD_LEVEL = 10
+    TOUCH_INTERVAL = 60
+
+    def __init__ (self, policy, cache_dir = None, max_size = MAX_SIZE):
+        if (not cache_dir):
+            cache_dir = os.path.join (GLib.get_user_cache_dir (), "ffs", "variants")
+        self.cache_dir = cache_dir
+        self.policy = policy
+        self.max_size = max_size
+        self.compressible = {}
+        self.attempted = set ()
+        self.queue = collections.deque ()
+        self.condition = threading.Condition ()
+        self.thread = None
+        self.encodings = ["gzip"]
+        try:
+            import zstandard
+            self.zstandard = zstandard
+            self.encodings.append ("zstd")
+        except ImportError:
+            self.zstandard = None
+
+
+    def is_compressible (self, path, validators):
+        cached = self.compressible.get (path)
+        if (cached and cached[0] == validators.etag):
+            return cached[1]
+        compressible = self.policy.is_compressible (path)
+        self.compressible[path] = (validators.etag, compressible)
+        return compressible
+
+
+    def get_name (self, path, size, mtime):
+        # the first part of the name is the same for all versions of a file
+        if (sys.version_info[0] > 2):
+            path = path.encode ("utf-8", "surrogateescape")
+        return "%s-%x-%x" % (hashlib.sha1 (path).hexdigest ()[:20], size, mtime)
+
+
+    def get_compressor (self, encoding):
+        if (encoding == "zstd"):
+            cctx = self.zstandard.ZstdCompressor (level = FriendlyVariantCache.ZSTD_LEVEL)
+            return cctx.compressobj ()
+        return zlib.compressobj (self.policy.compress_level,
+                                 zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+    def lookup (self, path, validators, encoding):
+        # returns the variant file, None if it is not ready (yet). The
+        # mtime of a variant is its last use, see evict()
+        name = self.get_name (path, validators.size, validators.mtime_ns)
+        variant = os.path.join (self.cache_dir,
+                                name + FriendlyVariantCache.EXTENSIONS[encoding])
+        try:
+            st = os.stat (variant)
+            now = time.time ()
+            if (now - st.st_mtime > FriendlyVariantCache.TOUCH_INTERVAL):
+                os.utime (variant, (now, now))
+        except OSError:
+            return None
+        return variant
+
+
+    def prepare (self, path, validators):
+        # a variant of a file larger than the cache would be evicted
+        # right after it was built
+        name = self.get_name (path, validators.size, validators.mtime_ns)
+        if (name in self.attempted or validators.size > self.max_size or
+            not self.is_compressible (path, validators)):
+            return
+        self.attempted.add (name)
+
+        with self.condition:
+            self.queue.append (path)
+            if (not self.thread):
+                self.thread = threading.Thread (target = self.run)
+                self.thread.daemon = True
+                self.thread.start ()
+            self.condition.notify ()
+
+
+    def run (self):
+        while (True):
+            with self.condition:
+                while (not self.queue):
+                    self.condition.wait ()
+                path = self.queue.popleft ()
+            self.build (path)
+
+
+    def remove (self, name):
+        try:
+            os.remove (os.path.join (self.cache_dir, name))
+        except OSError as e:
+            if (e.errno != errno.ENOENT):
+                raise
+
+
+    def build (self, path):
+        try:
+            st = os.stat (path)
+            name = self.get_name (path, st.st_size, get_mtime_ns (st))
+            if (not os.path.isdir (self.cache_dir)):
+                os.makedirs (self.cache_dir)
+
+            # variants of older versions of the file are useless now
+            prefix = name.split ("-")[0] + "-"
+            for old_name in os.listdir (self.cache_dir):
+                if (old_name.startswith (prefix) and
+                    not old_name.startswith (name + ".")):
+                    self.remove (old_name)
+
+            for encoding in self.encodings:
+                variant = os.path.join (self.cache_dir,
+                                        name + FriendlyVariantCache.EXTENSIONS[encoding])
+                if (os.path.isfile (variant)):
+                    continue
+                compressor = self.get_compressor (encoding)
+                with open (path, "rb") as src, open (variant + ".tmp", "wb") as dst:
+                    while (True):
+                        data = src.read (CHUNK_SIZE)
+                        if (not data):
+                            break
+                        dst.write (compressor.compress (data))
+                    dst.write (compressor.flush ())
+
+                new_st = os.stat (path)
+                if (new_st.st_size != st.st_size or
+                    get_mtime_ns (new_st) != get_mtime_ns (st)):
+                    # modified while compressing
+                    os.remove (variant + ".tmp")
+                    break
+                os.rename (variant + ".tmp", variant)
+            self.evict ()
+        except:
+            logging.error ("Failed to create a compressed copy of %s" % path)
+            traceback.print_exc ()
+
+
+    def evict (self):
+        # least recently used first
+        variants = []
+        for name in os.listdir (self.cache_dir):
+            if (name.endswith (".tmp")):
+                # still being written
+                continue
+            try:
+                st = os.stat (os.path.join (self.cache_dir, name))
+            except OSError as e:
+                if (e.errno != errno.ENOENT):
+                    raise
+                continue
+            variants.append ((st.st_mtime, st.st_size, name))
+        total = sum (size for mtime, size, name in variants)
+        for mtime, size, name in sorted (variants):
+            if (total <= self.max_size):
+                break
+            self.remove (name)
+            total -= size
+
+
+class FriendlyValidatorCache:
+
+    # Remembers the HTTP validators of served files. A lookup only
+    # needs a stat() of the file: the validators are recomputed only
+    # when its size, mtime or inode change.
+
+    Validators = collections.namedtuple ("Validators",
+                                         "size etag last_modified mtime mtime_ns")
+
+    def __init__ (self):
+        self.validators = {}
+
+
+    def get (self, path):
+        st = os.stat (path)
+        key = (st.st_size, get_mtime_ns (st), st.st_ino, st.st_dev)
+        cached = self.validators.get (path)
+        if (cached and cached[0] == key):
+            return cached[1]
+
+        etag, last_modified = get_file_validators (st)
+        validators = FriendlyValidatorCache.Validators (st.st_size, etag,
+                                                        last_modified,
+                                                        int (st.st_mtime),
+                                                        get_mtime_ns (st))
+        self.validators[path] = (key, validators)
+        return validators
+
+
+    def forget (self, path):
+        self.validators.pop (path, None)
+
+
+class FriendlyDigestCache:
+
+    # SHA-256 digests of shared files. Digests are computed one file at a
+    # time in a worker thread and are keyed by path, size and mtime, so
+    # the digest of an older version of a file is never used. The
+    # digests are saved in the cache directory by the worker and survive
+    # restarts; entries of files that no longer exist are dropped when
+    # the worker starts. Digests of uploads are added as they are
+    # computed while the upload is received.
+    #
+    # Files of at least DELTA_MIN_FILE_SIZE bytes also get a list of
+    # content-defined chunks and their digests for delta downloads; it
+    # is computed in the same pass and saved in its own file.
+
+    READ_SIZE = 1024 * 1024
+
+    def __init__ (self, cache_dir = None):
+        if (not cache_dir):
+            cache_dir = os.path.join (GLib.get_user_cache_dir (), "ffs")
+        self.index_file = os.path.join (cache_dir, "digests.json")
+        self.chunks_dir = os.path.join (cache_dir, "chunks")
+        # path -> [size, mtime, hex digest, has chunk list]
+        self.digests = {}
+        # hex digest -> set of paths
+        self.paths = {}
+        self.queue = collections.deque ()
+        self.queued = set ()
+        self.condition = threading.Condition ()
+        self.thread = None
+        self.dirty = False
+
+        if (not os.path.isdir (self.chunks_dir)):
+            os.makedirs (self.chunks_dir)
+        try:
+            with open (self.index_file) as f:
+                self.digests = json.load (f)
+        except (IOError, ValueError):
+            pass
+        for path, entry in self.digests.items ():
+            if (len (entry) == 3):
+                # saved without the chunk list flag
+                entry.append (False)
+            self.paths.setdefault (entry[2], set ()).add (path)
+
+
+    def lookup (self, path):
+        # the hex digest of the current version of path, None if it is
+        # not known (yet)
+        entry = self.digests.get (path)
+        if (not entry):
+            return None
+        try:
+            st = os.stat (path)
+        except OSError as e:
+            if (e.errno == errno.ENOENT):
+                with self.condition:
+                    self.forget (path)
+                    self.condition.notify ()
+            return None
+        if (entry[0] != st.st_size or entry[1] != st.st_mtime):
+            return None
+        return entry[2]
+
+
+    def lookup_chunks (self, path):
+        # [[offset, length, hex digest], ...] for the current version of
+        # path, None if it is not known (yet)
+        digest = self.lookup (path)
+        if (not digest):
+            return None
+        entry = self.digests[path]
+        if (entry[0] < DELTA_MIN_FILE_SIZE):
+            return [[0, entry[0], digest]]
+        if (not entry[3]):
+            return None
+        try:
+            with open (self.get_chunks_file (path)) as f:
+                chunks = json.load (f)
+        except (IOError, ValueError):
+            return None
+        if (chunks["size"] != entry[0] or chunks["mtime"] != entry[1]):
+            return None
+        return chunks["chunks"]
+
+
+    def is_current (self, path):
+        return (self.lookup (path) != None and
+                (self.digests[path][0] < DELTA_MIN_FILE_SIZE or
+                 self.digests[path][3]))
+
+
+    def get_chunks_file (self, path):
+        name = path.encode ("utf-8", "surrogateescape") if sys.version_info[0] > 2 else path
+        return os.path.join (self.chunks_dir, hashlib.sha1 (name).hexdigest () + ".json")
+
+
+    def store (self, path, entry):
+        # called with the lock held; a new chunk list has already been
+        # written over the old one
+        old = self.unindex (path)
+        if (old and old[3] and not entry[3]):
+            self.remove_chunks (path)
+        self.digests[path] = entry
+        self.paths.setdefault (entry[2], set ()).add (path)
+        self.dirty = True
+
+
+    def forget (self, path):
+        # called with the lock held
+        entry = self.unindex (path)
+        if (entry and entry[3]):
+            self.remove_chunks (path)
+
+
+    def unindex (self, path):
+        # called with the lock held
+        entry = self.digests.pop (path, None)
+        if (not entry):
+            return None
+        paths = self.paths.get (entry[2])
+        if (paths):
+            paths.discard (path)
+            if (not paths):
+                del self.paths[entry[2]]
+        self.dirty = True
+        return entry
+
+
+    def remove_chunks (self, path):
+        try:
+            os.remove (self.get_chunks_file (path))
+        except OSError:
+            pass
+
+
+    def add (self, path, digest):
+        # the worker saves the index
+        st = os.stat (path)
+        with self.condition:
+            self.store (path, [st.st_size, st.st_mtime, digest, False])
+            self.start ()
+            self.condition.notify ()
+
+
+    def find (self, digest, size, directory):
+        # a file in directory (or below it) with this digest and size
+        prefix = os.path.join (directory, "")
+        with self.condition:
+            candidates = [path for path in self.paths.get (digest, ())
+                          if self.digests[path][0] == size and
+                             path.startswith (prefix)]
+        for path in candidates:
+            if (self.lookup (path) == digest):
+                return path
+        return None
+
+
+    def prepare (self, paths):
+        # queues paths for the worker, which skips the ones that
+        # already have a current digest (and chunk list)
+        with self.condition:
+            for path in paths:
+                if (path not in self.queued):
+                    self.queued.add (path)
+                    self.queue.append (path)
+            self.start ()
+            self.condition.notify ()
+
+
+    def start (self):
+        # called with the lock held
+        if (not self.thread):
+            self.thread = threading.Thread (target = self.run)
+            self.thread.daemon = True
+            self.thread.start ()
+
+
+    def prune (self):
+        # drops the entries of files that no longer exist, and chunk
+        # lists that no entry refers to
+        with self.condition:
+            paths = list (self.digests)
+        missing = [path for path in paths if not os.path.exists (path)]
+        with self.condition:
+            for path in missing:
+                self.forget (path)
+            used = set (os.path.basename (self.get_chunks_file (path))
+                        for path, entry in self.digests.items () if entry[3])
+        for name in os.listdir (self.chunks_dir):
+            if (name not in used):
+                try:
+                    os.remove (os.path.join (self.chunks_dir, name))
+                except OSError:
+                    pass
+
+
+    def run (self):
+        self.prune ()
+        while (True):
+            with self.condition:
+                while (not self.queue and not self.dirty):
+                    self.condition.wait ()
+                if (self.queue):
+                    path = self.queue.popleft ()
+                    self.queued.discard (path)
+                else:
+                    # saved when there is nothing else to do
+                    path = None
+                    self.dirty = False
+                    data = json.dumps (self.digests)
+            if (path == None):
+                self.save (data)
+            elif (not self.is_current (path)):
+                self.compute (path)
+
+
+    def compute (self, path):
+        digest = hashlib.sha256 ()
+        chunks = None
+        try:
+            st = os.stat (path)
+            with open (path, "rb") as f:
+                if (st.st_size >= DELTA_MIN_FILE_SIZE):
+                    chunks = []
+                    for offset, data in split_delta_chunks (f):
+                        digest.update (data)
+                        chunks.append ([offset, len (data),
+                                        hashlib.sha256 (data).hexdigest ()])
+                else:
+                    data = f.read (FriendlyDigestCache.READ_SIZE)
+                    while (data):
+                        digest.update (data)
+                        data = f.read (FriendlyDigestCache.READ_SIZE)
+            current = os.stat (path)
+        except (IOError, OSError):
+            logging.warning ("Failed to compute the checksum of %s" % path)
+            return
+        if (current.st_size != st.st_size or current.st_mtime != st.st_mtime):
+            # changed while it was read
+            return
+
+        if (chunks != None):
+            chunks_file = self.get_chunks_file (path)
+            try:
+                with open (chunks_file + ".tmp", "w") as f:
+                    json.dump ({"size": st.st_size, "mtime": st.st_mtime,
+                                "chunks": chunks}, f)
+                os.rename (chunks_file + ".tmp", chunks_file)
+            except (IOError, OSError):
+                logging.warning ("Failed to save the chunk list of %s" % path)
+                chunks = None
+        with self.condition:
+            self.store (path, [st.st_size, st.st_mtime, digest.hexdigest (),
+                               chunks != None])
+
+
+    def save (self, data):
+        try:
+            with open (self.index_file + ".tmp", "w") as f:
+                f.write (data)
+            os.rename (self.index_file + ".tmp", self.index_file)
+        except (IOError, OSError):
+            logging.warning ("Failed to save the checksum cache")
+
+
+class FriendlyPageCache:
+
+    # Rendered HTML pages keyed by everything that is shown on them. The
+    # page is rendered and gzipped once; requests get a shared buffer
+    # that is not copied. Pages are dropped when the share changes.
+
+    Page = collections.namedtuple ("Page", "buffer gzip_buffer etag")
+
+    def __init__ (self):
+        self.pages = {}
+
+
+    def get (self, key, render):
+        page = self.pages.get (key)
+        if (page):
+            return page
+
+        html = render ()
+        if (not isinstance (html, bytes)):
+            html = html.encode ("utf-8")
+        etag = "\"%s\"" % hashlib.sha1 (html).hexdigest ()[:20]
+        compressor = zlib.compressobj (9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress (html) + compressor.flush ()
+        gzip_buffer = None
+        if (len (gzipped) < len (html)):
+            gzip_buffer = Soup.Buffer.new (gzipped)
+        page = FriendlyPageCache.Page (Soup.Buffer.new (html), gzip_buffer, etag)
+        self.pages[key] = page
+        return page
+
+
+    def invalidate (self):
+        self.pages = {}
+
+
+class FriendlyTokenBucket:
+
+    # Allows 'rate' bytes per second with bursts of a fraction of a
+    # second. Taking more than is available puts the bucket in debt:
+    # take() returns how long the caller should wait before sending.
+
+    def __init__ (self, rate):
+        self.rate = float (rate)
+        self.burst = max (self.rate / 4, 2 * CHUNK_SIZE)
+        self.tokens = self.burst
+        self.updated = GLib.get_monotonic_time () / 1000000.0
+
+
+    def take (self, nbytes, now):
+        self.tokens = min (self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        return max (0.0, -self.tokens / self.rate)
+
+
+class FriendlyRateLimiter:
+
+    # Paces transfers in one direction with token buckets: a global one,
+    # one for local network clients and one for internet clients (the
+    # ones that come through the forwarded port), and one per client
+    # address. A rate of 0 means no limit. Transfers ask for one chunk
+    # at a time, so concurrent transfers get their turns in order and
+    # share the bandwidth fairly. Whether an address is local is only
+    # worked out once per address.
+
+    CLIENT_IDLE_SECONDS = 60
+    MAX_CLASSIFIED_ADDRESSES = 1024
+
+    def __init__ (self, rate = 0, client_rate = 0, local_rate = 0, internet_rate = 0):
+        self.bucket = FriendlyTokenBucket (rate) if rate else None
+        self.class_buckets = {
+            True: FriendlyTokenBucket (local_rate) if local_rate else None,
+            False: FriendlyTokenBucket (internet_rate) if internet_rate else None}
+        self.client_rate = client_rate
+        self.client_buckets = {}
+        # address -> is local
+        self.address_classes = {}
+
+
+    def get_delay (self, address, nbytes):
+        # Returns the number of seconds to wait before sending nbytes
+        now = GLib.get_monotonic_time () / 1000000.0
+        buckets = [self.bucket, self.class_buckets[self.is_local (address)]]
+        if (self.client_rate):
+            buckets.append (self.get_client_bucket (address, now))
+
+        delay = 0.0
+        for bucket in buckets:
+            if (bucket):
+                delay = max (delay, bucket.take (nbytes, now))
+        return delay
+
+
+    def is_local (self, address):
+        is_local = self.address_classes.get (address)
+        if (is_local == None):
+            if (len (self.address_classes) >= FriendlyRateLimiter.MAX_CLASSIFIED_ADDRESSES):
+                self.address_classes.clear ()
+            is_local = is_local_address (address)
+            self.address_classes[address] = is_local
+        return is_local
+
+
+    def get_client_bucket (self, address, now):
+        bucket = self.client_buckets.get (address)
+        if (not bucket):
+            for old_address in list (self.client_buckets):
+                idle = now - self.client_buckets[old_address].updated
+                if (idle > FriendlyRateLimiter.CLIENT_IDLE_SECONDS):
+                    del self.client_buckets[old_address]
+            bucket = FriendlyTokenBucket (self.client_rate)
+            self.client_buckets[address] = bucket
+        return bucket
+
+
+class FriendlyAdmissionController:
+
+    # Limits the number of downloads that are sent at the same time.
+    # Downloads over the limit wait (paused) in a FIFO queue of limited
+    # length and are started when a running download finishes. When
+    # the queue is full, admit() returns False. A download on a stolen
+    # connection gets no "finished" signal and calls release() instead.
+
+    def __init__ (self, server, max_active, max_queued, change_callback):
+        self.server = server
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.change_callback = change_callback
+        # active message -> "finished" handler id
+        self.active = {}
+        self.queue = collections.deque ()
+        self.average_wait = 0.0
+
+
+    def admit (self, message, start):
+        # calls start() now or when the message gets its turn. start()
+        # returns True if it took the connection away from libsoup: the
+        # message must not be unpaused then
+        if (len (self.active) < self.max_active):
+            self.activate (message)
+            start ()
+            return True
+
+        if (len (self.queue) >= self.max_queued):
+            return False
+
+        self.server.pause_message (message)
+        self.queue.append ((message, start, GLib.get_monotonic_time ()))
+        message.connect ("finished", self.on_queued_message_finished)
+        self.change_callback ()
+        return True
+
+
+    def activate (self, message):
+        self.active[message] = message.connect ("finished",
+                                                self.on_active_message_finished)
+
+
+    def on_active_message_finished (self, message):
+        self.release (message)
+
+
+    def release (self, message):
+        handler_id = self.active.pop (message, None)
+        if (handler_id == None):
+            return
+        message.disconnect (handler_id)
+        self.start_next ()
+
+
+    def on_queued_message_finished (self, message):
+        # the client went away while waiting
+        for item in self.queue:
+            if (item[0] == message):
+                self.queue.remove (item)
+                self.change_callback ()
+                break
+
+
+    def start_next (self):
+        while (self.queue and len (self.active) < self.max_active):
+            message, start, queued = self.queue.popleft ()
+            wait = (GLib.get_monotonic_time () - queued) / 1000000.0
+            self.average_wait = 0.8 * self.average_wait + 0.2 * wait
+            self.activate (message)
+            if (not start ()):
+                self.server.unpause_message (message)
+        self.change_callback ()
+
+
+    def get_queue_length (self):
+        return len (self.queue)
+
+
+    def get_longest_wait (self):
+        # seconds that the first download in the queue has waited
+        if (not self.queue):
+            return 0.0
+        return (GLib.get_monotonic_time () - self.queue[0][2]) / 1000000.0
+
+
+    def get_retry_after (self):
+        return max (5, int (self.average_wait + 0.5))
+
+
+class FriendlyStreamer:
+
+    # Writes the data from 'source' into the response body of a message
+    # one chunk at a time: the next chunk is only read once libsoup has
+    # written the previous one to the socket ("wrote-chunk"). Memory
+    # use does not depend on the size of the response and the first
+    # chunk can be sent right away.
+    #
+    # A source has a read() method that returns the next piece of data
+    # (an empty string at the end), a close() method and a 'length'
+    # attribute that is None if the length is not known in advance.
+    # read() may also return None if the data is not available yet: the
+    # source then calls its 'ready_callback' when it is.
+
+    def __init__ (self, server, message, client, source):
+        self.server = server
+        self.message = message
+        self.client = client
+        self.source = source
+        self.written = 0
+        self.waiting = False
+        self.paced_data = None
+        self.address = client.get_host ()
+        source.ready_callback = self.on_source_ready
+
+        if (source.length == None):
+            message.response_headers.set_encoding (Soup.Encoding.CHUNKED)
+        else:
+            message.response_headers.set_content_length (source.length)
+        message.response_body.set_accumulate (False)
+        self.handler_ids = [message.connect ("wrote-chunk", self.on_wrote_chunk),
+                            message.connect ("finished", self.on_finished)]
+        self.write_chunk ()
+
+
+    def write_chunk (self):
+        try:
+            data = self.source.read ()
+        except:
+            logging.error ("Failed to read data for a download")
+            traceback.print_exc ()
+            self.client.get_socket ().disconnect ()
+            return
+
+        if (data == None):
+            self.waiting = True
+            return
+
+        if (not data):
+            if (self.source.length != None and self.written < self.source.length):
+                # The file shrunk while we were serving it: we cannot
+                # honor the Content-Length anymore, so drop the connection
+                logging.warning ("Shared file was truncated during download")
+                self.client.get_socket ().disconnect ()
+                return
+            self.message.response_body.complete ()
+            return
+
+        self.written += len (data)
+        limiter = self.server.download_limiter
+        if (limiter):
+            delay = limiter.get_delay (self.address, len (data))
+            if (delay > 0.001):
+                # hold the chunk back and stop writing until it is due
+                self.paced_data = data
+                self.server.pause_message (self.message)
+                GLib.timeout_add (int (delay * 1000), self.on_pacing_timeout)
+                return
+        self.message.response_body.append_buffer (Soup.Buffer.new (data))
+
+
+    def on_wrote_chunk (self, message):
+        self.write_chunk ()
+
+
+    def on_pacing_timeout (self):
+        if (self.handler_ids):
+            self.message.response_body.append_buffer (Soup.Buffer.new (self.paced_data))
+            self.server.unpause_message (self.message)
+        self.paced_data = None
+        return False
+
+
+    def on_source_ready (self):
+        if (self.waiting and self.handler_ids):
+            # libsoup stops writing when it runs out of data
+            self.waiting = False
+            self.write_chunk ()
+            if (self.paced_data == None):
+                self.server.unpause_message (self.message)
+        return False
+
+
+    def on_finished (self, message):
+        for handler_id in self.handler_ids:
+            message.disconnect (handler_id)
+        self.handler_ids = []
+        self.source.close ()
+
+
+class FriendlySendfileTransfer:
+
+    # Sends a span of a file with os.sendfile() on a connection that has
+    # been stolen from libsoup, so the file data is never copied through
+    # userspace. 'stream' is what steal_connection() returned and is
+    # only closed at the end; the data is written to 'gsocket', taken
+    # from the client before the connection was stolen. libsoup knows
+    # nothing about the response: the response
+    # head is written here, the connection is closed at the end and
+    # 'finished_callback (complete, sent, head_time, first_byte_time)'
+    # is called instead of the message signals; the times are monotonic
+    # times, None if that point was not reached. Downloads are paced
+    # like FriendlyStreamer does.
+
+    MAX_SEND_SIZE = 4 * 1024 * 1024
+
+    def __init__ (self, server, stream, gsocket, address, head, f, offset, length,
+                  finished_callback):
+        self.server = server
+        self.stream = stream
+        self.socket = gsocket
+        self.socket.set_blocking (False)
+        self.fd = self.socket.get_fd ()
+        self.address = address
+        self.head = head
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+        self.sent = 0
+        self.head_time = None
+        self.first_byte_time = None
+        self.finished_callback = finished_callback
+        self.watch ()
+
+
+    def watch (self):
+        GLib.io_add_watch (self.fd, GLib.PRIORITY_DEFAULT,
+                           GLib.IOCondition.OUT | GLib.IOCondition.ERR |
+                           GLib.IOCondition.HUP,
+                           self.on_writable)
+        return False
+
+
+    def on_writable (self, fd, condition):
+        if (condition & (GLib.IOCondition.ERR | GLib.IOCondition.HUP)):
+            self.finish (False)
+            return False
+
+        try:
+            if (self.head):
+                written = os.write (self.fd, self.head)
+                self.head = self.head[written:]
+                if (self.head):
+                    return True
+                self.head_time = GLib.get_monotonic_time ()
+            if (self.remaining == 0):
+                self.finish (True)
+                return False
+            sent = os.sendfile (self.fd, self.f.fileno (), self.offset,
+                                min (self.remaining, FriendlySendfileTransfer.MAX_SEND_SIZE))
+        except OSError as e:
+            if (e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]):
+                return True
+            logging.info ("Download was interrupted: %s" % e)
+            self.finish (False)
+            return False
+
+        if (sent == 0):
+            # we cannot honor the Content-Length anymore
+            logging.warning ("Shared file was truncated during download")
+            self.finish (False)
+            return False
+        if (self.first_byte_time == None):
+            self.first_byte_time = GLib.get_monotonic_time ()
+        self.offset += sent
+        self.remaining -= sent
+        self.sent += sent
+        if (self.remaining == 0):
+            self.finish (True)
+            return False
+
+        limiter = self.server.download_limiter
+        if (limiter):
+            delay = limiter.get_delay (self.address, sent)
+            if (delay > 0.001):
+                GLib.timeout_add (int (delay * 1000), self.watch)
+                return False
+        return True
+
+
+    def finish (self, complete):
+        self.f.close ()
+        try:
+            self.stream.close (None)
+        except:
+            pass
+        self.finished_callback (complete, self.sent, self.head_time,
+                                self.first_byte_time)
+
+
+class FriendlyFileReader:
+
+    # Streamer source for a file. 'spans' is a list of byte strings and
+    # (offset, length) file spans that are read in order, the default
+    # is the whole file.
+
+    def __init__ (self, filename, spans = None):
+        self.f = open (filename, "rb")
+        if (spans == None):
+            spans = [(0, os.fstat (self.f.fileno ()).st_size)]
+        self.spans = list (reversed (spans))
+        self.remaining = 0
+
+        self.length = 0
+        for span in spans:
+            if (isinstance (span, bytes)):
+                self.length += len (span)
+            else:
+                self.length += span[1]
+
+
+    def read (self):
+        while (self.remaining <= 0):
+            if (not self.spans):
+                return b""
+            span = self.spans.pop ()
+            if (isinstance (span, bytes)):
+                return span
+            self.f.seek (span[0])
+            self.remaining = span[1]
+
+        data = self.f.read (min (CHUNK_SIZE, self.remaining))
+        self.remaining -= len (data)
+        return data
+
+
+    def close (self):
+        self.f.close ()
+
+
+class FriendlyGzipStream:
+
+    # Streamer source that gzips another source on the fly, used until
+    # the precompressed variant of a file is ready. The output is the
+    # same as the gzip variant built by FriendlyVariantCache.
+
+    def __init__ (self, source, level):
+        self.source = source
+        self.compressor = zlib.compressobj (level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+        self.length = None
+        self.ready_callback = None
+
+
+    def read (self):
+        if (not self.compressor):
+            return b""
+        while (True):
+            data = self.source.read ()
+            if (not data):
+                tail = self.compressor.flush ()
+                self.compressor = None
+                return tail
+            data = self.compressor.compress (data)
+            if (data):
+                return data
+
+
+    def close (self):
+        self.source.close ()
+
+
+class FriendlyZipStream:
+
+    # Streamer source that creates a ZIP archive of the selection on the
+    # fly, so the archive can be sent while it is being built and is
+    # never stored anywhere. CRCs and sizes are only known after the
+    # data has been written, so they follow each entry in a data
+    # descriptor. ZIP64 records are used where the 32-bit fields are
+    # not enough.
+    #
+    # With a pool, up to 'max_pending' blocks are deflated in parallel.
+    # read() returns None while the next block is still being
+    # compressed: ready_callback is then called (in the main loop) when
+    # it is done, or wait() can be used in another thread to block
+    # until then. Finished blocks are stored in the main loop, so the
+    # main loop has to be running either way.
+    #
+    # With a member cache, deflated entries of unchanged files are copied
+    # from the cache instead of being compressed again.
+
+    ZIP64_LIMIT = 0xFFFFFFFF
+    # deflate can grow incompressible data slightly: leave some room
+    # when deciding from the file size whether an entry needs ZIP64
+    ZIP64_SIZE_LIMIT = ZIP64_LIMIT - (1 << 24)
+
+    FLAG_DATA_DESCRIPTOR = 0x08
+    FLAG_UTF8 = 0x800
+
+    STORED = 0
+    DEFLATED = 8
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__ (self, files, policy, pool = None, max_pending = 1,
+                  member_cache = None):
+        self.files = files
+        self.policy = policy
+        self.pool = pool
+        self.max_pending = max_pending
+        self.member_cache = member_cache
+        self.pending = collections.deque ()
+        self.ready_callback = None
+        self.length = None
+        self.pieces = self.generate ()
+
+
+    def read (self):
+        for piece in self.pieces:
+            if (piece == None or piece):
+                return piece
+        return b""
+
+
+    def wait (self):
+        if (self.pending):
+            self.pending[0].done.wait ()
+
+
+    def on_block_done (self, block, data, error):
+        # called in a pool thread
+        GLib.idle_add (self.store_block, block, data, error)
+
+
+    def store_block (self, block, data, error):
+        block.data = data
+        block.error = error
+        block.done.set ()
+        if (self.ready_callback):
+            self.ready_callback ()
+        return False
+
+
+    def close (self):
+        self.pieces.close ()
+
+
+    def generate (self):
+        offset = 0
+        records = []
+        for path, arcname, is_dir in walk_selection (self.files):
+            try:
+                st = os.stat (path)
+                f = None if is_dir else open (path, "rb")
+            except (IOError, OSError):
+                logging.warning ("Skipping unreadable file %s" % path)
+                continue
+
+            name = arcname.encode ("utf-8")
+            if (is_dir):
+                method = FriendlyZipStream.STORED
+                flags = FriendlyZipStream.FLAG_UTF8
+            else:
+                method = FriendlyZipStream.STORED
+                if (self.policy.is_compressible (path)):
+                    method = FriendlyZipStream.DEFLATED
+                flags = (FriendlyZipStream.FLAG_UTF8 |
+                         FriendlyZipStream.FLAG_DATA_DESCRIPTOR)
+            zip64 = st.st_size >= FriendlyZipStream.ZIP64_SIZE_LIMIT
+            header = self.get_local_header (name, st, method, flags, zip64)
+            yield header
+
+            crc, compressed_size, size = 0, 0, 0
+            if (f):
+                with f:
+                    for data in self.compress_member (path, st, f, method):
+                        if (data != None):
+                            compressed_size += len (data)
+                        yield data
+                crc, size = self.crc, self.size
+                if (not zip64 and max (size, compressed_size) >= FriendlyZipStream.ZIP64_LIMIT):
+                    raise Exception ("%s grew too large while archiving" % path)
+                if (zip64):
+                    descriptor = struct.pack ("<IIQQ", 0x08074b50, crc, compressed_size, size)
+                else:
+                    descriptor = struct.pack ("<IIII", 0x08074b50, crc, compressed_size, size)
+                yield descriptor
+            else:
+                descriptor = b""
+
+            records.append ((name, st, method, flags, crc, compressed_size, size, offset))
+            offset += len (header) + compressed_size + len (descriptor)
+
+        yield self.get_central_directory (records, offset)
+
+
+    def compress (self, f, method):
+        # Yields the (compressed) contents of f (or None while waiting
+        # for the pool), records crc and size
+        self.crc, self.size = 0, 0
+        if (method == FriendlyZipStream.STORED):
+            data = f.read (CHUNK_SIZE)
+            while (data):
+                self.crc = zlib.crc32 (data, self.crc)
+                self.size += len (data)
+                yield data
+                data = f.read (CHUNK_SIZE)
+        elif (not self.pool):
+            compressor = zlib.compressobj (self.policy.compress_level, zlib.DEFLATED, -15)
+            data = f.read (CHUNK_SIZE)
+            while (data):
+                self.crc = zlib.crc32 (data, self.crc)
+                self.size += len (data)
+                yield compressor.compress (data)
+                data = f.read (CHUNK_SIZE)
+            yield compressor.flush ()
+        else:
+            for data in self.compress_parallel (f):
+                yield data
+        self.crc &= 0xFFFFFFFF
+
+
+    def compress_member (self, path, st, f, method):
+        # compress() through the member cache: yields the cached member
+        # if there is one for this version of the file, and otherwise
+        # stores the compressed data for the next archive
+        cache = self.member_cache
+        if (not cache or method != FriendlyZipStream.DEFLATED or
+            st.st_size < FriendlyMemberCache.MIN_SIZE):
+            for data in self.compress (f, method):
+                yield data
+            return
+
+        cached = cache.open (path, st)
+        if (cached):
+            member, member_file = cached
+            with member_file:
+                data = member_file.read (CHUNK_SIZE)
+                while (data):
+                    yield data
+                    data = member_file.read (CHUNK_SIZE)
+            self.crc, self.size = member.crc, member.size
+            return
+
+        name, member_file = cache.create ()
+        complete = False
+        try:
+            with member_file:
+                for data in self.compress (f, method):
+                    if (data):
+                        member_file.write (data)
+                    yield data
+                compressed_size = member_file.tell ()
+            # a file that changed while it was read is not cached
+            current = os.fstat (f.fileno ())
+            complete = (current.st_size == st.st_size == self.size and
+                        current.st_mtime == st.st_mtime)
+        finally:
+            if (complete):
+                cache.add (path, st, name, self.crc, self.size, compressed_size)
+            else:
+                cache.discard (name)
+
+
+    def compress_parallel (self, f):
+        dictionary = None
+        eof = False
+        while (not eof or self.pending):
+            while (not eof and len (self.pending) < self.max_pending):
+                data = f.read (FriendlyZipStream.BLOCK_SIZE)
+                if (len (data) < FriendlyZipStream.BLOCK_SIZE):
+                    eof = True
+                if (not data):
+                    break
+                self.crc = zlib.crc32 (data, self.crc)
+                self.size += len (data)
+                block = FriendlyDeflateBlock ()
+                callbacks = {"callback": lambda result, block = block:
+                                 self.on_block_done (block, result, None)}
+                if (sys.version_info[0] > 2):
+                    callbacks["error_callback"] = lambda error, block = block: \
+                        self.on_block_done (block, None, error)
+                args = (data, dictionary, self.policy.compress_level)
+                self.pool.apply_async (deflate_block, args, **callbacks)
+                self.pending.append (block)
+                dictionary = data[-32768:]
+
+            if (not self.pending):
+                break
+            if (not self.pending[0].done.is_set ()):
+                yield None
+                continue
+            yield self.pending.popleft ().get ()
+
+        # the blocks end in sync flushes: finish with an empty final block
+        yield b"\x03\x00"
+
+
+    def get_local_header (self, name, st, method, flags, zip64):
+        dos_time, dos_date = get_dos_datetime (st.st_mtime)
+        if (zip64):
+            # sizes are in the zip64 extra field (and data descriptor)
+            extra = struct.pack ("<HHQQ", 0x0001, 16, 0, 0)
+            size_field = 0xFFFFFFFF
+            version = 45
+        else:
+            extra = b""
+            size_field = 0
+            version = 20
+        return struct.pack ("<IHHHHHIIIHH", 0x04034b50, version, flags, method,
+                            dos_time, dos_date, 0, size_field, size_field,
+                            len (name), len (extra)) + name + extra
+
+
+    def get_central_directory (self, records, cd_offset):
+        limit = FriendlyZipStream.ZIP64_LIMIT
+        central = []
+        for (name, st, method, flags, crc, compressed_size, size, offset) in records:
+            dos_time, dos_date = get_dos_datetime (st.st_mtime)
+            extra = b""
+            if (size >= limit):
+                extra += struct.pack ("<Q", size)
+                size = limit
+            if (compressed_size >= limit):
+                extra += struct.pack ("<Q", compressed_size)
+                compressed_size = limit
+            if (offset >= limit):
+                extra += struct.pack ("<Q", offset)
+                offset = limit
+            if (extra):
+                extra = struct.pack ("<HH", 0x0001, len (extra)) + extra
+                version = 45
+            else:
+                version = 20
+            external_attr = (st.st_mode & 0xFFFF) << 16
+            if (name.endswith (b"/")):
+                external_attr |= 0x10
+            central.append (struct.pack ("<IHHHHHHIIIHHHHHII", 0x02014b50,
+                                         (3 << 8) | version, version, flags,
+                                         method, dos_time, dos_date, crc,
+                                         compressed_size, size, len (name),
+                                         len (extra), 0, 0, 0, external_attr,
+                                         offset) + name + extra)
+        central = b"".join (central)
+
+        count = len (records)
+        cd_size = len (central)
+        end = b""
+        if (count >= 0xFFFF or cd_size >= limit or cd_offset >= limit):
+            zip64_end_offset = cd_offset + cd_size
+            end += struct.pack ("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | 45, 45,
+                                0, 0, count, count, cd_size, cd_offset)
+            end += struct.pack ("<IIQI", 0x07064b50, 0, zip64_end_offset, 1)
+            count = min (count, 0xFFFF)
+            cd_size = min (cd_size, limit)
+            cd_offset = min (cd_offset, limit)
+        end += struct.pack ("<IHHHHIIH", 0x06054b50, 0, 0, count, count,
+                            cd_size, cd_offset, 0)
+        return central + end
+
+
+class FriendlyUploadDirectory:
+
+    # Where uploads are saved: one directory for the app with a
+    # subdirectory for every day that has uploads. The names in the
+    # current day directory are read once and then kept in memory along
+    # with the next free "name(N).ext" counter for every upload name,
+    # so picking a name does not get slower as the directory fills up.
+    # Files are created with O_EXCL: a file that appears behind our back
+    # is never overwritten, its name is just added to the index.
+
+    def __init__ (self, base_dir = None):
+        self.base_dir = base_dir
+        self.directory = None
+        self.day = None
+        self.names = set ()
+        self.counters = {}
+
+
+    def get_base_dir (self):
+        if (not self.base_dir):
+            dl_dir = GLib.get_user_special_dir (GLib.UserDirectory.DIRECTORY_DOWNLOAD)
+            if (not dl_dir):
+                # e.g. no xdg user dirs on a server
+                dl_dir = GLib.get_home_dir ()
+            self.base_dir = os.path.join (dl_dir, "%s Uploads" % FFS_APP_NAME)
+        return self.base_dir
+
+
+    def get_directory (self):
+        day = time.strftime ("%Y-%m-%d")
+        if (day != self.day):
+            directory = os.path.join (self.get_base_dir (), day)
+            if (not os.path.isdir (directory)):
+                os.makedirs (directory)
+            if (hasattr (os, "scandir")):
+                self.names = set (entry.name for entry in os.scandir (directory))
+            else:
+                self.names = set (os.listdir (directory))
+            self.counters = {}
+            self.day = day
+            self.directory = directory
+        return self.directory
+
+
+    def create (self, basename):
+        # returns the path and the open file for a new upload
+        directory = self.get_directory ()
+        fn, ext = os.path.splitext (basename)
+        counter = self.counters.get (basename, 1)
+        while (True):
+            name = basename if counter == 1 else "%s(%d)%s" % (fn, counter, ext)
+            counter += 1
+            if (name in self.names):
+                continue
+            self.names.add (name)
+
+            path = os.path.join (directory, name)
+            try:
+                fd = os.open (path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                                    getattr (os, "O_BINARY", 0), 0o644)
+            except OSError as e:
+                if (e.errno != errno.EEXIST):
+                    raise
+                continue
+            self.counters[basename] = counter
+            return (path, os.fdopen (fd, "wb"))
+
+
+class FriendlyResumableUpload:
+
+    # An upload that can be continued after the connection drops, using
+    # the core of the tus protocol (https://tus.io): "POST /uploads/"
+    # creates an upload, PATCH appends data at Upload-Offset and HEAD
+    # returns the current offset. The data is written into a partial
+    # file that is preallocated to the full length. Its offset is kept
+    # in a sidecar file that is only updated after the data has been
+    # synced to disk, so it is never ahead of the data after a crash.
+    # Like FriendlyUploadReceiver, an upload is fed the chunks of a
+    # request body; abort() keeps whatever has been received. The data is
+    # hashed as it arrives, unless the upload was continued after a
+    # restart.
+    #
+    # Preallocation reserves disk space before any data arrives, so new
+    # uploads must leave MIN_FREE_SPACE bytes free and all incomplete
+    # uploads together may only reserve MAX_RESERVED_FRACTION of the
+    # space. Uploads that make no progress for EXPIRY_SECONDS are
+    # removed.
+
+    SYNC_INTERVAL = 16 * 1024 * 1024
+    EXPIRY_SECONDS = 6 * 60 * 60
+    MIN_FREE_SPACE = 512 * 1024 * 1024
+    MAX_RESERVED_FRACTION = 0.5
+
+    def __init__ (self, partial_dir, upload_id, filename, length, offset = 0):
+        self.id = upload_id
+        self.filename = filename
+        self.length = length
+        self.offset = offset
+        self.synced_offset = offset
+        self.path = os.path.join (partial_dir, upload_id + ".part")
+        self.info_path = os.path.join (partial_dir, upload_id + ".info")
+        self.f = None
+        self.failed = False
+        # SHA-256 of the data before 'offset', None if it is not known
+        self.hash = hashlib.sha256 () if offset == 0 else None
+
+
+    @staticmethod
+    def create (partial_dir, filename, length):
+        upload_id = binascii.hexlify (os.urandom (16)).decode ("ascii")
+        upload = FriendlyResumableUpload (partial_dir, upload_id, filename, length)
+        try:
+            with open (upload.path, "wb") as f:
+                if (hasattr (os, "posix_fallocate") and length > 0):
+                    os.posix_fallocate (f.fileno (), 0, length)
+                else:
+                    f.truncate (length)
+            upload.save ()
+        except:
+            # a .part without .info would never expire
+            upload.remove ()
+            raise
+        return upload
+
+
+    @staticmethod
+    def get_free_space (partial_dir):
+        st = os.statvfs (partial_dir)
+        return st.f_bavail * st.f_frsize
+
+
+    @staticmethod
+    def get_reserved_space (partial_dir):
+        # space taken by the partial files of incomplete uploads
+        reserved = 0
+        for name in os.listdir (partial_dir):
+            if (name.endswith (".part")):
+                try:
+                    reserved += os.path.getsize (os.path.join (partial_dir, name))
+                except OSError:
+                    pass
+        return reserved
+
+
+    @staticmethod
+    def has_space (partial_dir, length):
+        free = (FriendlyResumableUpload.get_free_space (partial_dir) -
+                FriendlyResumableUpload.MIN_FREE_SPACE)
+        reserved = FriendlyResumableUpload.get_reserved_space (partial_dir)
+        return (length <= free and
+                reserved + length <= (free + reserved) *
+                                     FriendlyResumableUpload.MAX_RESERVED_FRACTION)
+
+
+    @staticmethod
+    def load (partial_dir, upload_id):
+        # returns None if there is no such upload
+        upload = FriendlyResumableUpload (partial_dir, upload_id, None, 0)
+        try:
+            with open (upload.info_path) as f:
+                info = json.load (f)
+        except (IOError, ValueError):
+            return None
+        if (not os.path.isfile (upload.path)):
+            return None
+        upload.filename = info["filename"]
+        upload.length = info["length"]
+        upload.offset = upload.synced_offset = info["offset"]
+        if (upload.offset > 0):
+            upload.hash = None
+        return upload
+
+
+    @staticmethod
+    def remove_expired (partial_dir):
+        now = time.time ()
+        for name in os.listdir (partial_dir):
+            path = os.path.join (partial_dir, name)
+            try:
+                if (now - os.path.getmtime (path) > FriendlyResumableUpload.EXPIRY_SECONDS):
+                    os.remove (path)
+            except OSError:
+                pass
+
+
+    def save (self):
+        with open (self.info_path + ".tmp", "w") as f:
+            json.dump ({"filename": self.filename,
+                        "length": self.length,
+                        "offset": self.synced_offset}, f)
+        os.rename (self.info_path + ".tmp", self.info_path)
+
+
+    def is_active (self):
+        return (self.f != None)
+
+
+    def is_complete (self):
+        return (not self.failed and self.offset == self.length)
+
+
+    def begin (self):
+        self.failed = False
+        self.f = open (self.path, "r+b")
+        self.f.seek (self.offset)
+
+
+    def feed (self, data):
+        if (self.failed or not self.f):
+            return
+        try:
+            if (self.offset + len (data) > self.length):
+                raise Exception ("Upload is longer than its Upload-Length")
+            self.f.write (data)
+            self.offset += len (data)
+            if (self.hash):
+                self.hash.update (data)
+            if (self.offset - self.synced_offset >= FriendlyResumableUpload.SYNC_INTERVAL):
+                self.sync ()
+        except:
+            logging.error ("Failed to write upload %s" % self.filename)
+            traceback.print_exc ()
+            self.failed = True
+
+
+    def sync (self):
+        self.f.flush ()
+        os.fsync (self.f.fileno ())
+        self.synced_offset = self.offset
+        self.save ()
+
+
+    def end (self):
+        if (not self.f):
+            return
+        try:
+            self.sync ()
+        except:
+            logging.error ("Failed to save upload %s" % self.filename)
+            traceback.print_exc ()
+            self.failed = True
+        self.f.close ()
+        self.f = None
+
+
+    def abort (self):
+        # the connection dropped: keep what was received for resuming
+        self.end ()
+
+
+    def get_digest (self):
+        return self.hash.hexdigest () if self.hash else None
+
+
+    def remove (self):
+        for path in [self.path, self.info_path]:
+            try:
+                os.remove (path)
+            except OSError:
+                pass
+
+
+class FriendlyUploadReceiver:
+
+    # Parses a multipart/form-data request body as the chunks arrive
+    # ("got-chunk") and writes every file part straight into its own file
+    # in the upload directory. Only the unparsed tail of the last chunk
+    # (at most a delimiter or a part header) is kept in memory. Files are
+    # hashed as they are written: 'files' has the basename, filename,
+    # size and SHA-256 of every file part.
+
+    PREAMBLE = 0
+    DELIMITER = 1
+    HEADERS = 2
+    BODY = 3
+    DONE = 4
+
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__ (self, boundary, create_upload_file):
+        # the CRLF before the first delimiter is optional: pretend it's there
+        self.delimiter = ("\r\n--" + boundary).encode ("ascii")
+        self.buffer = b"\r\n"
+        self.state = FriendlyUploadReceiver.PREAMBLE
+        self.create_upload_file = create_upload_file
+        self.f = None
+        self.hash = None
+        self.files = []
+        self.failed = False
+
+
+    def feed (self, data):
+        if (self.failed):
+            return
+        try:
+            self.buffer += data
+            self.parse ()
+        except:
+            logging.error ("Failed to write upload")
+            traceback.print_exc ()
+            self.abort ()
+
+
+    def parse (self):
+        while (True):
+            if (self.state == FriendlyUploadReceiver.PREAMBLE or
+                self.state == FriendlyUploadReceiver.BODY):
+                i = self.buffer.find (self.delimiter)
+                if (i < 0):
+                    # keep whatever could be the start of a delimiter
+                    keep = min (len (self.buffer), len (self.delimiter) - 1)
+                    self.write (self.buffer[:len (self.buffer) - keep])
+                    self.buffer = self.buffer[len (self.buffer) - keep:]
+                    return
+                self.write (self.buffer[:i])
+                self.end_part ()
+                self.buffer = self.buffer[i + len (self.delimiter):]
+                self.state = FriendlyUploadReceiver.DELIMITER
+
+            elif (self.state == FriendlyUploadReceiver.DELIMITER):
+                if (len (self.buffer) < 2):
+                    return
+                if (self.buffer[:2] == b"--"):
+                    self.buffer = b""
+                    self.state = FriendlyUploadReceiver.DONE
+                    return
+                self.buffer = self.buffer[2:]
+                self.state = FriendlyUploadReceiver.HEADERS
+
+            elif (self.state == FriendlyUploadReceiver.HEADERS):
+                if (self.buffer.startswith (b"\r\n")):
+                    header_end = 0
+                else:
+                    header_end = self.buffer.find (b"\r\n\r\n")
+                    if (header_end < 0):
+                        if (len (self.buffer) > FriendlyUploadReceiver.MAX_HEADER_SIZE):
+                            raise Exception ("Multipart header too long")
+                        return
+                    header_end += 2
+                self.start_part (self.buffer[:header_end].decode ("utf-8", "replace"))
+                self.buffer = self.buffer[header_end + 2:]
+                self.state = FriendlyUploadReceiver.BODY
+
+            else:
+                # ignore the epilogue
+                self.buffer = b""
+                return
+
+
+    def start_part (self, header_block):
+        headers = Soup.MessageHeaders.new (Soup.MessageHeadersType.MULTIPART)
+        for line in header_block.split ("\r\n"):
+            name, sep, value = line.partition (":")
+            if (sep):
+                headers.append (name.strip (), value.strip ())
+
+        [has_cd, cd, params] = headers.get_content_disposition ()
+        if (not has_cd or not params.get ("filename")):
+            # not a file (or no file was selected in the form)
+            return
+
+        # some browsers send the full path of the file
+        basename = os.path.basename (params["filename"].replace ("\\", "/"))
+        if (not basename or basename in [".", ".."]):
+            basename = "Upload"
+        filename, self.f = self.create_upload_file (basename)
+        self.hash = hashlib.sha256 ()
+        self.files.append ([basename, filename, 0, None])
+
+
+    def write (self, data):
+        if (self.f and data):
+            self.f.write (data)
+            self.hash.update (data)
+            self.files[-1][2] += len (data)
+
+
+    def end_part (self):
+        if (self.f):
+            self.f.close ()
+            self.f = None
+            self.files[-1][3] = self.hash.hexdigest ()
+
+
+    def is_complete (self):
+        return (not self.failed and
+                self.state == FriendlyUploadReceiver.DONE)
+
+
+    def abort (self):
+        # remove everything written so far
+        self.failed = True
+        self.end_part ()
+        for [basename, filename, size, digest] in self.files:
+            try:
+                os.remove (filename)
+            except OSError:
+                logging.warning ("Failed to remove partial upload %s" % filename)
+        self.files = []
+
+
+class FriendlyHistogram:
+
+    # Counts observed values in buckets, exported as a Prometheus histogram
+
+    def __init__ (self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len (buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe (self, value):
+        self.counts[bisect.bisect_left (self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def format (self):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip (self.buckets, self.counts):
+            cumulative += count
+            lines.append ("%s_bucket{le=\"%r\"} %d" % (self.name, float (bound), cumulative))
+        lines.append ("%s_bucket{le=\"+Inf\"} %d" % (self.name, self.count))
+        lines.append ("%s_sum %s" % (self.name, repr (float (self.sum))))
+        lines.append ("%s_count %d" % (self.name, self.count))
+        return lines
+
+
+class FriendlyMetrics:
+
+    # Records what happens to every request (latency, time to first
+    # byte, bytes sent and received, throughput) and exports it in the
+    # Prometheus text format. Times are measured from the moment libsoup
+    # starts reading the request.
+
+    SECONDS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800]
+    BYTES = [1024 * 4 ** i for i in range (13)]
+    BYTES_PER_SECOND = [64 * 1024 * 4 ** i for i in range (8)]
+    # throughput of very small transfers says nothing about the network
+    MIN_THROUGHPUT_BYTES = 64 * 1024
+
+    def __init__ (self):
+        self.latency = FriendlyHistogram ("ffs_request_duration_seconds",
+                                          "Time from request start to response end",
+                                          FriendlyMetrics.SECONDS)
+        self.ttfb = FriendlyHistogram ("ffs_time_to_first_byte_seconds",
+                                       "Time from request start to the first response byte",
+                                       FriendlyMetrics.SECONDS)
+        self.sent = FriendlyHistogram ("ffs_response_body_bytes",
+                                       "Response body bytes sent per request",
+                                       FriendlyMetrics.BYTES)
+        self.received = FriendlyHistogram ("ffs_request_body_bytes",
+                                           "Request body bytes received per request",
+                                           FriendlyMetrics.BYTES)
+        self.download_throughput = FriendlyHistogram ("ffs_download_throughput_bytes_per_second",
+                                                      "Throughput of downloads",
+                                                      FriendlyMetrics.BYTES_PER_SECOND)
+        self.upload_throughput = FriendlyHistogram ("ffs_upload_throughput_bytes_per_second",
+                                                    "Throughput of uploads",
+                                                    FriendlyMetrics.BYTES_PER_SECOND)
+        self.archive_time = FriendlyHistogram ("ffs_archive_preparation_seconds",
+                                               "Time taken to prepare archives",
+                                               [1, 5, 10, 30, 60, 300, 900, 3600])
+        self.histograms = [self.latency, self.ttfb, self.sent, self.received,
+                           self.download_throughput, self.upload_throughput,
+                           self.archive_time]
+        self.responses = collections.Counter ()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.active_requests = 0
+        self.requests = {}
+        self.connections = set ()
+
+
+    def track_request (self, message, client):
+        state = {"start": GLib.get_monotonic_time (), "headers": None,
+                 "first_byte": None, "sent": 0, "received": 0}
+        state["handler_ids"] = [
+            message.connect ("wrote-headers", self.on_wrote_headers, state),
+            message.connect ("wrote-body-data", self.on_wrote_body_data, state),
+            message.connect ("got-chunk", self.on_got_chunk, state),
+            message.connect ("finished", self.on_finished, state)]
+        self.requests[message] = state
+        self.active_requests += 1
+
+        socket = client.get_socket ()
+        if (socket not in self.connections):
+            self.connections.add (socket)
+            socket.connect ("disconnected", self.on_socket_disconnected)
+
+
+    def on_socket_disconnected (self, socket):
+        self.connections.discard (socket)
+
+
+    def on_wrote_headers (self, message, state):
+        state["headers"] = GLib.get_monotonic_time ()
+
+
+    def on_wrote_body_data (self, message, chunk, state):
+        if (state["first_byte"] == None):
+            state["first_byte"] = GLib.get_monotonic_time ()
+        state["sent"] += chunk.length
+        self.bytes_sent += chunk.length
+
+
+    def on_got_chunk (self, message, chunk, state):
+        state["received"] += chunk.length
+        self.bytes_received += chunk.length
+
+
+    def record_sent (self, message, nbytes, headers_time, first_byte_time):
+        # for responses written without libsoup (sendfile): libsoup
+        # emits no signals for them, so this also finishes the request
+        self.bytes_sent += nbytes
+        state = self.requests.get (message)
+        if (not state):
+            return
+        for handler_id in state["handler_ids"]:
+            message.disconnect (handler_id)
+        state["headers"] = headers_time
+        state["first_byte"] = first_byte_time
+        state["sent"] += nbytes
+        self.on_finished (message, state)
+
+
+    def on_finished (self, message, state):
+        now = GLib.get_monotonic_time ()
+        self.requests.pop (message, None)
+        self.active_requests -= 1
+        self.responses[message.status_code] += 1
+
+        self.latency.observe ((now - state["start"]) / 1000000.0)
+        # responses without a body count until their headers
+        first_byte = state["first_byte"] or state["headers"]
+        if (first_byte != None):
+            self.ttfb.observe ((first_byte - state["start"]) / 1000000.0)
+        self.sent.observe (state["sent"])
+        self.received.observe (state["received"])
+
+        if (state["sent"] >= FriendlyMetrics.MIN_THROUGHPUT_BYTES):
+            duration = max (now - state["first_byte"], 1) / 1000000.0
+            self.download_throughput.observe (state["sent"] / duration)
+        if (state["received"] >= FriendlyMetrics.MIN_THROUGHPUT_BYTES):
+            duration = max (now - state["start"], 1) / 1000000.0
+            self.upload_throughput.observe (state["received"] / duration)
+
+
+    def archive_prepared (self, microseconds):
+        self.archive_time.observe (microseconds / 1000000.0)
+
+
+    def format (self, downloads_in_progress):
+        lines = ["# HELP ffs_responses_total Responses sent by status code",
+                 "# TYPE ffs_responses_total counter"]
+        for code in sorted (self.responses):
+            lines.append ("ffs_responses_total{code=\"%d\"} %d" % (code, self.responses[code]))
+        for (name, kind, description, value) in [
+            ("ffs_sent_bytes_total", "counter", "Response body bytes sent", self.bytes_sent),
+            ("ffs_received_bytes_total", "counter", "Request body bytes received", self.bytes_received),
+            ("ffs_active_requests", "gauge", "Requests being handled", self.active_requests),
+            ("ffs_active_connections", "gauge", "Open client connections", len (self.connections)),
+            ("ffs_downloads_in_progress", "gauge", "Downloads in progress", downloads_in_progress)]:
+            lines.append ("# HELP %s %s" % (name, description))
+            lines.append ("# TYPE %s %s" % (name, kind))
+            lines.append ("%s %d" % (name, value))
+        for histogram in self.histograms:
+            lines.extend (histogram.format ())
+        return "\n".join (lines) + "\n"
+
+
+class FriendlyStartupLog:
+
+    # Logs (at info level, see --verbose) how long each startup phase
+    # took. Phases run in parallel, so they are logged in the order
+    # they finish, with the time since startup began.
+
+    def __init__ (self):
+        self.started = GLib.get_monotonic_time ()
+        self.phases = {}
+        self.ended = set ()
+
+
+    def begin (self, phase):
+        self.phases[phase] = GLib.get_monotonic_time ()
+
+
+    def end (self, phase, result = None):
+        # only the first end of a phase is logged
+        if (phase in self.ended):
+            return
+        self.ended.add (phase)
+        now = GLib.get_monotonic_time ()
+        began = self.phases.pop (phase, self.started)
+        logging.info ("Startup: %s took %.1f ms (at %.1f ms)%s"
+                      % (phase, (now - began) / 1000.0,
+                         (now - self.started) / 1000.0,
+                         ": " + result if result else ""))
+
+
+class FriendlyReachabilityProber:
+
+    # Checks that the server can be reached at ip:port by sending HEAD
+    # requests there. Every attempt has a timeout and failed attempts
+    # are retried with exponential backoff: the state only becomes
+    # UNAVAILABLE after MAX_FAILURES failures in a row, so one slow
+    # answer does not hide a working address. Once the state is known
+    # the address is re-validated periodically. 'callback' is called
+    # when the state changes; 'rtt' is the round trip time (in ms) of
+    # the last successful probe.
+
+    TIMEOUT_SECONDS = 5
+    MIN_BACKOFF_SECONDS = 1
+    MAX_BACKOFF_SECONDS = 60
+    MAX_FAILURES = 4
+    REVALIDATE_SECONDS = 300
+
+    def __init__ (self, session, server_header, ip, port, callback):
+        self.session = session
+        self.server_header = server_header
+        self.ip = ip
+        self.port = port
+        self.callback = callback
+        self.state = IPState.UNKNOWN
+        self.rtt = None
+        self.failures = 0
+        self.backoff = FriendlyReachabilityProber.MIN_BACKOFF_SECONDS
+        self.message = None
+        self.sent = 0
+        self.timeout_id = None
+        self.probe ()
+
+
+    def probe (self):
+        uri = Soup.URI ()
+        uri.set_scheme ("http")
+        uri.set_host (self.ip)
+        uri.set_path ("/")
+        uri.set_port (self.port)
+
+        self.message = Soup.Message ()
+        self.message.set_property ("uri", uri)
+        self.message.set_property ("method", "HEAD")
+        self.sent = GLib.get_monotonic_time ()
+        self.session.queue_message (self.message, self.on_response, None)
+        self.timeout_id = GLib.timeout_add_seconds (FriendlyReachabilityProber.TIMEOUT_SECONDS,
+                                                    self.on_timeout)
+        return False
+
+
+    def on_timeout (self):
+        # on_response() gets called with the cancelled message
+        self.timeout_id = None
+        self.session.cancel_message (self.message, Status.CANCELLED)
+        return False
+
+
+    def on_response (self, session, message, data):
+        if (message != self.message):
+            return
+        self.message = None
+        if (self.timeout_id):
+            GLib.source_remove (self.timeout_id)
+            self.timeout_id = None
+
+        if (message.response_headers.get_one ("server") == self.server_header):
+            self.rtt = (GLib.get_monotonic_time () - self.sent) / 1000.0
+            self.failures = 0
+            self.backoff = FriendlyReachabilityProber.MIN_BACKOFF_SECONDS
+            delay = FriendlyReachabilityProber.REVALIDATE_SECONDS
+            self.set_state (IPState.AVAILABLE)
         else:
-            archive_name = os.path.join (temp_dir, "archive.zip")
-
-        cmd = ["7z",  "-y", "-tzip", "-bd", "-mx=7", "a", archive_name ]
-        flags = GLib.SpawnFlags.SEARCH_PATH | GLib.SpawnFlags.DO_NOT_REAP_CHILD
-        result = GLib.spawn_async (cmd + files, [],
-                                   GLib.get_current_dir (),
-                                   flags, None, None,
-                                   False, True, False)
-        self.out_7z = GLib.IOChannel (result[2])
-        self.out_7z.set_close_on_unref (True)
-        GLib.child_watch_add (result[0], self.on_child_process_exit, callback)
+            logging.info ("Probe of %s:%d failed: %d %s" % (self.ip, self.port,
+                          message.status_code, message.reason_phrase))
+            self.failures += 1
+            delay = self.backoff
+            self.backoff = min (2 * self.backoff,
+                                FriendlyReachabilityProber.MAX_BACKOFF_SECONDS)
+            if (self.failures >= FriendlyReachabilityProber.MAX_FAILURES):
+                self.set_state (IPState.UNAVAILABLE)
+
+        if (self.callback):
+            self.timeout_id = GLib.timeout_add_seconds (delay, self.probe)
+
+
+    def set_state (self, state):
+        if (state != self.state):
+            self.state = state
+            self.callback (self)
+
+
+    def stop (self):
+        self.callback = None
+        if (self.timeout_id):
+            GLib.source_remove (self.timeout_id)
+            self.timeout_id = None
+        if (self.message):
+            message = self.message
+            self.message = None
+            self.session.cancel_message (message, Status.CANCELLED)
+
+
+class FriendlyZeroconfService:
+
+    # Announces the server with avahi. The D-Bus calls are all made
+    # asynchronously one after another, 'callback' is called with an
+    # error message (or None) when the service has been registered.
+
+    def __init__ (self, name, port, stype="_http._tcp",
+                  domain="", host="", text="path=/", callback = None):
+
+        import avahi
+
+        self.avahi = avahi
+        self.callback = callback
+        self.group = None
+        self.closed = False
+        self.service = (avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, 0,
+                        name, stype, domain, host, port,
+                        avahi.string_array_to_txt_array([text]))
+
+        Gio.DBusProxy.new_for_bus (Gio.BusType.SYSTEM,
+                                   0,
+                                   None,
+                                   avahi.DBUS_NAME,
+                                   avahi.DBUS_PATH_SERVER,
+                                   avahi.DBUS_INTERFACE_SERVER,
+                                   None,
+                                   self.on_server_proxy,
+                                   None)
+
+    def on_server_proxy (self, source, result, data):
+        try:
+            server = Gio.DBusProxy.new_for_bus_finish (result)
+        except Exception as e:
+            self.on_error (None, e, None)
+            return
+        server.EntryGroupNew ("()",
+                              result_handler = self.on_entry_group_new,
+                              error_handler = self.on_error)
+
+    def on_entry_group_new (self, server, path, data):
+        Gio.DBusProxy.new_for_bus (Gio.BusType.SYSTEM,
+                                   0,
+                                   None,
+                                   self.avahi.DBUS_NAME,
+                                   path,
+                                   self.avahi.DBUS_INTERFACE_ENTRY_GROUP,
+                                   None,
+                                   self.on_group_proxy,
+                                   None)
+
+    def on_group_proxy (self, source, result, data):
+        try:
+            group = Gio.DBusProxy.new_for_bus_finish (result)
+        except Exception as e:
+            self.on_error (None, e, None)
+            return
+        if (self.closed):
+            return
+        self.group = group
+        self.group.AddService ("(iiussssqaay)", *self.service,
+                               result_handler = self.on_service_added,
+                               error_handler = self.on_error)
 
-        return archive_name
+    def on_service_added (self, group, result, data):
+        self.group.Commit ("()",
+                           result_handler = self.on_committed,
+                           error_handler = self.on_error)
 
-class FriendlyZeroconfService:
+    def on_committed (self, group, result, data):
+        if (self.callback):
+            self.callback (None)
 
-    def __init__ (self, name, port, stype="_http._tcp",
-                  domain="", host="", text="path=/"):
-
-        # these _should_ not block but async would still be proper
-
-        server = Gio.DBusProxy.new_for_bus_sync (Gio.BusType.SYSTEM,
-                                                 0,
-                                                 None,
-                                                 avahi.DBUS_NAME,
-                                                 avahi.DBUS_PATH_SERVER,
-                                                 avahi.DBUS_INTERFACE_SERVER,
-                                                 None)
-        self.group = Gio.DBusProxy.new_for_bus_sync (Gio.BusType.SYSTEM,
-                                                     0,
-                                                     None,
-                                                     avahi.DBUS_NAME,
-                                                     server.EntryGroupNew(),
-                                                     avahi.DBUS_INTERFACE_ENTRY_GROUP,
-                                                     None)
-        self. group.AddService ("(iiussssqaay)",
-                                avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, 0,
-                                name, stype, domain, host, port,
-                                avahi.string_array_to_txt_array([text]))
-        self.group.Commit ("()")
+    def on_error (self, proxy, error, data):
+        if (self.callback):
+            self.callback (str (error))
 
     def shutdown (self):
-        self.group.Reset ("()")
+        self.closed = True
+        if (self.group):
+            self.group.Reset ("()")
 
 
 class FriendlyFileServer ():
@@ -221,59 +3281,177 @@ class FriendlyFileServer ():
             raise AttributeError
 
 
-    def __init__ (self, port = 0, allow_uploads = False, change_callback = None):
+    def __init__ (self, port = 0, allow_uploads = False, change_callback = None,
+                  prepare_archives = False, archive_cache_size = 2048 * 1024 * 1024,
+                  share_individually = False, use_upnp = True, use_zeroconf = True,
+                  metrics = False, download_limiter = None, upload_limiter = None,
+                  max_downloads = 0, max_queued_downloads = 0, control_api = False,
+                  zero_copy = False, live_shares = False,
+                  variant_cache_size = FriendlyVariantCache.MAX_SIZE):
+
+        self.startup_log = FriendlyStartupLog ()
 
         # This should be a call to Soup.Server.__init__(), see note in __getattr__
         self._obj = GObject.new (Soup.Server,
                                  port = port,
                                  server_header = "friendly-file-server")
+        self.startup_log.end ("binding the port")
 
         self.allow_upload = allow_uploads
         self.change_callback = change_callback
-        self.shared_file = None
-        self.archive_state = ArchiveState.NA
+        # shares by token, 'share' is the primary share
+        self.shares = {}
+        self.share = None
+        self.share_individually = share_individually
+        self.control_api = control_api
+        self.zero_copy = zero_copy
+        self.live_shares = live_shares
+        self.download_count = 0
+        self.validator_cache = FriendlyValidatorCache ()
+        self.digest_cache = FriendlyDigestCache ()
+        self.variant_cache = FriendlyVariantCache (FriendlyCompressionPolicy (),
+                                                   max_size = variant_cache_size)
+        self.page_cache = FriendlyPageCache ()
+        self.metrics = FriendlyMetrics () if metrics else None
+        self.download_limiter = download_limiter
+        self.upload_limiter = upload_limiter
+        self.admission = None
+        if (max_downloads > 0):
+            self.admission = FriendlyAdmissionController (self, max_downloads,
+                                                          max_queued_downloads,
+                                                          self.on_queue_change)
+        self.username = GLib.get_real_name ()
+        self.preparing_archives = {}
         self.igd = None
-        try:
-            self.zipper = FriendlyZipper ()
-        except:
-            self.zipper = None
+        member_cache = None
+        if (live_shares):
+            # live archives are recreated often: keep the compressed
+            # members so only changed files are compressed again
+            member_cache = FriendlyMemberCache ()
+        self.zipper = FriendlyZipper (member_cache = member_cache)
+        self.archive_cache = None
+        if (prepare_archives):
+            self.archive_cache = FriendlyArchiveCache (archive_cache_size)
 
         self.upload_count = 0
         self.upload_bytes = 0
-        self.upload_dir = None
+        self.upload_dir = FriendlyUploadDirectory ()
+        self.partial_dir = None
+        self.resumable_uploads = {}
+        self.upload_receivers = {}
 
-        self.local_ip = find_ip ()
+        self.local_ip = None
         self.local_ip_state = IPState.UNKNOWN
+        self.upnp_ip = None
+        self.upnp_port = None
+        self.upnp_ip_state = IPState.UNAVAILABLE
+        self.upnp_requested_port = None
+        self.upnp_port_candidates = []
+        self.use_upnp = use_upnp
+        self.local_prober = None
+        self.upnp_prober = None
+        self.zeroconf = None
+        # set by shutdown(): callbacks from threads and services that
+        # arrive after it do nothing
+        self.closed = False
+        self.session = Soup.SessionAsync (timeout = 10)
 
         self.add_handler (None, self.on_soup_request, None)
+        self.connect ("request-started", self.on_soup_request_started)
+        self.run_async ()
+        self.startup_log.end ("starting the server")
+
+        # Everything else happens in the background: the server already
+        # answers requests while the address is looked up
+        self.startup_log.begin ("finding the local address")
+        thread = threading.Thread (target = self.find_ip_thread)
+        thread.daemon = True
+        thread.start ()
+
+        if (use_zeroconf):
+            try:
+                self.startup_log.begin ("zeroconf announcement")
+                name = self.username + "'s " + FFS_APP_NAME
+                self.zeroconf = FriendlyZeroconfService (name, self.get_port(),
+                                                         callback = self.on_zeroconf_done)
+            except:
+                self.zeroconf = None
+                self.startup_log.end ("zeroconf announcement", "not available")
+
+
+    def find_ip_thread (self):
+        try:
+            ip = find_ip ()
+        except (IOError, OSError):
+            # no network at all
+            ip = "127.0.0.1"
+        GLib.idle_add (self.on_ip_found, ip)
+
+
+    def on_ip_found (self, ip):
+        if (self.closed):
+            return False
+        self.startup_log.end ("finding the local address", ip)
+        self.local_ip = ip
         print ("Server starting, guessed uri http://%s:%d"
                % (self.local_ip, self.get_port ()))
-        self.run_async ()
 
-        # Is URI really available (at least from this machine)?
         self.confirm_uri (self.local_ip, self.get_port(), False)
+        self.start_upnp ()
+        self.change_callback ()
+        return False
 
-        self.upnp_ip = None
-        self.upnp_port = None
-        self.upnp_ip_state = IPState.UNAVAILABLE
+
+    def start_upnp (self):
+        self.startup_log.begin ("UPnP port mapping")
         try:
+            if (not self.use_upnp):
+                raise Exception ("UPnP disabled")
+            from gi.repository import GUPnPIgd
             self.igd = GUPnPIgd.SimpleIgd ()
             self.igd.connect ("mapped-external-port", self.on_igd_mapped_port)
             # FAILED: python/GI can't cope with signals with GError
             # self.igd.connect ("error-mapping-port", self.on_igd_error)
-            self.igd.add_port ("TCP",
-                            self.get_port (), # remote port really
-                               self.local_ip, self.get_port (),
-                               0, FFS_APP_NAME)
+
+            # external ports to try in order if the previous one looks
+            # blocked (some ISPs block non-standard ports)
+            self.upnp_port_candidates = [self.get_port ()]
+            for port in [8080, 80, 8000, 8888]:
+                if (port not in self.upnp_port_candidates):
+                    self.upnp_port_candidates.append (port)
+            self.map_next_upnp_port ()
         except:
             self.igd = None
             self.upnp_ip_state = IPState.UNKNOWN
+            self.startup_log.end ("UPnP port mapping", "not available")
+
+
+    def map_next_upnp_port (self):
+        # returns False if all candidate ports have been tried
+        if (self.upnp_requested_port):
+            self.igd.remove_port ("TCP", self.upnp_requested_port)
+        if (not self.upnp_port_candidates):
+            self.upnp_requested_port = None
+            return False
+        self.upnp_requested_port = self.upnp_port_candidates.pop (0)
+        self.igd.add_port ("TCP",
+                           self.upnp_requested_port, # remote port really
+                           self.local_ip, self.get_port (),
+                           0, FFS_APP_NAME)
+        return True
+
+
+    def on_zeroconf_done (self, error):
+        if (self.closed):
+            return
+        self.startup_log.end ("zeroconf announcement", error or "registered")
 
-        try:
-            name = GLib.get_real_name () + "'s " + FFS_APP_NAME
-            self.zeroconf = FriendlyZeroconfService (name, self.get_port())
-        except:
-            self.zeroconf = None
+
+    def get_local_uri (self):
+        # None until the local address is known
+        if (not self.local_ip):
+            return None
+        return "http://%s:%d" % (self.local_ip, self.get_port ())
 
 
     def can_share_multiple (self):
@@ -281,26 +3459,140 @@ class FriendlyFileServer ():
 
 
     def shutdown (self):
-        self.stop_sharing ()
+        self.closed = True
+        for share in list (self.shares.values ()):
+            self.remove_share (share)
+
+        for prober in [self.local_prober, self.upnp_prober]:
+            if (prober):
+                prober.stop ()
+        self.local_prober = None
+        self.upnp_prober = None
 
         if (self.igd):
-            self.igd.remove_port ("TCP", self.get_port ())
+            if (self.upnp_requested_port):
+                self.igd.remove_port ("TCP", self.upnp_requested_port)
             self.igd = None
 
         if (self.zeroconf):
             self.zeroconf.shutdown()
             self.zeroconf = None
 
+        if (self.zipper.member_cache):
+            self.zipper.member_cache.close ()
+
         self.disconnect ()
 
 
-    def on_soup_message_wrote_body (self, message):
-        self.download_finished_count += 1
+    def start_download (self, message, complete, share, stolen = False):
+        # 'complete' is False for partial downloads: they only count as
+        # finished downloads if they reach the end of the file. libsoup
+        # emits no signals for a 'stolen' connection, finish_download()
+        # is called when the transfer ends instead
+        if (not stolen):
+            if (complete):
+                message.connect ("wrote-body", self.on_soup_message_wrote_body, share)
+            message.connect ("finished", self.on_soup_message_download_finished, share)
+        share.download_count += 1
+        self.download_count += 1
+        self.change_callback ()
+
+
+    def on_soup_message_wrote_body (self, message, share):
+        share.download_finished_count += 1
+
+
+    def on_soup_message_download_finished (self, message, share):
+        # "finished" is emitted for aborted downloads as well
+        self.finish_download (share, False)
+
+
+    def finish_download (self, share, finished):
+        if (finished):
+            share.download_finished_count += 1
+        share.download_count -= 1
         self.download_count -= 1
         self.change_callback ()
 
 
+    def on_soup_request_started (self, server, message, client):
+        message.connect ("got-headers", self.on_soup_message_got_headers, client)
+        if (self.metrics):
+            self.metrics.track_request (message, client)
+
+
+    def on_soup_message_got_headers (self, message, client):
+        if (message.method == "PATCH"):
+            self.start_resumable_append (message, client)
+            return
+        if (message.method != "POST"):
+            return
+        if (self.is_control_request (message.get_uri ().get_path (), client)):
+            return
+
+        # Upload bodies are never accumulated in memory: a multipart
+        # body is parsed as it arrives and anything else is discarded
+        message.request_body.set_accumulate (False)
+
+        content_type, params = message.request_headers.get_content_type ()
+        if (not self.allow_upload or
+            message.get_uri ().get_path () != "/" or
+            content_type != "multipart/form-data" or
+            not params or not params.get ("boundary")):
+            return
+
+        receiver = FriendlyUploadReceiver (params["boundary"],
+                                           self.upload_dir.create)
+        self.upload_receivers[message] = receiver
+        message.connect ("got-chunk", self.on_soup_message_got_chunk,
+                         (receiver, client.get_host ()))
+        message.connect ("finished", self.on_soup_message_upload_finished)
+
+
+    def on_soup_message_got_chunk (self, message, chunk, data):
+        receiver, address = data
+        receiver.feed (chunk.get_data ())
+
+        if (self.upload_limiter):
+            delay = self.upload_limiter.get_delay (address, chunk.length)
+            if (delay > 0.001):
+                # stop reading the request body until the chunk is paid for
+                self.pause_message (message)
+                GLib.timeout_add (int (delay * 1000), self.on_upload_pacing_timeout, message)
+
+
+    def on_upload_pacing_timeout (self, message):
+        if (message in self.upload_receivers):
+            self.unpause_message (message)
+        return False
+
+
+    def on_soup_message_upload_finished (self, message):
+        # request was not handled (e.g. client disconnected mid-upload)
+        receiver = self.upload_receivers.pop (message, None)
+        if (receiver):
+            receiver.abort ()
+
+
     def on_soup_request (self, server, message, path, query, client, data):
+        if (path.startswith ("/uploads/")):
+            try:
+                self.handle_resumable_upload_request (message, path)
+            except:
+                logging.error ("Failed to handle upload request: Internal server error")
+                traceback.print_exc ()
+                message.set_status (Status.INTERNAL_SERVER_ERROR)
+            return
+
+        if (self.is_control_request (path, client)):
+            try:
+                self.handle_control_request (message, path)
+            except:
+                logging.error ("Failed to handle control request: Internal server error")
+                traceback.print_exc ()
+                message.set_status (Status.INTERNAL_SERVER_ERROR)
+            return
+
         if (message.method not in  ["POST", "GET", "HEAD"] or
             message.method == "POST" and path != "/"):
             message.set_status (Status.METHOD_NOT_ALLOWED)
@@ -318,27 +3610,70 @@ class FriendlyFileServer ():
         elif (path == "/favicon.ico"):
             # TODO: need an icon
             message.set_status (Status.NOT_FOUND)
+        elif (path == "/metrics" and self.metrics):
+            message.set_response ("text/plain; version=0.0.4", Soup.MemoryUse.COPY,
+                                  self.metrics.format (self.download_count).encode ("utf-8"))
+            message.set_status (Status.OK)
         else:
             try:
-                self.handle_download_request (message, path)
+                self.handle_download_request (message, path, client)
             except:
                 logging.error ("Failed to handle download request for '%s': Internal server error"
-                               % self.shared_file)
+                               % path)
                 traceback.print_exc ()
                 self.reply_request (message, Status.INTERNAL_SERVER_ERROR, FormInfo.DOWNLOAD_FAILURE)
                 return
 
 
-    def reply_request (self, message, status, form_info):
+    def reply_request (self, message, status, form_info, directory = None,
+                       share = None):
+        # pages show the primary share unless another one is given
+        share = share or self.share
+        if (share and share.share_index):
+            directory = directory or share.share_index.prefix
+        key = (self.allow_upload, form_info, directory,
+               share and (share.token, share.archive_state, share.shared_file))
+        page = self.page_cache.get (key, lambda: self.render_form (form_info, directory, share))
+
+        headers = message.response_headers
+        headers.replace ("Vary", "Accept-Encoding")
+        headers.replace ("Cache-Control", "no-cache")
+        headers.set_content_type ("text/html", None)
+
+        buf = page.buffer
+        etag = page.etag
+        accepted = parse_accept_encoding (message.request_headers.get_one ("Accept-Encoding"))
+        if (page.gzip_buffer and accepted.get ("gzip", 0) > 0):
+            buf = page.gzip_buffer
+            etag = etag[:-1] + "-gzip\""
+            headers.replace ("Content-Encoding", "gzip")
+        headers.replace ("ETag", etag)
+
+        if_none_match = message.request_headers.get_one ("If-None-Match")
+        if (status == Status.OK and etag_matches (if_none_match, etag)):
+            message.set_status (Status.NOT_MODIFIED)
+            return
+
+        message.response_body.truncate ()
+        message.response_body.append_buffer (buf)
+        message.set_status (status)
+
+
+    def render_form (self, form_info, directory, share):
+        if (not share):
+            return get_form (self.allow_upload, form_info, ArchiveState.NA,
+                             None, self.username)
         try:
-            basename = GLib.path_get_basename (self.shared_file)
+            basename = GLib.path_get_basename (share.shared_file)
         except:
             basename = None
-        form = get_form (self.allow_upload, form_info,
-                         self.archive_state, basename,
-                         GLib.get_real_name ())
-        message.set_response ("text/html", Soup.MemoryUse.COPY, form)
-        message.set_status (status)
+        listing = None
+        if (share.share_index):
+            listing = share.share_index.get_listing (directory)
+        href = "/1" if share == self.share else share.prefix
+        return get_form (self.allow_upload, form_info,
+                         share.archive_state, basename,
+                         self.username, listing, href)
 
 
     def handle_upload_request (self, message):
@@ -346,80 +3681,648 @@ class FriendlyFileServer ():
             self.reply_request (message, Status.FORBIDDEN, FormInfo.NO_INFO)
             return
 
-        mp = Soup.Multipart.new_from_message (message.request_headers,
-                                              message.request_body)
-        [has_part, header, body] = mp.get_part (0)
-        if (not has_part):
+        receiver = self.upload_receivers.pop (message, None)
+        if (not receiver or not receiver.is_complete () or not receiver.files):
+            if (receiver):
+                receiver.abort ()
             self.reply_request (message, Status.BAD_REQUEST, FormInfo.UPLOAD_FAILURE)
             return
 
-        data = body.get_data ()
-        [has_cd, cd, params] = header.get_content_disposition ()
-
-        basename = "Upload"
-        if (has_cd):
-            basename = params["filename"]
-        new_filename = self.get_upload_filename (basename)
+        self.reply_request (message, Status.OK, FormInfo.UPLOAD_SUCCESS)
+        for [basename, filename, size, digest] in receiver.files:
+            self.add_upload (basename, filename, size, digest)
+        self.change_callback ()
 
-        with open (new_filename, "w") as f:
-            f.write (data)
 
-        self.reply_request (message, Status.OK, FormInfo.UPLOAD_SUCCESS)
+    def add_upload (self, basename, filename, size, digest):
+        # An upload that is identical to an earlier one is not kept:
+        # the digest was computed while the data arrived
         self.upload_count += 1
-        self.upload_bytes += len(data)
-        print "Received upload %s" % basename
+        self.upload_bytes += size
+        duplicate = None
+        if (digest):
+            duplicate = self.digest_cache.find (digest, size,
+                                                self.upload_dir.get_base_dir ())
+        if (duplicate and duplicate != filename):
+            try:
+                os.remove (filename)
+                print ("Received upload %s (identical to %s)" % (basename, duplicate))
+                return
+            except OSError:
+                logging.warning ("Failed to remove duplicate upload %s" % filename)
+        if (digest):
+            self.digest_cache.add (filename, digest)
+        else:
+            self.digest_cache.prepare ([filename])
+        print ("Received upload %s" % basename)
+
+
+    def get_partial_dir (self):
+        if (not self.partial_dir):
+            partial_dir = os.path.join (self.upload_dir.get_base_dir (), ".partial")
+            if (not os.path.isdir (partial_dir)):
+                os.makedirs (partial_dir)
+            FriendlyResumableUpload.remove_expired (partial_dir)
+            self.partial_dir = partial_dir
+        return self.partial_dir
+
+
+    def remove_expired_uploads (self):
+        partial_dir = self.get_partial_dir ()
+        FriendlyResumableUpload.remove_expired (partial_dir)
+        for upload_id, upload in list (self.resumable_uploads.items ()):
+            if (not upload.is_active () and not os.path.isfile (upload.path)):
+                del self.resumable_uploads[upload_id]
+
+
+    def get_resumable_upload (self, upload_id):
+        upload = self.resumable_uploads.get (upload_id)
+        if (not upload and len (upload_id) == 32 and
+            all (c in "0123456789abcdef" for c in upload_id)):
+            # partial uploads survive restarts
+            upload = FriendlyResumableUpload.load (self.get_partial_dir (), upload_id)
+            if (upload):
+                self.resumable_uploads[upload_id] = upload
+        return upload
+
+
+    def start_resumable_append (self, message, client):
+        # got-headers of a PATCH: the body is written to the partial
+        # file as it arrives if the request is acceptable
+        message.request_body.set_accumulate (False)
+        path = message.get_uri ().get_path ()
+        if (not self.allow_upload or not path.startswith ("/uploads/")):
+            return
+        upload = self.get_resumable_upload (path[len ("/uploads/"):])
+        content_type, params = message.request_headers.get_content_type ()
+        if (not upload or upload.is_active () or
+            content_type != "application/offset+octet-stream" or
+            message.request_headers.get_one ("Upload-Offset") != str (upload.offset)):
+            return
+
+        upload.begin ()
+        self.upload_receivers[message] = upload
+        message.connect ("got-chunk", self.on_soup_message_got_chunk,
+                         (upload, client.get_host ()))
+        message.connect ("finished", self.on_soup_message_upload_finished)
+
+
+    def handle_resumable_upload_request (self, message, path):
+        headers = message.response_headers
+        headers.replace ("Tus-Resumable", "1.0.0")
+        headers.replace ("Cache-Control", "no-store")
+        if (message.method == "OPTIONS"):
+            headers.replace ("Tus-Version", "1.0.0")
+            headers.replace ("Tus-Extension", "creation")
+            message.set_status (Status.NO_CONTENT)
+            return
+
+        if (not self.allow_upload):
+            message.set_status (Status.FORBIDDEN)
+            return
+
+        if (path == "/uploads/"):
+            if (message.method != "POST"):
+                message.set_status (Status.METHOD_NOT_ALLOWED)
+                return
+            self.create_resumable_upload (message)
+            return
+
+        upload = self.get_resumable_upload (path[len ("/uploads/"):])
+        if (not upload):
+            message.set_status (Status.NOT_FOUND)
+        elif (message.method == "HEAD"):
+            headers.replace ("Upload-Offset", str (upload.offset))
+            headers.replace ("Upload-Length", str (upload.length))
+            message.set_status (Status.OK)
+        elif (message.method == "PATCH"):
+            self.append_resumable_upload (message, upload)
+        else:
+            message.set_status (Status.METHOD_NOT_ALLOWED)
+
+
+    def create_resumable_upload (self, message):
+        try:
+            length = int (message.request_headers.get_one ("Upload-Length"))
+        except (TypeError, ValueError):
+            length = -1
+        if (length < 0):
+            message.set_status (Status.BAD_REQUEST)
+            return
+
+        # Upload-Metadata is "key base64value,key base64value"
+        basename = None
+        for item in (message.request_headers.get_one ("Upload-Metadata") or "").split (","):
+            key, sep, value = item.strip ().partition (" ")
+            if (key == "filename"):
+                try:
+                    basename = base64.b64decode (value).decode ("utf-8")
+                except (TypeError, ValueError):
+                    pass
+        # some browsers send the full path of the file
+        basename = os.path.basename ((basename or "").replace ("\\", "/"))
+        if (not basename or basename in [".", ".."]):
+            basename = "Upload"
+
+        partial_dir = self.get_partial_dir ()
+        self.remove_expired_uploads ()
+        if (not FriendlyResumableUpload.has_space (partial_dir, length)):
+            message.set_status (Status.REQUEST_ENTITY_TOO_LARGE)
+            return
+        try:
+            upload = FriendlyResumableUpload.create (partial_dir, basename, length)
+        except (IOError, OSError) as e:
+            logging.warning ("Failed to create upload %s: %s" % (basename, e))
+            if (e.errno in (errno.ENOSPC, errno.EFBIG)):
+                message.set_status (Status.REQUEST_ENTITY_TOO_LARGE)
+            else:
+                message.set_status (Status.INTERNAL_SERVER_ERROR)
+            return
+        self.resumable_uploads[upload.id] = upload
+        message.response_headers.replace ("Location", "/uploads/" + upload.id)
+        message.set_status (Status.CREATED)
+        if (upload.is_complete ()):
+            self.finish_resumable_upload (upload)
+
+
+    def append_resumable_upload (self, message, upload):
+        headers = message.response_headers
+        if (self.upload_receivers.pop (message, None) != upload):
+            # not accepted in start_resumable_append ()
+            content_type, params = message.request_headers.get_content_type ()
+            if (content_type != "application/offset+octet-stream"):
+                message.set_status (Status.UNSUPPORTED_MEDIA_TYPE)
+            else:
+                headers.replace ("Upload-Offset", str (upload.offset))
+                message.set_status (Status.CONFLICT)
+            return
+
+        upload.end ()
+        headers.replace ("Upload-Offset", str (upload.offset))
+        if (upload.failed):
+            message.set_status (Status.INTERNAL_SERVER_ERROR)
+            return
+        message.set_status (Status.NO_CONTENT)
+        if (upload.is_complete ()):
+            self.finish_resumable_upload (upload)
+
+
+    def finish_resumable_upload (self, upload):
+        # move the complete file into the upload directory
+        filename, f = self.upload_dir.create (upload.filename)
+        f.close ()
+        os.rename (upload.path, filename)
+        upload.remove ()
+        del self.resumable_uploads[upload.id]
+
+        self.add_upload (upload.filename, filename, upload.length,
+                         upload.get_digest ())
         self.change_callback ()
 
 
-    def handle_download_request (self, message, path):
-        # could handle multiple files here ...
-        if (path != "/1" or not self.shared_file):
+    def handle_download_request (self, message, path, client):
+        # The first part of the path is the share token, "1" for the
+        # primary share. The rest is looked up in the share's own URLs
+        token, sep, rest = path[1:].partition ("/")
+        if (not sep and token.endswith (".sha256")):
+            self.handle_manifest_request (message, token[:-len (".sha256")])
+            return
+        if (not sep and token.endswith (".chunks")):
+            self.handle_chunks_request (message, token[:-len (".chunks")])
+            return
+        share = self.share if token == "1" else self.shares.get (token)
+        if (not share):
             self.reply_request (message, Status.NOT_FOUND, FormInfo.DOWNLOAD_NOT_FOUND)
             return
+        path = share.prefix + sep + rest
+
+        if (share.share_index):
+            self.handle_index_request (message, path, client, share)
+            return
+
+        if (path != share.prefix or not share.shared_file):
+            self.reply_request (message, Status.NOT_FOUND, FormInfo.DOWNLOAD_NOT_FOUND,
+                                share = share)
+            return
+
+        if (share.archive_state == ArchiveState.PREPARING):
+            self.reply_request (message, Status.ACCEPTED, FormInfo.PREPARING_DOWNLOAD,
+                                share = share)
+            return
 
-        if (self.archive_state == ArchiveState.PREPARING):
-            self.reply_request (message, Status.ACCEPTED, FormInfo.PREPARING_DOWNLOAD)
+        if (share.archive_state == ArchiveState.STREAMING):
+            self.handle_archive_stream_request (message, client, share)
             return
 
-        shared_content = GLib.file_get_contents (self.shared_file)[1]
+        self.send_file (message, client, share, share.shared_file, negotiate = True)
 
+
+    def handle_index_request (self, message, path, client, share):
+        index = share.share_index
+        if (not path.endswith ("/") and index.is_directory (path + "/")):
+            path += "/"
+        if (index.is_directory (path)):
+            self.reply_request (message, Status.OK, FormInfo.NO_INFO, path, share)
+            return
+
+        entry = index.lookup (path)
+        if (not entry):
+            self.reply_request (message, Status.NOT_FOUND, FormInfo.DOWNLOAD_NOT_FOUND,
+                                share = share)
+            return
+        self.send_file (message, client, share, entry.path, entry.content_type)
+
+
+    def send_file (self, message, client, share, filename, content_type = None,
+                   negotiate = False):
+        validators = self.validator_cache.get (filename)
+        size = validators.size
+        headers = message.response_headers
+        headers.replace ("Accept-Ranges", "bytes")
+        headers.replace ("Last-Modified", validators.last_modified)
+
+        # Compressed responses are only sent for requests without a Range
+        encoding, variant = None, None
+        if (negotiate and self.variant_cache.is_compressible (filename, validators)):
+            headers.replace ("Vary", "Accept-Encoding")
+            if (not message.request_headers.get_one ("Range")):
+                encoding, variant = self.negotiate_encoding (message, filename,
+                                                             validators)
+        if (encoding):
+            validators = validators._replace (etag = validators.etag[:-1] +
+                                              "-" + encoding + "\"")
+        headers.replace ("ETag", validators.etag)
+        if (not encoding):
+            # the digest of the whole file, also for range requests
+            digest = self.digest_cache.lookup (filename)
+            if (digest):
+                value = get_digest_header_value (digest)
+                headers.replace ("Digest", "sha-256=" + value)
+                headers.replace ("Repr-Digest", "sha-256=:" + value + ":")
+
+        if (self.is_not_modified (message, validators)):
+            message.set_status (Status.NOT_MODIFIED)
+            return
+
+        ranges = self.get_requested_ranges (message, size,
+                                            (validators.etag,
+                                             validators.last_modified))
+        if (ranges == []):
+            headers.replace ("Content-Range", "bytes */%d" % size)
+            message.set_status (Status.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return
+
+        attachment = {"filename": GLib.path_get_basename (filename)}
+        headers.set_content_disposition ("attachment", attachment)
+        content_type = content_type or "application/octet-stream"
+
+        if (encoding):
+            headers.replace ("Content-Encoding", encoding)
+            headers.set_content_type (content_type, None)
+            message.set_status (Status.OK)
+            if (variant):
+                if (message.method == "HEAD"):
+                    headers.set_content_length (os.path.getsize (variant))
+                    return
+                create_source = lambda: FriendlyFileReader (variant)
+            else:
+                if (message.method == "HEAD"):
+                    headers.set_encoding (Soup.Encoding.CHUNKED)
+                    return
+                level = self.variant_cache.policy.compress_level
+                create_source = lambda: FriendlyGzipStream (FriendlyFileReader (filename),
+                                                            level)
+            self.stream_download (message, client, share, create_source, True)
+            return
+
+        if (message.method == "HEAD"):
+            # answered from the validator cache, the file is not opened
+            headers.set_content_length (size)
+            headers.set_content_type (content_type, None)
+            message.set_status (Status.OK)
+            return
+
+        if (ranges == None):
+            spans = None
+            headers.set_content_type (content_type, None)
+            message.set_status (Status.OK)
+        elif (len (ranges) == 1):
+            start, end = ranges[0]
+            spans = [(start, end - start + 1)]
+            headers.set_content_type (content_type, None)
+            headers.replace ("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, size))
+            message.set_status (Status.PARTIAL_CONTENT)
+        else:
+            boundary = binascii.hexlify (os.urandom (16)).decode ("ascii")
+            spans = []
+            for (start, end) in ranges:
+                part_header = ("\r\n--%s\r\n"
+                               "Content-Type: %s\r\n"
+                               "Content-Range: bytes %d-%d/%d\r\n\r\n"
+                               % (boundary, content_type, start, end, size))
+                spans.append (part_header.encode ("ascii"))
+                spans.append ((start, end - start + 1))
+            spans.append (("\r\n--%s--\r\n" % boundary).encode ("ascii"))
+            headers.set_content_type ("multipart/byteranges",
+                                      {"boundary": boundary})
+            message.set_status (Status.PARTIAL_CONTENT)
+
+        sendfile_span = None
+        if (ranges == None):
+            sendfile_span = (filename, 0, size)
+        elif (len (ranges) == 1):
+            sendfile_span = (filename, ranges[0][0], ranges[0][1] - ranges[0][0] + 1)
+        self.stream_download (message, client, share,
+                              lambda: FriendlyFileReader (filename, spans),
+                              ranges == None or ranges[-1][1] == size - 1,
+                              sendfile_span)
+
+
+    def negotiate_encoding (self, message, filename, validators):
+        # Returns the content encoding and the variant file to send.
+        # The variant is None if the response is gzipped on the fly
+        accepted = parse_accept_encoding (message.request_headers.get_one ("Accept-Encoding"))
+        self.variant_cache.prepare (filename, validators)
+
+        best_q, best_encoding, best_variant = 0, None, None
+        for encoding in self.variant_cache.encodings:
+            q = accepted.get (encoding, 0)
+            if (q <= 0 or q < best_q):
+                continue
+            variant = self.variant_cache.lookup (filename, validators, encoding)
+            if (not variant and encoding != "gzip"):
+                continue
+            best_q, best_encoding, best_variant = q, encoding, variant
+        return (best_encoding, best_variant)
+
+
+    def stream_download (self, message, client, share, create_source, complete,
+                         sendfile_span = None):
+        # The source is only created (and the file opened) once the
+        # admission controller lets the download start. 'sendfile_span'
+        # is the (filename, offset, length) of a plain file response
+        def start ():
+            f = None
+            try:
+                if (sendfile_span and self.can_sendfile (client)):
+                    f = open (sendfile_span[0], "rb")
+                    head = self.get_response_head (message, sendfile_span[2])
+                    gsocket = client.get_gsocket ()
+                else:
+                    FriendlyStreamer (self, message, client, create_source ())
+            except:
+                if (f):
+                    f.close ()
+                logging.error ("Failed to start download: Internal server error")
+                traceback.print_exc ()
+                message.response_headers.clear ()
+                self.reply_request (message, Status.INTERNAL_SERVER_ERROR, FormInfo.DOWNLOAD_FAILURE,
+                                    share = share)
+                return False
+            if (not f):
+                self.start_download (message, complete, share)
+                return False
+
+            def on_finished (sent_all):
+                self.finish_download (share, complete and sent_all)
+                if (self.admission):
+                    self.admission.release (message)
+
+            self.start_download (message, complete, share, True)
+            self.send_with_sendfile (message, client, gsocket, head, f,
+                                     sendfile_span[1], sendfile_span[2], on_finished)
+            return True
+
+        if (not self.admission):
+            start ()
+        elif (not self.admission.admit (message, start)):
+            message.response_headers.clear ()
+            message.response_headers.replace ("Retry-After",
+                                              str (self.admission.get_retry_after ()))
+            self.reply_request (message, Status.SERVICE_UNAVAILABLE, FormInfo.SERVER_BUSY,
+                                share = share)
+
+
+    def can_sendfile (self, client):
+        # stealing the connection needs libsoup 2.50
+        return (self.zero_copy and hasattr (os, "sendfile") and
+                hasattr (client, "steal_connection") and
+                hasattr (client, "get_gsocket"))
+
+
+    def send_with_sendfile (self, message, client, gsocket, head, f, offset, length,
+                            finished_callback):
+        # libsoup emits no message signals for a stolen connection: the
+        # metrics are recorded here and 'finished_callback (complete)'
+        # does the rest of the download bookkeeping, also if the
+        # transfer cannot be started
+        def on_finished (complete, sent, head_time, first_byte_time):
+            if (self.metrics):
+                self.metrics.record_sent (message, sent, head_time, first_byte_time)
+            finished_callback (complete)
+
+        address = client.get_host ()
+        stream = None
+        try:
+            stream = client.steal_connection ()
+            FriendlySendfileTransfer (self, stream, gsocket, address, head, f,
+                                      offset, length, on_finished)
+        except:
+            logging.error ("Failed to start download on the stolen connection")
+            traceback.print_exc ()
+            f.close ()
+            try:
+                if (stream):
+                    stream.close (None)
+                else:
+                    gsocket.close ()
+            except:
+                pass
+            on_finished (False, 0, None, None)
+
+
+    def get_response_head (self, message, length):
+        if (message.get_http_version () == Soup.HTTPVersion.HTTP_1_0):
+            version = "HTTP/1.0"
+        else:
+            version = "HTTP/1.1"
+        lines = ["%s %d %s" % (version, message.status_code,
+                               Soup.status_get_phrase (message.status_code))]
+        message.response_headers.foreach (lambda name, value, data:
+                                          lines.append ("%s: %s" % (name, value)),
+                                          None)
+        lines.append ("Date: %s" % Soup.Date.new_from_now (0).to_string (Soup.DateFormat.HTTP))
+        lines.append ("Server: %s" % self.get_property ("server-header"))
+        lines.append ("Content-Length: %d" % length)
+        # the connection cannot be given back to libsoup
+        lines.append ("Connection: close")
+        return ("\r\n".join (lines) + "\r\n\r\n").encode ("utf-8")
+
+
+    def on_queue_change (self):
+        self.change_callback ()
+
+
+    def handle_manifest_request (self, message, token):
+        # "/<token>.sha256": the checksums of the share's files in the
+        # format of sha256sum. Streamed archives have no checksum.
+        share = self.share if token == "1" else self.shares.get (token)
+        if (share and share.archive_state == ArchiveState.PREPARING):
+            message.response_headers.replace ("Retry-After", "5")
+            message.set_status (Status.ACCEPTED)
+            return
+        files = self.get_checksum_files (share) if share else []
+        if (not files):
+            message.set_status (Status.NOT_FOUND)
+            return
+
+        lines = []
+        for path, name in files:
+            digest = self.digest_cache.lookup (path)
+            if (not digest):
+                self.digest_cache.prepare ([path for path, name in files])
+                message.response_headers.replace ("Retry-After", "5")
+                message.set_status (Status.ACCEPTED)
+                return
+            lines.append ("%s  %s\n" % (digest, name))
+        message.response_headers.replace ("Cache-Control", "no-cache")
+        message.set_response ("text/plain; charset=utf-8", Soup.MemoryUse.COPY,
+                              "".join (lines).encode ("utf-8"))
         message.set_status (Status.OK)
-        attachment = {"filename": GLib.path_get_basename (self.shared_file)}
+
+
+    def handle_chunks_request (self, message, token):
+        # "/<token>.chunks": the content-defined chunks of a shared file
+        # as JSON, so that a client with an older copy of the file can
+        # fetch only the chunks it does not have ("ffs.py --fetch")
+        share = self.share if token == "1" else self.shares.get (token)
+        if (share and share.archive_state == ArchiveState.PREPARING):
+            message.response_headers.replace ("Retry-After", "5")
+            message.set_status (Status.ACCEPTED)
+            return
+        files = self.get_checksum_files (share) if share else []
+        if (len (files) != 1 or share.share_index):
+            message.set_status (Status.NOT_FOUND)
+            return
+
+        path, name = files[0]
+        chunks = self.digest_cache.lookup_chunks (path)
+        digest = self.digest_cache.lookup (path)
+        if (chunks == None or digest == None):
+            self.digest_cache.prepare ([path])
+            message.response_headers.replace ("Retry-After", "5")
+            message.set_status (Status.ACCEPTED)
+            return
+        manifest = {"name": name,
+                    "size": sum (chunk[1] for chunk in chunks),
+                    "sha256": digest,
+                    "chunks": chunks}
+        message.response_headers.replace ("Cache-Control", "no-cache")
+        message.set_response ("application/json", Soup.MemoryUse.COPY,
+                              json.dumps (manifest).encode ("utf-8"))
+        message.set_status (Status.OK)
+
+
+    def get_checksum_files (self, share):
+        # (path, name in the manifest) of every file that has a checksum
+        if (share.share_index):
+            index = share.share_index
+            return [(entry.path, url[len (index.prefix):])
+                    for url, entry in sorted (index.entries.items ())
+                    if entry.size != None]
+        if (not share.shared_file or share.archive_state in (ArchiveState.STREAMING,
+                                                             ArchiveState.PREPARING)):
+            return []
+        return [(share.shared_file, GLib.path_get_basename (share.shared_file))]
+
+
+    def handle_archive_stream_request (self, message, client, share):
+        # The archive is created while it is being sent, so its length
+        # is not known and ranges cannot be supported
+        message.response_headers.replace ("Accept-Ranges", "none")
+        attachment = {"filename": GLib.path_get_basename (share.shared_file)}
         message.response_headers.set_content_disposition ("attachment", attachment)
-        message.response_body.append_buffer (Soup.Buffer.new (shared_content))
+        message.response_headers.set_content_type ("application/zip", None)
+        message.set_status (Status.OK)
+        if (message.method == "HEAD"):
+            return
 
-        message.connect ("wrote-body", self.on_soup_message_wrote_body)
-        self.download_count += 1
-        self.change_callback ()
+        selection = share.shared_selection
+        self.stream_download (message, client, share,
+                              lambda: self.zipper.create_stream (selection), True)
 
 
-    def on_test_response (self, session, message, is_upnp):
-        state = IPState.UNAVAILABLE
-        if (message.response_headers.get_one ("server") == self.get_property ("server-header")):
-            state = IPState.AVAILABLE
+    def is_not_modified (self, message, validators):
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = message.request_headers.get_one ("If-None-Match")
+        if (if_none_match):
+            return etag_matches (if_none_match, validators.etag)
 
-        if (is_upnp):
-            self.upnp_ip_state = state
-            if (state == IPState.AVAILABLE):
-                print ("Port-forward confirmed to work ")
+        if_modified_since = message.request_headers.get_one ("If-Modified-Since")
+        if (if_modified_since):
+            date = Soup.Date.new_from_string (if_modified_since)
+            if (date and date.to_time_t () >= validators.mtime):
+                return True
+        return False
+
+
+    def get_requested_ranges (self, message, size, validators):
+        # Returns the byte ranges to send, None for the full file
+        if (message.method != "GET"):
+            return None
+        range_header = message.request_headers.get_one ("Range")
+        if (not range_header):
+            return None
+
+        # If-Range contains either an ETag or a date: if it does not
+        # match the current file, the client must get the full file
+        if_range = message.request_headers.get_one ("If-Range")
+        if (if_range and if_range.strip () not in validators):
+            return None
+
+        return parse_range_header (range_header, size)
+
+
+    def on_probe_change (self, prober):
+        is_upnp = (prober == self.upnp_prober)
+        available = (prober.state == IPState.AVAILABLE)
+        self.startup_log.end ("%s self-test" % ("UPnP" if is_upnp else "local"),
+                              "%.1f ms round trip" % prober.rtt if available
+                              else "unreachable")
+
+        if (not is_upnp):
+            self.local_ip_state = prober.state
+        elif (available):
+            self.upnp_ip_state = prober.state
+            print ("Port-forward confirmed to work ")
+        elif (self.igd and self.map_next_upnp_port ()):
+            # forwarded port looks blocked, on_igd_mapped_port() tests
+            # the next one
+            logging.info ("Port %d seems blocked, trying port %d"
+                          % (prober.port, self.upnp_requested_port))
+            prober.stop ()
+            self.upnp_prober = None
+            self.upnp_ip_state = IPState.UNKNOWN
         else:
-            self.local_ip_state = state
+            self.upnp_ip_state = prober.state
         self.change_callback ()
 
 
     def confirm_uri (self, ip, port, is_upnp):
-        uri = Soup.URI ()
-        uri.set_scheme ("http")
-        uri.set_host (ip)
-        uri.set_path ("/")
-        uri.set_port (port)
-
-        msg = Soup.Message ()
-        msg.set_property ("uri", uri)
-        msg.set_property ("method", "HEAD")
-
-        session = Soup.SessionSync ()
-        session.queue_message (msg, self.on_test_response, is_upnp)
+        # Is the URI really available (at least from this machine)?
+        prober = FriendlyReachabilityProber (self.session,
+                                             self.get_property ("server-header"),
+                                             ip, port, self.on_probe_change)
+        if (is_upnp):
+            if (self.upnp_prober):
+                self.upnp_prober.stop ()
+            self.upnp_prober = prober
+        else:
+            if (self.local_prober):
+                self.local_prober.stop ()
+            self.local_prober = prober
+        self.startup_log.begin ("%s self-test" % ("UPnP" if is_upnp else "local"))
 
 
     def on_igd_error (self, igd, err, proto, ep, lip, lp, msg):
@@ -431,12 +4334,15 @@ class FriendlyFileServer ():
                             ext_ip, old_ext_ip, ext_port,
                             local_ip, local_port,
                             desc):
+        if (self.closed):
+            return
         if(self.upnp_ip_state == IPState.AVAILABLE and
            self.upnp_ip == ext_ip and
            self.upnp_port == ext_port):
             return
 
         print ("Port-forwarded http://%s:%d" % (ext_ip, ext_port))
+        self.startup_log.end ("UPnP port mapping", "%s:%d" % (ext_ip, ext_port))
         self.upnp_ip = ext_ip
         self.upnp_port = ext_port
         self.upnp_ip_state = IPState.UNKNOWN
@@ -444,84 +4350,307 @@ class FriendlyFileServer ():
 
 
     def start_sharing (self, files):
-        if (self.shared_file != None):
+        # (re)sets the primary share
+        if (self.share != None):
             self.stop_sharing ()
+        self.share = self.add_share (files)
+        self.change_callback ()
+
+
+    def add_share (self, files, lifetime = None, individually = None):
+        share = FriendlyShare (files, lifetime)
+        if (individually == None):
+            individually = self.share_individually
 
         if (len (files) > 1 or GLib.file_test (files[0], GLib.FileTest.IS_DIR)):
-            self.archive_state = ArchiveState.FAILED
-            self.shared_file = self.zipper.create_archive (files, self.on_archive_ready)
-            self.archive_state = ArchiveState.PREPARING
+            if (individually):
+                share.archive_state = ArchiveState.NA
+                share.share_index = FriendlyShareIndex (files, share.prefix + "/")
+                share.shared_file = share.share_index.name
+            elif (self.archive_cache):
+                self.start_sharing_archive (share, files)
+            else:
+                share.archive_state = ArchiveState.STREAMING
+                share.shared_selection = files
+                share.shared_file = get_archive_name (files)
+            if (self.live_shares):
+                share.monitor = FriendlyTreeMonitor (
+                    files, lambda paths: self.on_share_files_changed (share, paths))
         elif (len (files) == 1):
-            self.archive_state = ArchiveState.NA
-            self.shared_file = files[0]
-
-        self.download_count = 0
-        self.download_finished_count = 0
+            share.archive_state = ArchiveState.NA
+            share.shared_file = files[0]
+            try:
+                validators = self.validator_cache.get (share.shared_file)
+                self.variant_cache.prepare (share.shared_file, validators)
+            except OSError:
+                pass
+
+        self.digest_cache.prepare (path for path, name in self.get_checksum_files (share))
+        self.shares[share.token] = share
+        if (lifetime):
+            share.timeout_id = GLib.timeout_add_seconds (lifetime,
+                                                         self.on_share_expired,
+                                                         share)
+        self.page_cache.invalidate ()
+        return share
+
+
+    def start_sharing_archive (self, share, files):
+        # the share is preparing until the key has been computed like
+        # for a live update, then it gets a cached or a new archive
+        share.archive_state = ArchiveState.PREPARING
+        share.shared_file = get_archive_name (files)
+        self.update_archive (share)
+
+
+    def prepare_archive (self, key, files):
+        if (key not in self.preparing_archives):
+            directory = self.archive_cache.get_directory (key)
+            started = GLib.get_monotonic_time ()
+            def on_ready (state):
+                if (self.metrics):
+                    self.metrics.archive_prepared (GLib.get_monotonic_time () - started)
+                self.on_archive_ready (key, archive, state)
+            archive = self.zipper.create_archive (files, directory, on_ready)
+            self.preparing_archives[key] = archive
+        return self.preparing_archives[key]
+
+
+    def on_share_files_changed (self, share, paths):
+        if (share.token not in self.shares):
+            return
+        if (share.share_index):
+            for path in paths:
+                share.share_index.update (path)
+                self.validator_cache.forget (path)
+            share.shared_file = share.share_index.name
+            self.digest_cache.prepare (path for path in paths if os.path.isfile (path))
+        elif (share.archive_key):
+            self.update_archive (share)
+        # streamed archives are created when they are requested, so they
+        # are always up to date
+        self.page_cache.invalidate ()
         self.change_callback ()
 
 
-    def stop_sharing (self):
-        if (self.archive_state != ArchiveState.NA):
-            try:
-                os.remove (self.shared_file)
-                os.rmdir (GLib.path_get_dirname (self.shared_file))
-            except :
-                logging.warning ("Failed to remove temporary archive")
+    def update_archive (self, share):
+        # The current archive is served until the new one is ready. The
+        # member cache means only the changed files are compressed. The
+        # key stats the whole tree, so it is computed in a thread; only
+        # the result of the latest update is used. A share without an
+        # archive yet fails if the key cannot be computed.
+        share.archive_update += 1
+        thread = threading.Thread (target = self.find_archive_key_thread,
+                                   args = (share, share.archive_update))
+        thread.daemon = True
+        thread.start ()
 
-        self.shared_file = None
+
+    def find_archive_key_thread (self, share, update):
+        try:
+            key = self.archive_cache.get_key (share.files)
+        except OSError:
+            # changed while it was read: the monitor will report it again
+            logging.warning ("Failed to read the shared files")
+            key = None
+        GLib.idle_add (self.on_archive_key_found, share, update, key)
+
+
+    def on_archive_key_found (self, share, update, key):
+        if (update != share.archive_update or share.token not in self.shares):
+            return False
+        if (not key):
+            if (not share.archive_key):
+                share.archive_state = ArchiveState.FAILED
+                share.shared_file = None
+                self.change_callback ()
+            return False
+        if (key == share.archive_key or key == share.next_archive_key):
+            return False
+
+        share.next_archive_key = key
+        archive = self.archive_cache.lookup (key)
+        if (archive):
+            self.replace_archive (share, key, archive)
+        else:
+            self.prepare_archive (key, share.files)
         self.change_callback ()
+        return False
 
 
-    def get_upload_filename (self, basename):
-        if (not self.upload_dir):
-            dl_dir = GLib.get_user_special_dir (GLib.UserDirectory.DIRECTORY_DOWNLOAD)
-            dirname = os.path.join (dl_dir, "%s Uploads" % FFS_APP_NAME)
+    def replace_archive (self, share, key, archive):
+        old_key = share.archive_key
+        share.archive_key = key
+        share.next_archive_key = None
+        share.shared_file = archive
+        share.archive_state = ArchiveState.READY
+        self.digest_cache.prepare ([archive])
+        # an old archive that is still being prepared is released in
+        # on_archive_ready()
+        if (old_key and old_key not in self.preparing_archives and
+            not self.get_archive_shares (old_key)):
+            self.archive_cache.release (old_key)
 
-            for i in range (2, 1000):
-                try:
-                    os.makedirs (dirname)
-                    self.upload_dir = dirname
-                    break
-                except os.error:
-                    dirname = os.path.join (dl_dir, "%s Uploads(%d)" % (FFS_APP_NAME, i))
-            if (not self.upload_dir): raise Exception
 
-        fn, ext = os.path.splitext (basename)
-        new_fn = os.path.join (self.upload_dir, "%s" % basename)
+    def stop_sharing (self):
+        if (self.share):
+            self.remove_share (self.share)
+        self.change_callback ()
+
+
+    def remove_share (self, share):
+        # Downloads that are in progress are not interrupted. Archives
+        # stay in the cache; one that is still being prepared is added
+        # to the cache when it is ready
+        if (share.timeout_id):
+            GLib.source_remove (share.timeout_id)
+            share.timeout_id = None
+        if (share.monitor):
+            share.monitor.stop ()
+            share.monitor = None
+        self.shares.pop (share.token, None)
+        if (share == self.share):
+            self.share = None
+
+        key = share.archive_key
+        share.archive_key = None
+        if (key and share.archive_state != ArchiveState.PREPARING and
+            not self.get_archive_shares (key)):
+            self.archive_cache.release (key)
+        self.page_cache.invalidate ()
+
+
+    def on_share_expired (self, share):
+        share.timeout_id = None
+        self.remove_share (share)
+        self.change_callback ()
+        return False
 
-        if (not os.path.exists (new_fn)):
-            return (new_fn)
 
-        for i in range (2, 1000):
-            new_fn = os.path.join (self.upload_dir,
-                                   "{}({}){}".format ( fn, i, ext ))
-            if (not os.path.exists (new_fn)):
-                return new_fn
+    def get_archive_shares (self, key):
+        return [share for share in self.shares.values ()
+                if share.archive_key == key]
 
-        raise Exception
 
+    def on_archive_ready (self, key, archive, state):
+        del self.preparing_archives[key]
+        if (state == ArchiveState.READY):
+            archive = self.archive_cache.add (key, archive)
+            if (archive):
+                self.digest_cache.prepare ([archive])
+            else:
+                state = ArchiveState.FAILED
+        else:
+            self.archive_cache.discard (key)
+
+        # live shares keep their current archive if the new one failed
+        updated = [share for share in self.shares.values ()
+                   if share.next_archive_key == key]
+        for share in updated:
+            share.next_archive_key = None
+            if (state == ArchiveState.READY):
+                self.replace_archive (share, key, archive)
+            elif (not share.archive_key):
+                share.archive_state = ArchiveState.FAILED
+                share.shared_file = None
+
+        shares = self.get_archive_shares (key)
+        if (not shares):
+            # sharing was stopped while the archive was being prepared,
+            # or it failed for shares that had no archive yet
+            self.archive_cache.release (key)
+            if (updated):
+                self.change_callback ()
+            return
 
-    def on_archive_ready (self, state):
-        self.archive_state = state
-        if (self.archive_state == ArchiveState.FAILED):
-            self.shared_file = None
+        for share in shares:
+            share.archive_state = state
+            if (share.archive_state == ArchiveState.FAILED):
+                share.shared_file = None
         self.change_callback ()
 
 
-class FriendlyWindow (Gtk.Window):
+    def is_control_request (self, path, client):
+        return (self.control_api and
+                (path == "/shares" or path.startswith ("/shares/")) and
+                is_loopback_address (client.get_host ()))
+
+
+    def handle_control_request (self, message, path):
+        # A JSON API for managing shares, only available from this
+        # machine:
+        #   GET /shares                list the shares
+        #   POST /shares               {"files": [...], "lifetime": seconds,
+        #                               "individually": bool} adds a share
+        #   DELETE /shares/<token>     removes a share
+        # The Host check stops web pages that use DNS rebinding. Requiring
+        # a JSON body means a browser has to send a CORS preflight, which
+        # is never answered, so pages cannot POST here either.
+        if (not is_loopback_host (message.request_headers.get_one ("Host"))):
+            message.set_status (Status.FORBIDDEN)
+            return
+        if (path == "/shares" and message.method == "GET"):
+            reply = [share.get_status () for share in self.shares.values ()]
+            status = Status.OK
+        elif (path == "/shares" and message.method == "POST"):
+            content_type, params = message.request_headers.get_content_type ()
+            if (content_type != "application/json"):
+                message.set_status (Status.UNSUPPORTED_MEDIA_TYPE)
+                return
+            try:
+                request = json.loads (message.request_body.flatten ().get_data ().decode ("utf-8"))
+                files = [os.path.abspath (f) for f in request["files"]]
+                lifetime = request.get ("lifetime")
+                individually = request.get ("individually")
+            except (KeyError, TypeError, ValueError, AttributeError):
+                message.set_status (Status.BAD_REQUEST)
+                return
+            if (lifetime != None and
+                (isinstance (lifetime, bool) or not isinstance (lifetime, int) or
+                 lifetime <= 0 or lifetime > 0xFFFFFFFF)):
+                # seconds for GLib.timeout_add_seconds ()
+                message.set_status (Status.BAD_REQUEST)
+                return
+            if (not files or not all (os.path.exists (f) for f in files)):
+                message.set_status (Status.NOT_FOUND)
+                return
+            share = self.add_share (files, lifetime, individually)
+            self.change_callback ()
+            reply = share.get_status ()
+            status = Status.CREATED
+            message.response_headers.replace ("Location", share.prefix)
+        elif (path.startswith ("/shares/") and message.method == "DELETE"):
+            share = self.shares.get (path[len ("/shares/"):])
+            if (not share):
+                message.set_status (Status.NOT_FOUND)
+                return
+            self.remove_share (share)
+            self.change_callback ()
+            message.set_status (Status.NO_CONTENT)
+            return
+        else:
+            message.set_status (Status.METHOD_NOT_ALLOWED)
+            return
+
+        message.set_response ("application/json", Soup.MemoryUse.COPY,
+                              json.dumps (reply).encode ("utf-8"))
+        message.set_status (status)
+
+
+class FriendlyWindow:
 
-    def __init__ (self, files, port, allow_uploads):
-        Gtk.Window.__init__ (self, title = FFS_APP_NAME)
+    def __init__ (self, args):
+        self.window = Gtk.Window (title = FFS_APP_NAME)
 
-        self.config_port = port
+        self.config_port = args.port
 
-        self.connect ("delete_event", self.delete_event)
+        self.window.connect ("delete_event", self.delete_event)
 
-        self.set_default_size (350, 250)
+        self.window.set_default_size (350, 250)
 
         hbox = Gtk.HBox (spacing = 6)
         hbox.set_border_width (18)
-        self.add (hbox)
+        self.window.add (hbox)
 
         vbox = Gtk.VBox (spacing = 12)
         hbox.pack_start (vbox, True, True, 0)
@@ -570,12 +4699,13 @@ class FriendlyWindow (Gtk.Window):
         hbox.pack_start (self.upload_label, True, True, 0)
 
         self.upload_switch = Gtk.Switch ()
-        self.upload_switch.set_active (allow_uploads)
+        self.upload_switch.set_active (args.allow_uploads)
         hbox.pack_start (self.upload_switch, False, False, 0)
         self.upload_switch.connect ("notify::active", self.on_upload_switch_notify)
 
         try:
-            self.server = FriendlyFileServer (port, allow_uploads, self.on_server_change)
+            self.server = create_server (args, self.on_server_change)
+            files = list (set (args.file))
             if (len (files) > 0):
                 self.server.start_sharing (files)
         except:
@@ -602,11 +4732,12 @@ class FriendlyWindow (Gtk.Window):
             else:
                 self.sharing_label.set_text ("Failed to start the web server on port %d."
                                              % self.config_port)
-            self.set_sensitive (False)
+            self.window.set_sensitive (False)
             return
 
         # always show the local address
-        self.local_ip_label.set_text ("http://%s:%d" % (self.server.local_ip, self.server.get_port ()))
+        self.local_ip_label.set_text (self.server.get_local_uri () or
+                                      "Looking up the address...")
 
         # only show the port-forwarded opened address if we know it works ...
         if (self.server.upnp_ip_state == IPState.AVAILABLE):
@@ -627,14 +4758,15 @@ class FriendlyWindow (Gtk.Window):
             self.upload_label.set_text ("Allow uploads:\n(No uploads yet)")
         elif (self.server.upload_count == 1):
             self.upload_label.set_markup ("Allow uploads:\n(<a href='file://%s' title='Open containing folder'>One upload</a> so far, %s)"
-                                          % (self.server.upload_dir, get_human_readable_bytes(self.server.upload_bytes)))
+                                          % (self.server.upload_dir.get_base_dir (), get_human_readable_bytes(self.server.upload_bytes)))
         elif (self.server.upload_count > 1):
             self.upload_label.set_markup ("Allow uploads:\n(<a href='file://%s' title='Open containing folder'>%d uploads</a> so far, totalling %s)"
-                                          % (self.server.upload_dir, self.server.upload_count, get_human_readable_bytes(self.server.upload_bytes)))
+                                          % (self.server.upload_dir.get_base_dir (), self.server.upload_count, get_human_readable_bytes(self.server.upload_bytes)))
 
-        if (self.server.shared_file == None):
+        share = self.server.share
+        if (share == None or share.shared_file == None):
             self.share_button.set_label ("Share files")
-            if (self.server.archive_state == ArchiveState.FAILED):
+            if (share and share.archive_state == ArchiveState.FAILED):
                 self.sharing_label.set_text ("Failed to create the archive.")
             else:
                 self.sharing_label.set_text ("Currently sharing nothing.")
@@ -642,27 +4774,32 @@ class FriendlyWindow (Gtk.Window):
 
         self.share_button.set_label ("Stop sharing")
 
-        basename = GLib.path_get_basename (self.server.shared_file)
-        if (self.server.archive_state == ArchiveState.PREPARING):
+        basename = GLib.path_get_basename (share.shared_file)
+        if (share.archive_state == ArchiveState.PREPARING):
             self.sharing_label.set_text ("Now preparing '%s' for sharing"
                                          % basename)
-        elif (self.server.download_count < 1):
-            if (self.server.download_finished_count == 0):
+        elif (share.download_count < 1):
+            if (share.download_finished_count == 0):
                 text = "no downloads yet"
-            elif  (self.server.download_finished_count == 1):
+            elif  (share.download_finished_count == 1):
                 text = "downloaded once"
             else:
-                text = "%d downloads so far" % self.server.download_finished_count
+                text = "%d downloads so far" % share.download_finished_count
             self.sharing_label.set_text ("Sharing '%s'\n(%s)"
                                          % (basename, text))
         else:
-            if (self.server.download_finished_count == 0):
+            if (share.download_finished_count == 0):
                 text = "download in progress"
-            elif  (self.server.download_finished_count == 1):
+            elif  (share.download_finished_count == 1):
                 text = "download in progress, downloaded once already"
             else:
                 text = "download in progress, %d downloads so far" \
-                       % self.server.download_finished_count
+                       % share.download_finished_count
+            admission = self.server.admission
+            if (admission and admission.get_queue_length () > 0):
+                text += "\n%d waiting in queue for up to %d s" \
+                        % (admission.get_queue_length (),
+                           admission.get_longest_wait ())
             self.sharing_label.set_text ("Sharing '%s'\n(%s)"
                                          % (basename, text))
 
@@ -672,20 +4809,23 @@ class FriendlyWindow (Gtk.Window):
 
 
     def on_button_clicked (self, widget):
-        if (self.server.shared_file != None):
+        if (self.server.share and self.server.share.shared_file != None):
             self.server.stop_sharing ()
         else:
-            dialog = Gtk.FileChooserDialog ("Select files or folders to share", self,
+            dialog = Gtk.FileChooserDialog ("Select files or folders to share", self.window,
                                             Gtk.FileChooserAction.OPEN,
                                             (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
                                              "Share", Gtk.ResponseType.OK))
             dialog.set_select_multiple (self.server.can_share_multiple ())
             if (self.server.can_share_multiple ()):
-                info = Gtk.Label ("You can select multiple files. If you do, they will "
-                                  "be added to a zip archive which will then be shared.")
-                dialog.set_extra_widget (info)
+                individual_check = Gtk.CheckButton ("Share multiple files individually "
+                                                    "instead of as a zip archive")
+                individual_check.set_active (self.server.share_individually)
+                dialog.set_extra_widget (individual_check)
             if (dialog.run () == Gtk.ResponseType.OK):
                 files = dialog.get_filenames ()
+                if (self.server.can_share_multiple ()):
+                    self.server.share_individually = individual_check.get_active ()
                 try:
                     self.server.start_sharing (files)
                 except:
@@ -694,16 +4834,598 @@ class FriendlyWindow (Gtk.Window):
             dialog.destroy ()
 
 
-# https://bugzilla.gnome.org/show_bug.cgi?id=622084
-signal.signal (signal.SIGINT, signal.SIG_DFL)
+class FriendlyDaemon:
+
+    # Runs the server without a user interface on a plain GLib main
+    # loop. Status changes are printed to stdout and, if a status file
+    # was given, written to it as JSON.
+
+    def __init__ (self, args):
+        self.status_file = args.status_file
+        self.last_status = None
+        self.loop = GLib.MainLoop ()
+        self.server = None
+        self.server = create_server (args, self.on_server_change)
+        files = list (set (args.file))
+        if (len (files) > 0):
+            self.server.start_sharing (files)
+        self.on_server_change ()
+
+
+    def get_status (self):
+        server = self.server
+        status = {"local_uri": server.get_local_uri (),
+                  "local_state": server.local_ip_state,
+                  "upnp_uri": None,
+                  "upnp_state": server.upnp_ip_state,
+                  "local_rtt": None,
+                  "upnp_rtt": None,
+                  "shared_file": None,
+                  "archive_state": ArchiveState.NA,
+                  "downloads_in_progress": 0,
+                  "downloads_finished": 0,
+                  "uploads": server.upload_count,
+                  "upload_bytes": server.upload_bytes,
+                  "queued_downloads": 0,
+                  "queue_wait": 0}
+        if (server.upnp_ip_state == IPState.AVAILABLE):
+            status["upnp_uri"] = "http://%s:%d" % (server.upnp_ip, server.upnp_port)
+        if (server.local_prober):
+            status["local_rtt"] = server.local_prober.rtt
+        if (server.upnp_prober):
+            status["upnp_rtt"] = server.upnp_prober.rtt
+        if (server.share):
+            status["shared_file"] = server.share.shared_file
+            status["archive_state"] = server.share.archive_state
+            status["downloads_in_progress"] = server.share.download_count
+            status["downloads_finished"] = server.share.download_finished_count
+        status["shares"] = [share.get_status () for share in server.shares.values ()]
+        if (server.admission):
+            status["queued_downloads"] = server.admission.get_queue_length ()
+            status["queue_wait"] = int (server.admission.get_longest_wait ())
+        return status
+
+
+    def on_server_change (self):
+        if (not self.server):
+            return
+        status = self.get_status ()
+        if (status == self.last_status):
+            return
+        self.last_status = status
+
+        if (status["shared_file"]):
+            sharing = "sharing '%s' (%d downloads in progress, %d finished)" % (
+                GLib.path_get_basename (status["shared_file"]),
+                status["downloads_in_progress"], status["downloads_finished"])
+        else:
+            sharing = "sharing nothing"
+        other_shares = len (status["shares"]) - (1 if self.server.share else 0)
+        if (other_shares > 0):
+            sharing += ", %d other shares" % other_shares
+        if (status["queued_downloads"]):
+            sharing += ", %d downloads queued (waiting up to %d s)" % (
+                status["queued_downloads"], status["queue_wait"])
+        uris = status["local_uri"] or "port %d" % self.server.get_port ()
+        if (status["upnp_uri"]):
+            uris += ", " + status["upnp_uri"]
+        print ("Serving at %s: %s, %d uploads" % (uris, sharing, status["uploads"]))
+        sys.stdout.flush ()
+
+        if (self.status_file):
+            try:
+                with open (self.status_file + ".tmp", "w") as f:
+                    json.dump (status, f)
+                os.rename (self.status_file + ".tmp", self.status_file)
+            except (IOError, OSError):
+                logging.warning ("Failed to write status file %s" % self.status_file)
+
+
+    def quit (self):
+        self.loop.quit ()
+        return False
+
+
+    def run (self):
+        GLib.unix_signal_add (GLib.PRIORITY_DEFAULT, signal.SIGINT, self.quit)
+        GLib.unix_signal_add (GLib.PRIORITY_DEFAULT, signal.SIGTERM, self.quit)
+        self.loop.run ()
+        self.server.shutdown ()
+
+
+class FriendlyFetcher:
+
+    # Command line client for downloading a shared file ("ffs.py --fetch
+    # URL"). The size is found with HEAD and the file is split into
+    # segments that are downloaded with Range requests over
+    # 'connections' parallel connections, straight into a preallocated
+    # partial file next to the target. The segments that are still
+    # missing are kept in a state file, so running the same fetch again
+    # after an interruption continues where it stopped.
+    #
+    # If there is an older copy of the file, only the chunks that are
+    # not in it are downloaded: the chunk list of the share
+    # ("<URL>.chunks") is compared with the chunks of the local copy,
+    # the known chunks are copied and the segments only cover the
+    # missing ones. The result is checked against the SHA-256 from the
+    # chunk list (or the Repr-Digest header) before it replaces the
+    # target.
+
+    SEGMENT_SIZE = 8 * 1024 * 1024
+    RETRIES = 3
+    PREPARE_RETRIES = 120
+    MAX_RETRY_AFTER = 60
+
+    def __init__ (self, url, output = None, old_copy = None, connections = 4):
+        parts = urlparse.urlsplit (url)
+        if (parts.scheme != "http" or not parts.hostname):
+            raise Exception ("Not an ffs download URL: %s" % url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip ("/") or "/1"
+        self.output = output
+        self.old_copy = old_copy
+        self.connections = max (1, connections)
+        self.connection = None
+        self.lock = threading.Lock ()
+        self.etag = None
+        self.state = None
+        self.state_name = None
+        self.error = None
+        self.downloaded_bytes = 0
+        self.reused_bytes = 0
+        self.elapsed = 0
+
+
+    def request (self, connection, method, path, headers = {}):
+        # Returns (connection, response). A request on a connection that
+        # the server has closed is retried once on a new connection.
+        for attempt in range (2):
+            if (not connection):
+                connection = httplib.HTTPConnection (self.host, self.port,
+                                                     timeout = 30)
+            try:
+                connection.request (method, path, headers = headers)
+                return (connection, connection.getresponse ())
+            except (httplib.HTTPException, socket.error):
+                connection.close ()
+                connection = None
+                if (attempt > 0):
+                    raise
+
+
+    def request_ready (self, method, path):
+        # request() on the main connection, waiting while the server
+        # answers 202 because it is still preparing the response; the
+        # 202 response is returned if it is still not ready after
+        # PREPARE_RETRIES attempts
+        for attempt in range (FriendlyFetcher.PREPARE_RETRIES):
+            self.connection, response = self.request (self.connection, method, path)
+            if (response.status != Status.ACCEPTED):
+                return response
+            response.read ()
+            try:
+                delay = int (response.getheader ("Retry-After", "5"))
+            except ValueError:
+                delay = 5
+            time.sleep (min (max (delay, 1), FriendlyFetcher.MAX_RETRY_AFTER))
+        return response
+
+
+    def get_chunk_list (self):
+        # None if the share has no chunk list (e.g. a single file of
+        # an individually shared directory)
+        response = self.request_ready ("GET", self.path + ".chunks")
+        body = response.read ()
+        if (response.status != Status.OK):
+            return None
+        return json.loads (body.decode ("utf-8"))
+
+
+    def index_old_copy (self, path):
+        # chunk digest -> (offset, length) in the old copy
+        chunks = {}
+        with open (path, "rb") as f:
+            for offset, data in split_delta_chunks (f):
+                chunks.setdefault (hashlib.sha256 (data).hexdigest (),
+                                   (offset, len (data)))
+        return chunks
+
+
+    def fetch (self):
+        response = self.request_ready ("HEAD", self.path)
+        response.read ()
+        if (response.status != Status.OK):
+            raise Exception ("Cannot download %s (%d %s)" %
+                             (self.path, response.status, response.reason))
+        output = self.output or self.get_filename (response) or "download"
+        temp_name = output + ".part"
+        self.state_name = temp_name + ".json"
+        self.etag = response.getheader ("ETag")
+        size = response.getheader ("Content-Length")
+
+        started = time.time ()
+        if (response.getheader ("Accept-Ranges") != "bytes" or size == None):
+            # e.g. an archive that is created while it is sent
+            digest = self.fetch_whole (temp_name)
+        else:
+            size = int (size)
+            self.state = self.load_state (temp_name, size)
+            if (not self.state):
+                self.state = self.plan (output, temp_name, size,
+                                        get_repr_digest (response))
+                self.save_state ()
+            self.download_segments (temp_name)
+            digest = self.state["sha256"]
+        self.elapsed = time.time () - started
+
+        if (digest and get_file_digest (temp_name) != digest):
+            self.remove_partial (temp_name)
+            raise Exception ("Checksum of %s does not match" % output)
+        os.rename (temp_name, output)
+        self.remove_partial (None)
+        return output
+
+
+    def get_filename (self, response):
+        value = response.getheader ("Content-Disposition")
+        if (not value):
+            return None
+        headers = Soup.MessageHeaders.new (Soup.MessageHeadersType.RESPONSE)
+        headers.append ("Content-Disposition", value)
+        [has_cd, cd, params] = headers.get_content_disposition ()
+        if (not has_cd or not params.get ("filename")):
+            return None
+        return os.path.basename (params["filename"].replace ("\\", "/"))
+
+
+    def fetch_whole (self, temp_name):
+        # one plain GET, cannot be resumed
+        self.connection, response = self.request (self.connection, "GET", self.path)
+        if (response.status != Status.OK):
+            raise Exception ("Download failed (%d %s)" % (response.status, response.reason))
+        with open (temp_name, "wb") as f:
+            data = response.read (CHUNK_SIZE)
+            while (data):
+                f.write (data)
+                self.downloaded_bytes += len (data)
+                data = response.read (CHUNK_SIZE)
+        return get_repr_digest (response)
+
+
+    def plan (self, output, temp_name, size, digest):
+        # Preallocates the partial file, copies the chunks that can be
+        # reused from an old copy and returns the new state: the
+        # segments to download as [offset, length, chunks], where chunks
+        # are the [offset, length, digest] in the segment or None
+        with open (temp_name, "wb") as f:
+            if (hasattr (os, "posix_fallocate") and size > 0):
+                os.posix_fallocate (f.fileno (), 0, size)
+            else:
+                f.truncate (size)
+
+        old_copy = self.old_copy
+        if (not old_copy and os.path.isfile (output)):
+            old_copy = output
+        chunk_list = self.get_chunk_list () if old_copy else None
+        if (not chunk_list):
+            segments = [[offset, min (FriendlyFetcher.SEGMENT_SIZE, size - offset), None]
+                        for offset in range (0, size, FriendlyFetcher.SEGMENT_SIZE)]
+            return {"size": size, "etag": self.etag, "sha256": digest,
+                    "segments": segments}
+        if (chunk_list["size"] != size):
+            raise Exception ("The shared file changed during download")
+
+        old_chunks = self.index_old_copy (old_copy)
+        segments = []
+        with open (temp_name, "r+b") as f:
+            with open (old_copy, "rb") as old_file:
+                for offset, length, chunk_digest in chunk_list["chunks"]:
+                    if (chunk_digest in old_chunks):
+                        old_offset, old_length = old_chunks[chunk_digest]
+                        old_file.seek (old_offset)
+                        f.seek (offset)
+                        f.write (old_file.read (old_length))
+                        self.reused_bytes += old_length
+                        continue
+                    # consecutive missing chunks share a segment
+                    segment = segments[-1] if segments else None
+                    if (not segment or segment[0] + segment[1] != offset or
+                        segment[1] + length > FriendlyFetcher.SEGMENT_SIZE):
+                        segment = [offset, 0, []]
+                        segments.append (segment)
+                    segment[1] += length
+                    segment[2].append ([offset, length, chunk_digest])
+        return {"size": size, "etag": self.etag, "sha256": chunk_list["sha256"],
+                "segments": segments}
+
+
+    def load_state (self, temp_name, size):
+        # the state of an earlier fetch of the same version of the file
+        try:
+            with open (self.state_name) as f:
+                state = json.load (f)
+            if (state["size"] != size or state["etag"] != self.etag or
+                os.path.getsize (temp_name) != size):
+                return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        done = size - sum (segment[1] for segment in state["segments"])
+        print ("Resuming download, %s already done" % get_human_readable_bytes (done))
+        return state
+
+
+    def save_state (self):
+        # called with the lock held (or before the workers start)
+        try:
+            with open (self.state_name + ".tmp", "w") as f:
+                json.dump (self.state, f)
+            os.rename (self.state_name + ".tmp", self.state_name)
+        except (IOError, OSError):
+            logging.warning ("Failed to save the download state")
+
+
+    def remove_partial (self, temp_name):
+        for name in [temp_name, self.state_name]:
+            try:
+                if (name):
+                    os.remove (name)
+            except OSError:
+                pass
+
+
+    def download_segments (self, temp_name):
+        queue = collections.deque (self.state["segments"])
+        threads = []
+        for i in range (min (self.connections, len (queue))):
+            thread = threading.Thread (target = self.run_worker,
+                                       args = (queue, temp_name))
+            thread.daemon = True
+            thread.start ()
+            threads.append (thread)
+
+        started = time.time ()
+        while (True):
+            alive = [thread for thread in threads if thread.is_alive ()]
+            if (not alive):
+                break
+            alive[0].join (1.0)
+            if (sys.stdout.isatty ()):
+                elapsed = max (time.time () - started, 0.001)
+                sys.stdout.write ("\r%s downloaded, %s/s    " %
+                                  (get_human_readable_bytes (self.downloaded_bytes),
+                                   get_human_readable_bytes (self.downloaded_bytes / elapsed)))
+                sys.stdout.flush ()
+        if (sys.stdout.isatty ()):
+            sys.stdout.write ("\n")
+
+        if (self.error):
+            raise Exception ("%s (run the same command again to resume)" % self.error)
+
+
+    def run_worker (self, queue, temp_name):
+        # one connection: takes segments from the queue until it is empty
+        connection = None
+        try:
+            with open (temp_name, "r+b") as f:
+                while (not self.error):
+                    with self.lock:
+                        if (not queue):
+                            break
+                        segment = queue.popleft ()
+                    connection = self.download_segment (connection, f, segment)
+                    with self.lock:
+                        self.state["segments"].remove (segment)
+                        self.save_state ()
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or str (e)
+        if (connection):
+            connection.close ()
+
+
+    def download_segment (self, connection, f, segment):
+        # network errors are retried on a new connection
+        for attempt in range (FriendlyFetcher.RETRIES):
+            try:
+                return self.try_download_segment (connection, f, segment)
+            except (httplib.HTTPException, socket.error):
+                if (connection):
+                    connection.close ()
+                connection = None
+                if (attempt == FriendlyFetcher.RETRIES - 1):
+                    raise
+
+
+    def try_download_segment (self, connection, f, segment):
+        offset, length, chunks = segment
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+        if (self.etag):
+            headers["If-Range"] = self.etag
+        connection, response = self.request (connection, "GET", self.path, headers)
+        if (response.status != Status.PARTIAL_CONTENT):
+            connection.close ()
+            if (response.status == Status.OK):
+                raise Exception ("The shared file changed during download")
+            raise Exception ("Range request failed (%d %s)" %
+                             (response.status, response.reason))
+
+        f.seek (offset)
+        for chunk_offset, chunk_length, chunk_digest in chunks or [[offset, length, None]]:
+            digest = hashlib.sha256 () if chunk_digest else None
+            remaining = chunk_length
+            while (remaining > 0):
+                data = response.read (min (remaining, CHUNK_SIZE))
+                if (not data):
+                    raise httplib.IncompleteRead (b"", remaining)
+                f.write (data)
+                if (digest):
+                    digest.update (data)
+                remaining -= len (data)
+                with self.lock:
+                    self.downloaded_bytes += len (data)
+            if (digest and digest.hexdigest () != chunk_digest):
+                raise Exception ("The shared file changed during download")
+        response.read ()
+        return connection
+
+
+def create_server (args, change_callback):
+    return FriendlyFileServer (args.port, args.allow_uploads, change_callback,
+                               args.prepare_archives,
+                               args.archive_cache_size * 1024 * 1024,
+                               args.individually,
+                               not args.no_upnp, not args.no_zeroconf,
+                               args.metrics,
+                               create_rate_limiter (args.download_rate, args),
+                               create_rate_limiter (args.upload_rate, args),
+                               args.max_downloads, args.download_queue,
+                               args.control_api, args.zero_copy, args.live,
+                               args.variant_cache_size * 1024 * 1024)
+
+
+def create_rate_limiter (rate, args):
+    if (not (rate or args.client_rate or args.local_rate or args.internet_rate)):
+        return None
+    return FriendlyRateLimiter (rate * 1024, args.client_rate * 1024,
+                                args.local_rate * 1024, args.internet_rate * 1024)
+
+
+def run_gui (args):
+    global Gtk, Pango
+    from gi.repository import Gtk, Pango
+
+    # https://bugzilla.gnome.org/show_bug.cgi?id=622084
+    signal.signal (signal.SIGINT, signal.SIG_DFL)
+
+    win = FriendlyWindow (args)
+    win.window.connect ("delete-event", Gtk.main_quit)
+    win.window.show_all ()
+    if (win.server):
+        win.server.startup_log.end ("showing the window")
+    Gtk.main ()
+
+
+def run_headless (args):
+    try:
+        daemon = FriendlyDaemon (args)
+    except:
+        logging.error ("Failed to start the web server")
+        traceback.print_exc ()
+        sys.exit (1)
+    daemon.run ()
+
+
+def run_fetch (args):
+    try:
+        fetcher = FriendlyFetcher (args.fetch, args.output, args.old_copy,
+                                   args.connections)
+        output = fetcher.fetch ()
+    except KeyboardInterrupt:
+        sys.exit (1)
+    except Exception as e:
+        logging.error ("Download failed: %s" % e)
+        sys.exit (1)
+    print ("Saved %s: downloaded %s in %.1f s (%s/s over %d connections), "
+           "reused %s from the old copy"
+           % (output, get_human_readable_bytes (fetcher.downloaded_bytes),
+              fetcher.elapsed,
+              get_human_readable_bytes (fetcher.downloaded_bytes /
+                                        max (fetcher.elapsed, 0.001)),
+              fetcher.connections,
+              get_human_readable_bytes (fetcher.reused_bytes)))
+
+
+def main ():
+    parser = argparse.ArgumentParser (description = "Share files on the internet.")
+    parser.add_argument ("file", nargs = "*", help = "file that should be shared")
+    parser.add_argument ("-p", "--port", type = int, default = 0)
+    parser.add_argument ("-u", "--allow-uploads", action = "store_true")
+    parser.add_argument ("--prepare-archives", action = "store_true",
+                         help = "create archives before sharing them instead "
+                                "of streaming them, so downloads can be resumed")
+    parser.add_argument ("--archive-cache-size", type = int, default = 2048,
+                         metavar = "MB",
+                         help = "disk space used for keeping prepared archives "
+                                "(default: %(default)s)")
+    parser.add_argument ("--variant-cache-size", type = int, default = 1024,
+                         metavar = "MB",
+                         help = "disk space used for keeping compressed copies "
+                                "of shared files (default: %(default)s)")
+    parser.add_argument ("-i", "--individually", action = "store_true",
+                         help = "share multiple files or directories as a list "
+                                "of individual files instead of a zip archive")
+    parser.add_argument ("--headless", action = "store_true",
+                         help = "run without a user interface, reporting status "
+                                "on stdout")
+    parser.add_argument ("--status-file", metavar = "FILE",
+                         help = "in headless mode, keep the current status in "
+                                "FILE as JSON")
+    parser.add_argument ("--no-upnp", action = "store_true",
+                         help = "do not try to open a port on the router")
+    parser.add_argument ("--no-zeroconf", action = "store_true",
+                         help = "do not announce the server on the local network")
+    parser.add_argument ("--metrics", action = "store_true",
+                         help = "serve request metrics in the Prometheus text "
+                                "format at /metrics")
+    parser.add_argument ("--download-rate", type = int, default = 0, metavar = "KB/S",
+                         help = "limit the total speed of downloads")
+    parser.add_argument ("--upload-rate", type = int, default = 0, metavar = "KB/S",
+                         help = "limit the total speed of uploads")
+    parser.add_argument ("--client-rate", type = int, default = 0, metavar = "KB/S",
+                         help = "limit the speed of each client, in both directions")
+    parser.add_argument ("--local-rate", type = int, default = 0, metavar = "KB/S",
+                         help = "limit the speed of all local network clients, "
+                                "in both directions")
+    parser.add_argument ("--internet-rate", type = int, default = 0, metavar = "KB/S",
+                         help = "limit the speed of all internet clients, in "
+                                "both directions")
+    parser.add_argument ("--max-downloads", type = int, default = 0, metavar = "N",
+                         help = "send at most N downloads at the same time, "
+                                "queueing the rest")
+    parser.add_argument ("--download-queue", type = int, default = 32, metavar = "N",
+                         help = "with --max-downloads, queue at most N downloads "
+                                "and reject the rest (default: %(default)s)")
+    parser.add_argument ("--zero-copy", action = "store_true",
+                         help = "send plain files with sendfile() on connections "
+                                "taken over from libsoup (needs Python 3 and "
+                                "libsoup 2.50)")
+    parser.add_argument ("--control-api", action = "store_true",
+                         help = "manage shares with JSON requests to "
+                                "localhost: GET and POST /shares (with "
+                                "Content-Type application/json), DELETE "
+                                "/shares/TOKEN")
+    parser.add_argument ("--live", action = "store_true",
+                         help = "keep shared directories up to date when files "
+                                "are added, changed or removed")
+    parser.add_argument ("-v", "--verbose", action = "store_true",
+                         help = "log informational messages, such as the time "
+                                "taken by each startup phase")
+    parser.add_argument ("--fetch", metavar = "URL",
+                         help = "download a shared file instead of sharing, "
+                                "in parallel segments and fetching only the "
+                                "parts that changed if an older copy exists; "
+                                "an interrupted download is resumed")
+    parser.add_argument ("-o", "--output", metavar = "FILE",
+                         help = "with --fetch, save the file as FILE")
+    parser.add_argument ("--old-copy", metavar = "FILE",
+                         help = "with --fetch, reuse the unchanged parts of "
+                                "FILE (default: the output file)")
+    parser.add_argument ("-j", "--connections", type = int, default = 4, metavar = "N",
+                         help = "with --fetch, download over N parallel "
+                                "connections (default: %(default)s)")
+    args = parser.parse_args ()
+
+    logging.basicConfig (format = "%(levelname)s: %(message)s",
+                         level = logging.INFO if args.verbose else logging.WARNING)
+
+    if (args.fetch):
+        run_fetch (args)
+    elif (args.headless):
+        run_headless (args)
+    else:
+        run_gui (args)
 
-parser = argparse.ArgumentParser (description = "Share files on the internet.")
-parser.add_argument ("file", nargs = "*", help = "file that should be shared")
-parser.add_argument ("-p", "--port", type = int, default = 0)
-parser.add_argument ("-u", "--allow-uploads", action = "store_true")
-args = parser.parse_args ()
 
-win = FriendlyWindow (list(set(args.file)), args.port, args.allow_uploads)
-win.connect ("delete-event", Gtk.main_quit)
-win.show_all ()
-Gtk.main ()
+if __name__ == "__main__":
+    main ()